@@ -0,0 +1,230 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+
+import numpy as np
+from pyVmomi import vim
+
+from soil.api.utils.vmware.index import is_instance_type
+from soil.api.utils.vmware.inventory import SUMMARY_COUNTERS
+from soil.api.utils.vmware.inventory import SUMMARY_FIELDS
+from soil.api.utils.vmware.inventory import TOPOLOGY_FIELDS
+
+
+GROUP_BY = ('vcenter', 'datacenter', 'cluster')
+
+# the fields read to aggregate summaries grouped by datacenter or cluster
+AGGREGATE_FIELDS = dict(
+    (type_name, SUMMARY_FIELDS.get(type_name, []) +
+     TOPOLOGY_FIELDS.get(type_name, []))
+    for type_name in set(SUMMARY_FIELDS) | set(TOPOLOGY_FIELDS))
+
+# summary counter -> (managed object type, field summed up)
+SUMMARY_METRICS = (
+    ('numHosts', 'ComputeResource', 'summary.numHosts'),
+    ('numEffectiveHosts', 'ComputeResource', 'summary.numEffectiveHosts'),
+    ('totalCpuMhz', 'ComputeResource', 'summary.totalCpu'),
+    ('totalMemory', 'ComputeResource', 'summary.totalMemory'),
+    ('numCpuCores', 'ComputeResource', 'summary.numCpuCores'),
+    ('numCpuThreads', 'ComputeResource', 'summary.numCpuThreads'),
+    ('effectiveCpuMhz', 'ComputeResource', 'summary.effectiveCpu'),
+    ('effectiveMemory', 'ComputeResource', 'summary.effectiveMemory'),
+    ('numCpus', 'HostSystem', 'hardware.cpuInfo.numCpuPackages'),
+    ('dataStore', 'Datastore', 'summary.capacity'),
+)
+
+_METRIC_TYPES = ('ComputeResource', 'HostSystem', 'Datastore',
+                 'VirtualMachine')
+
+# types whose place in the inventory tree is remembered for grouping
+_TOPOLOGY_TYPES = ('Folder', 'Datacenter', 'ComputeResource', 'HostSystem')
+
+# metric type -> field leading to the cluster of the object
+_CLUSTER_KEY = {
+    'ComputeResource': None,
+    'HostSystem': 'parent',
+    'VirtualMachine': 'runtime.host',
+    'Datastore': 'parent',
+}
+
+# bound on the depth of nested folders between a datacenter and its objects
+_MAX_DEPTH = 64
+
+
+def _objects(column):
+    """Returns column if it holds objects, None if all its values were unset
+
+    A field unset on every row of a batch is an int64 column of zeros.
+    """
+    if column is None or column.dtype != object:
+        return None
+    return column
+
+
+class SummaryAggregator(object):
+    """Reduces ColumnBatch of one or many vCenters into summaries
+
+    Batches are kept as numpy columns while they are added. finish() then
+    sums every metric with a single vectorized reduction over all the
+    batches, optionally grouped by vCenter, datacenter or cluster: the
+    group of every row is resolved once per distinct parent, not per row.
+    """
+
+    def __init__(self, group_by=None):
+        if group_by is not None and group_by not in GROUP_BY:
+            raise ValueError("group_by must be one of %s" %
+                             ', '.join(GROUP_BY))
+        self.group_by = group_by
+        self._batches = collections.defaultdict(list)
+        self._topology = {}
+        self._hostnames = {}
+
+    def add(self, batch, vcenter=None, vcenter_host=None):
+        """Adds a ColumnBatch of the objects of vcenter
+
+        :param vcenter: the identifier of the vCenter of the batch
+        :param vcenter_host: the address of the vCenter, used to find the
+            hostname of the vCenter appliance among the virtual machines
+        """
+        type_name = batch.type_name
+        if self.group_by in ('datacenter', 'cluster') and any(
+                is_instance_type(type_name, [getattr(vim, topology_type)])
+                for topology_type in _TOPOLOGY_TYPES):
+            parents = _objects(batch.columns.get('parent'))
+            names = _objects(batch.columns.get('name'))
+            for i, moid in enumerate(batch.moids):
+                self._topology[(vcenter, moid)] = (
+                    type_name,
+                    parents[i] if parents is not None else None,
+                    names[i] if names is not None else None)
+
+        for metric_type in _METRIC_TYPES:
+            if is_instance_type(type_name, [getattr(vim, metric_type)]):
+                self._batches[metric_type].append((vcenter, batch))
+
+        if vcenter_host and is_instance_type(type_name,
+                                             [vim.VirtualMachine]):
+            addresses = _objects(batch.columns.get('guest.net[].ipAddress'))
+            hostnames = _objects(batch.columns.get('guest.hostName'))
+            if addresses is not None and hostnames is not None:
+                for i, ips in enumerate(addresses):
+                    if ips and vcenter_host in ips:
+                        self._hostnames[vcenter] = hostnames[i]
+
+    def hostname(self, vcenter=None):
+        """Returns the guest hostname of the vCenter appliance, if found"""
+        return self._hostnames.get(vcenter, '')
+
+    def finish(self):
+        """Returns the summaries
+
+        :return: the summary of all the batches without group_by, else a
+        list of {'group': {...}, 'summary': {...}}, one per group
+        """
+        labels = collections.OrderedDict()
+        indexes = {}
+        if self.group_by is not None:
+            for metric_type, entries in self._batches.items():
+                indexes[metric_type] = np.concatenate(
+                    [self._group_index(vcenter, metric_type, batch, labels)
+                     for vcenter, batch in entries])
+
+        size = max(len(labels), 1)
+        totals = dict((counter, np.zeros(size, dtype=np.int64))
+                      for counter in SUMMARY_COUNTERS)
+
+        for counter, metric_type, field in SUMMARY_METRICS:
+            values = self._column(metric_type, field)
+            if values is not None:
+                self._reduce(totals[counter], indexes.get(metric_type),
+                             values)
+
+        templates = self._column('VirtualMachine', 'config.template')
+        if templates is not None:
+            index = indexes.get('VirtualMachine')
+            templates = (templates != 0).astype(np.int64)
+            self._reduce(totals['numTemplates'], index, templates)
+            self._reduce(totals['numVms'], index, 1 - templates)
+
+        if self.group_by is None:
+            return dict((counter, int(total[0]))
+                        for counter, total in totals.items())
+
+        result = []
+        for i, label in enumerate(labels):
+            result.append({
+                'group': self._describe(label),
+                'summary': dict((counter, int(total[i]))
+                                for counter, total in totals.items()),
+            })
+        return result
+
+    @staticmethod
+    def _reduce(total, index, values):
+        values = values.astype(np.int64, copy=False)
+        if index is None:
+            total[0] += values.sum()
+        else:
+            np.add.at(total, index, values)
+
+    def _column(self, metric_type, field):
+        entries = self._batches.get(metric_type)
+        if not entries:
+            return None
+        # rows must line up with the group indexes of every batch
+        return np.concatenate([
+            batch.columns.get(field, np.zeros(len(batch), dtype=np.int64))
+            for _vcenter, batch in entries])
+
+    def _group_index(self, vcenter, metric_type, batch, labels):
+        """Returns the group index of every row of batch"""
+        if self.group_by == 'vcenter':
+            label = (vcenter, None)
+            index = labels.setdefault(label, len(labels))
+            return np.full(len(batch), index, dtype=np.intp)
+
+        field = _CLUSTER_KEY[metric_type]
+        keys = batch.moids if field is None else _objects(
+            batch.columns.get(field))
+        if keys is None:
+            keys = np.full(len(batch), '', dtype=object)
+        keys = np.where(keys == None, '', keys).astype(str)  # noqa: E711
+        unique, inverse = np.unique(keys, return_inverse=True)
+        unique_index = np.empty(len(unique), dtype=np.intp)
+        for i, key in enumerate(unique):
+            label = (vcenter, self._resolve(vcenter, metric_type, str(key)))
+            unique_index[i] = labels.setdefault(label, len(labels))
+        return unique_index[inverse]
+
+    def _parent(self, vcenter, moid):
+        node = self._topology.get((vcenter, moid))
+        return node[1] if node is not None else None
+
+    def _resolve(self, vcenter, metric_type, key):
+        """Returns the moid of the group of an object from its key"""
+        if not key:
+            return None
+        if metric_type == 'VirtualMachine':
+            # the key of a virtual machine is its host
+            key = self._parent(vcenter, key)
+        if self.group_by == 'cluster':
+            return None if metric_type == 'Datastore' else key
+
+        moid = key
+        for _depth in range(_MAX_DEPTH):
+            node = self._topology.get((vcenter, moid))
+            if node is None:
+                return None
+            if node[0] == 'Datacenter':
+                return moid
+            moid = node[1]
+        return None
+
+    def _describe(self, label):
+        vcenter, moid = label
+        group = {'vcenter': vcenter}
+        if self.group_by != 'vcenter':
+            node = self._topology.get((vcenter, moid))
+            group['moid'] = moid
+            group[self.group_by] = node[2] if node is not None else None
+        return group
@@ -1,17 +1,34 @@
 # Copyright 2020 Soil, Inc.
 
+import collections
+import ssl
+import threading
 import time
 
+import eventlet
 from pyVim import connect
 from pyVmomi import vmodl
 from pyVmomi import vim
 from oslo_log import log as logging
 
+import soil.conf
+from soil.api.utils.vmware.bulkhead import get_bulkhead
+from soil.api.utils.vmware.bulkhead import is_unavailable_error
 from soil.api.utils.vmware.hybrid import HybridCloud
+from soil.api.utils.vmware.columns import ColumnBatch
+from soil.api.utils.vmware.columns import iter_column_batches
 from soil.api.utils.vmware.common import parse_propspec
-from soil.api.utils.vmware.serviceutil import build_full_traversal
+from soil.api.utils.vmware.index import get_index
+from soil.api.utils.vmware.index import is_instance_type
+from soil.api.utils.vmware.rawsoap import RawPropertyCollector
+from soil.api.utils.vmware.records import RecordSet
+from soil.api.utils.vmware.serviceutil import build_traversal
+from soil.api.utils.vmware.serviceutil import build_view_traversal
+from soil.api.utils.vmware.session import get_session_store
+from soil.api.utils.vmware.tasks import get_task_watcher
 
 
+CONF = soil.conf.CONF
 LOG = logging.getLogger(__name__)
 
 
@@ -22,33 +39,228 @@ def _connect_failed(*args, **kwargs):
               "username(%s) and password(%s)" % (_user, _pwd))
 
 
+class _PooledSession(object):
+    """A logged-in service instance together with its session identity"""
+
+    __slots__ = ('si', 'session_key', 'user_name', 'released_at', 'shared')
+
+    def __init__(self, si, session_key=None, user_name=None, shared=False):
+        self.si = si
+        self.session_key = session_key
+        self.user_name = user_name
+        self.released_at = None
+        # NOTE: a shared session is used by other processes as well and
+        # must never be logged out, it is just dropped when not needed
+        self.shared = shared
+
+
+class vCenterSessionPool(object):
+    """Per-process pool of logged-in vCenter sessions
+
+    Sessions are keyed by vCenter (host, port, user). ``checkout`` hands out
+    an idle session when there is one, validating it first with
+    SessionManager.SessionIsActive if it has been idle for longer than
+    ``[vmware]session_check_interval``, and logs in a new one otherwise.
+    ``checkin`` returns the session to the pool instead of logging it out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(collections.deque)
+
+    def checkout(self, key, login):
+        """Returns a live pooled session for key, logging in if needed
+
+        :param key: the (host, port, user) tuple of the vCenter
+        :param login: callable returning a new service instance, or None,
+            and whether it is shared with other processes
+        """
+        while key is not None:
+            with self._lock:
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+            if session is None:
+                break
+            idle_time = time.time() - session.released_at
+            if (idle_time < CONF.vmware.session_check_interval or
+                    self._is_active(session)):
+                return session
+            LOG.debug("Pooled session of vCenter %s expired, "
+                      "dropping it", key[0])
+            self._close(session)
+
+        si, shared = login()
+        if si is None:
+            return None
+        try:
+            current = si.content.sessionManager.currentSession
+            return _PooledSession(si, current.key, current.userName,
+                                  shared=shared)
+        except Exception:
+            return _PooledSession(si, shared=shared)
+
+    def checkin(self, key, session):
+        """Returns session to the pool, logging it out if the pool is full"""
+        if key is not None and CONF.vmware.session_pool_size > 0:
+            session.released_at = time.time()
+            with self._lock:
+                idle = self._idle[key]
+                if len(idle) < CONF.vmware.session_pool_size:
+                    idle.append(session)
+                    return
+        self._close(session)
+
+    def discard(self, session):
+        """Drops a session which failed while it was checked out"""
+        self._close(session)
+
+    def clear(self):
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._close(session)
+
+    @staticmethod
+    def _is_active(session):
+        if session.session_key is None:
+            return False
+        try:
+            sm = session.si.content.sessionManager
+            return sm.SessionIsActive(sessionID=session.session_key,
+                                      userName=session.user_name)
+        except vim.fault.NoPermission:
+            # NOTE: SessionIsActive needs Sessions.ValidateSession, a
+            # session lacking it is still usable as long as it answers
+            return sm.currentSession is not None
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(session):
+        if session.shared:
+            return
+        try:
+            connect.Disconnect(session.si)
+        except Exception:
+            pass
+
+
+_SESSION_POOL = vCenterSessionPool()
+
+
 class VMwareCloud(HybridCloud):
     """vmware cloud base class
 
-    Initialize a connection to a vcenter or vsphere.
+    Initialize a connection to a vcenter or vsphere. Logged-in sessions are
+    borrowed from and returned to the per-process session pool, so a
+    connect/disconnect pair costs no SOAP login/logout when a session of
+    the same vcenter is idle in the pool.
+
+    A connection holds a slot of the bulkhead of its vcenter from connect
+    to disconnect, and is refused with vCenterUnavailable when none is
+    free in time or the circuit breaker of the vcenter is open. Long-lived
+    connections pass background=True and hold a background slot instead,
+    so they can not starve the calls of the API.
     """
 
     def __init__(self, *args, **kwargs):
+        self.background = kwargs.pop('background', False)
         self.args = args
         self.kwargs = kwargs
         self.si = None
+        self._session = None
+        self._bulkhead = None
+        self._connect_error = None
+
+    @property
+    def session_key(self):
+        host = self.kwargs.get('host', None)
+        if host is None:
+            return None
+        return (host, int(self.kwargs.get('port', 443)),
+                self.kwargs.get('user', None))
+
+    def _login(self):
+        """Returns a service instance and whether it is shared"""
+        key = self.session_key
+        if key is None or not CONF.vmware.share_sessions:
+            return self._smart_connect(), False
+        return get_session_store().login(key, self._attach,
+                                         self._smart_connect)
+
+    def _attach(self, cookie):
+        """Returns a service instance on the session behind cookie
+
+        Returns None if the session is not authenticated anymore.
+        """
+        host, port, _user = self.session_key
+        stub = connect.SmartStubAdapter(
+            host=host, port=port,
+            sslContext=ssl._create_unverified_context())
+        stub.cookie = cookie
+        si = vim.ServiceInstance('ServiceInstance', stub)
+        try:
+            if si.content.sessionManager.currentSession is None:
+                return None
+        except Exception:
+            return None
+        return si
 
-    def connect(self):
+    def _smart_connect(self):
+        si = None
         try:
-            self.si = connect.SmartConnectNoSSL(*self.args, **self.kwargs)
+            si = connect.SmartConnectNoSSL(*self.args, **self.kwargs)
         except Exception:
             try:
-                self.si = connect.SmartConnect(*self.args, **self.kwargs)
-            except Exception:
-                pass
+                si = connect.SmartConnect(*self.args, **self.kwargs)
+            except Exception as e:
+                self._connect_error = e
         finally:
-            if self.si is None:
+            if si is None:
                 _connect_failed(*self.args, **self.kwargs)
+        return si
 
-    def disconnect(self):
-        if self.si:
-            connect.Disconnect(self.si)
-            self.si = None
+    def connect(self):
+        key = self.session_key
+        if key is not None:
+            bulkhead = get_bulkhead(key[:2])
+            bulkhead.acquire(background=self.background)
+            self._bulkhead = bulkhead
+        self._connect_error = None
+        try:
+            self._session = _SESSION_POOL.checkout(key, self._login)
+        except Exception as e:
+            self._release(failed=is_unavailable_error(e))
+            raise
+        if self._session is not None:
+            self.si = self._session.si
+        else:
+            # the login failed, nothing holds the slot; a fault like
+            # InvalidLogin proves the vcenter answers
+            self._release(failed=is_unavailable_error(self._connect_error))
+
+    def disconnect(self, discard=False, failed=False):
+        """Gives the session back to the pool
+
+        :param discard: drop the session instead of pooling it, used when
+            the session failed while it was in use
+        :param failed: the vcenter did not answer in time, counted by its
+            circuit breaker
+        """
+        if self._session is not None:
+            if discard:
+                _SESSION_POOL.discard(self._session)
+            else:
+                _SESSION_POOL.checkin(self.session_key, self._session)
+        self._session = None
+        self.si = None
+        self._release(failed)
+
+    def _release(self, failed=False):
+        if self._bulkhead is not None:
+            self._bulkhead.release(failed, background=self.background)
+            self._bulkhead = None
 
 
 class vCenterBase(VMwareCloud):
@@ -60,7 +272,8 @@ class vCenterBase(VMwareCloud):
                 host=vcenter.host,
                 port=int(vcenter.port),
                 user=vcenter.username,
-                pwd=vcenter.password
+                pwd=vcenter.password,
+                background=kwargs.get('background', False)
             )
 
     def get_container_view(self, container, object_type=None, recursive=True):
@@ -121,9 +334,19 @@ class vCenterBase(VMwareCloud):
         return view
 
     def get_container_view_by_id(self, container, object_type=None, id=None, recursive=True):
+        """Returns the managed object of id under container, None if not found
+
+        Recursive lookups under the root folder are answered from the
+        managed object index of the vCenter: the reference is built from the
+        moid without enumerating the inventory. Other lookups still go
+        through a container view since the index does not know containment.
+        """
         if self.si is None:
             return
 
+        if recursive and container == self.si.content.rootFolder:
+            return self._lookup_by_id(object_type, id)
+
         container = self.si.content.viewManager.CreateContainerView(
             container, object_type, recursive
         )
@@ -134,6 +357,46 @@ class vCenterBase(VMwareCloud):
             if (current == id):
                 return child
 
+    @property
+    def index(self):
+        """The managed object index of this vCenter"""
+        return get_index(self.session_key)
+
+    def _make_ref(self, type_name, moid):
+        return getattr(vim, type_name)(moid, self.si._stub)
+
+    def _lookup_by_id(self, object_type, moid):
+        index = self.index
+        type_name = index.get_type(moid)
+        if type_name is None:
+            self._reload_index(object_type)
+            type_name = index.get_type(moid)
+        if type_name is None or not is_instance_type(type_name, object_type):
+            return None
+        return self._make_ref(type_name, moid)
+
+    def _reload_index(self, object_type, force=False):
+        """Reloads the index for object_type with a single name collection
+
+        Reloads are rate limited per type by [vmware]index_refresh_interval
+        unless force is set.
+        """
+        object_type = list(object_type or [vim.ManagedEntity])
+        type_names = [motype._wsdlName for motype in object_type]
+        if not force and self.index.loaded_since(
+                type_names, CONF.vmware.index_refresh_interval):
+            return
+
+        props = [(motype, ['name']) for motype in object_type]
+        objects = []
+        for obj in self.iter_view_property(self.si.content.rootFolder, props):
+            name = None
+            for prop in obj.propSet:
+                if prop.name == 'name':
+                    name = prop.val
+            objects.append((obj.obj._moId, obj.obj._wsdlName, name))
+        self.index.load(type_names, objects)
+
     def create_filter_spec(self, objs, props):
         """Returns the filterSpec
 
@@ -142,7 +405,8 @@ class vCenterBase(VMwareCloud):
         """
         objSpecs = []
         propSpecs = []
-        traversal = build_full_traversal()
+        # only walk the parts of the inventory leading to the queried types
+        traversal = build_traversal([motype for motype, _props in props])
         for obj in objs:
             objSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=obj,
                                                                selectSet=traversal)
@@ -159,6 +423,24 @@ class vCenterBase(VMwareCloud):
                                                               propSet=propSpecs)
         return filterSpec
 
+    def create_view_filter_spec(self, view, props):
+        """Returns the filterSpec collecting props of the objects of a view
+
+        A single ObjectSpec on the ContainerView itself, skipped, with a
+        traversal through its 'view' property, whatever the number of
+        objects in the view.
+
+        :param view: the ContainerView at which the filter begins
+        :param props: the properties need to be query
+        """
+        objSpec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view, skip=True, selectSet=build_view_traversal())
+        propSpecs = [vmodl.query.PropertyCollector.PropertySpec(
+            all=False, type=motype, pathSet=proplist)
+            for motype, proplist in props]
+        return vmodl.query.PropertyCollector.FilterSpec(objectSet=[objSpec],
+                                                        propSet=propSpecs)
+
     def collect_object_property(self, objs, props, maxObjects=None):
         """ Retrieve properties of objs using PropertyCollector managed object
 
@@ -170,34 +452,92 @@ class vCenterBase(VMwareCloud):
         if self.si is None:
             return
 
-        pc = self.si.content.propertyCollector
+        return list(self.iter_object_property(objs, props, maxObjects))
+
+    def iter_object_property(self, objs, props, maxObjects=None, pages=False,
+                             raw=False):
+        """ Yield properties of objs page by page as they are retrieved
+
+        Follows the ContinueRetrievePropertiesEx tokens iteratively, so only
+        one page of ObjectContent is held at a time whatever the size of
+        the inventory. A retrieval abandoned before its last page is
+        cancelled on the server.
+
+        :param objs: The objects will be query
+        :param props: The properties of objects need to be query
+        :param maxObjects: The maximum number of ObjectContent data objects in
+        a single page, defaults to [vmware]collector_max_objects
+        :param pages: yield each page as a list instead of each ObjectContent
+        :param raw: decode the responses with RawPropertyCollector and yield
+        (managed object, {path: primitive}) pairs instead of ObjectContent
+        """
+        if self.si is None:
+            return
+
         filterSpec = self.create_filter_spec(objs, props)
+        for item in self._retrieve(filterSpec, maxObjects, pages, raw):
+            yield item
+
+    def iter_view_property(self, container, props, object_type=None,
+                           recursive=True, maxObjects=None, pages=False,
+                           raw=False):
+        """ Yield properties of the objects under container page by page
+
+        The objects are not enumerated client-side: a ContainerView of
+        container is created and a single filter rooted at the view
+        collects props of every object in it, so a whole-inventory fetch
+        is one small request instead of one ObjectSpec per object plus a
+        separate view enumeration.
+
+        :param container: the Folder, Datacenter, ComputeResource,
+        ResourcePool or HostSystem to look under
+        :param props: The properties of objects need to be query
+        :param object_type: the types of the view, defaults to the types
+        of props
+        :param recursive: see get_container_view
+        :param maxObjects: see iter_object_property
+        :param pages: see iter_object_property
+        :param raw: see iter_object_property
+        """
+        if self.si is None:
+            return
+
+        if not object_type:
+            object_type = [motype for motype, _props in props]
+        view = self.si.content.viewManager.CreateContainerView(
+            container, object_type, recursive)
+        try:
+            filterSpec = self.create_view_filter_spec(view, props)
+            for item in self._retrieve(filterSpec, maxObjects, pages, raw):
+                yield item
+        finally:
+            view.Destroy()
+
+    def _retrieve(self, filterSpec, maxObjects=None, pages=False, raw=False):
+        if raw:
+            pc = RawPropertyCollector(self.si)
+        else:
+            pc = self.si.content.propertyCollector
         options = vmodl.query.PropertyCollector.RetrieveOptions(
-            maxObjects=maxObjects)
+            maxObjects=maxObjects or CONF.vmware.collector_max_objects or None)
         result = pc.RetrievePropertiesEx([filterSpec], options)
 
-        # because the maximum number of objects retrieved by RetrievePropertiesEx and
-        # ContinueRetrievePropertiesEx is limit to 100, so, we need to continue retrieve
-        # properties using token
-        def _continue(token=None):
-            _result = pc.ContinueRetrievePropertiesEx(token)
-            _token = _result.token
-            _objects = _result.objects
-            if _token is not None:
-                _objects_ex = _continue(_token)
-                _objects.extend(_objects_ex)
-            return _objects
-
-        if result is None:
-            return {}
-
-        token = result.token
-        objects = result.objects
-        if token is not None:
-            _objects = _continue(token)
-            objects.extend(_objects)
-
-        return objects
+        token = None
+        try:
+            while result is not None:
+                token = result.token
+                if pages:
+                    yield result.objects
+                else:
+                    for obj in result.objects:
+                        yield obj
+                if token is None:
+                    break
+                result = pc.ContinueRetrievePropertiesEx(token)
+                token = None
+        finally:
+            if token is not None:
+                pc.CancelRetrievePropertiesEx(token)
 
     def get_obj(self, content, vimtype, name):
         """
@@ -205,53 +545,75 @@ class vCenterBase(VMwareCloud):
         :param vimtype:
         :param name:
         :return:
-        Get the vsphere object associated with a given text name
+        Get the vsphere object associated with a given text name, looked up
+        in the managed object index of the vCenter
         """
-        obj = None
         if self.si is None:
             return
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder, vimtype, True)
-        for c in container.view:
-            if c.name == name:
-                obj = c
-                break
-        return obj
+
+        index = self.index
+        moid, type_name = index.find(vimtype, name)
+        if moid is None:
+            self._reload_index(vimtype)
+            moid, type_name = index.find(vimtype, name)
+        if moid is None:
+            return None
+        return self._make_ref(type_name, moid)
 
     def wait_for_task(self, task, actionName='job', hideResult=False):
         """Waits and provides updates on a vSphere task
+
+        The task is followed by the task watcher of the vCenter, which
+        multiplexes all the tasks in flight on a single long poll.
         :param task:
         :param actionName:
         :param hideResult:
-        :return:
+        :return: the result of the task, None if it failed
         """
+        try:
+            result = self.watch_task(task).wait()
+        except vmodl.MethodFault as e:
+            LOG.error('%s did not complete successfully: %s',
+                      actionName, e.msg or e)
+            return None
+
+        if result is not None and not hideResult:
+            LOG.info('%s completed successfully, result: %s',
+                     actionName, result)
+        else:
+            LOG.info('%s completed successfully.', actionName)
+        return result
 
-        while task.info.state not in [vim.TaskInfo.State.success,
-                                      vim.TaskInfo.State.error]:
-            time.sleep(2)
+    def watch_task(self, task):
+        """Returns a TaskFuture resolved when task completes"""
+        kwargs = dict(self.kwargs)
 
-        if task.info.state == vim.TaskInfo.State.success:
-            if task.info.result is not None and not hideResult:
-                out = '%s completed successfully, result: %s' % (
-                    actionName, task.info.result)
-                print(out)
-            else:
-                out = '%s completed successfully.' % actionName
-                print(out)
+        def connect():
+            vc = vCenterBase(*self.args, background=True, **kwargs)
+            vc.connect()
+            return vc
 
-        else:
-            out = '%s did not complete successfully: %s' % (
-                actionName, task.info.error)
-            print(out)
+        return get_task_watcher(self.session_key, connect).watch(task)
 
-        return task.info.result
+
+def _is_session_error(exc):
+    """Whether exc means the session it was raised on is no longer usable
+
+    A call interrupted by an eventlet.Timeout may leave a response in
+    flight on the connections of the session, so it is not reused either.
+    """
+    return isinstance(exc, (vim.fault.NotAuthenticated,
+                            vmodl.fault.SecurityError,
+                            IOError,
+                            eventlet.Timeout))
 
 
 class vCenterSmartConnect(vCenterBase):
     """Smart connect to vcenter
 
     reutrn a vcenter instance, instance contains some useful common method.
-    the connection to vcenter will be destroied automate after operation.
+    the session is given back to the session pool automate after operation,
+    or dropped when the operation failed with an authentication error.
 
     useage:
         smart_connect_to_vcenter = vCenterSmartConnect(vcenter)
@@ -265,45 +627,142 @@ class vCenterSmartConnect(vCenterBase):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.disconnect()
+        self.disconnect(discard=_is_session_error(exc_val),
+                        failed=is_unavailable_error(exc_val))
 
 
 class vCenterPropertyCollector(vCenterBase):
     """collect designation properties of vcenter object
 
     using Managed-object 'ProertyCollector' to retrieve properties
+
+    useage:
+        with vCenterPropertyCollector(vcenter, [], properties) as result:
+            for key, value in result.items():
+                ...
+
+        # with stream=True the (key, value) pairs are yielded page by page,
+        # so the result never has to fit in memory at once
+        with vCenterPropertyCollector(vcenter, [], properties,
+                                      stream=True) as result:
+            for key, value in result:
+                ...
+
+    By default the properties are collected through a single filter rooted
+    at a ContainerView of the inventory, use_view=False collects them from
+    one ObjectSpec per object of the view instead.
+
+    fast=True decodes the responses straight into python primitives with
+    RawPropertyCollector: the result has the same shape, but the values are
+    dicts, lists, moids and scalars instead of pyVmomi objects, which is
+    much cheaper for large read-only collections.
+
+    compact=True implies fast=True and returns a RecordSet: moid -> slotted
+    record of primitives, the most compact form for big inventories.
+
+    columns, the fields as passed to plan_propspec, implies fast=True and
+    turns the objects into ColumnBatch of those fields: the stream yields
+    (type name, ColumnBatch) pairs page by page, the result maps every type
+    name to one ColumnBatch, ready for vectorized reductions.
     """
 
-    def __init__(self, vcenter, object_type, properties):
+    def __init__(self, vcenter, object_type, properties, stream=False,
+                 max_objects=None, use_view=True, fast=False,
+                 compact=False, columns=None):
         super(vCenterPropertyCollector, self).__init__(vcenter)
         self._object_type = object_type
         self._properties = properties
+        self._stream = stream
+        self._max_objects = max_objects
+        self._use_view = use_view
+        self._fast = fast or compact or columns is not None
+        self._compact = compact
+        self._columns = columns
 
     def __enter__(self):
         self.connect()
-        result = self._collect(self._object_type, self._properties)
+        if self._stream:
+            if self._columns is not None:
+                return self._iter_batches(self._object_type,
+                                          self._properties)
+            return self._iter_collect(self._object_type, self._properties)
+        try:
+            result = self._collect(self._object_type, self._properties)
+        except Exception as e:
+            # __exit__ is not called when __enter__ raises
+            self.disconnect(discard=_is_session_error(e),
+                            failed=is_unavailable_error(e))
+            raise
         return result
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.disconnect()
+        self.disconnect(discard=_is_session_error(exc_val),
+                        failed=is_unavailable_error(exc_val))
 
     def _collect(self, object_type, properties):
+        if self._columns is not None:
+            batches = collections.defaultdict(list)
+            result = {}
+            for key, value in self._iter_batches(object_type, properties):
+                if key == 'content':
+                    result[key] = value
+                else:
+                    batches[key].append(value)
+            for type_name, type_batches in batches.items():
+                result[type_name] = ColumnBatch.concat(type_batches)
+            return result
+
+        if not self._compact:
+            return dict(self._iter_collect(object_type, properties))
+
+        result = RecordSet(properties)
+        pairs = self._iter_collect(object_type, properties)
+        # the service content comes first, the other keys are managed
+        # objects which can not be compared with a string
+        for key, value in pairs:
+            result[key] = value
+            break
+        for key, value in pairs:
+            result.add(key._wsdlName, key._moId, value)
+        return result
+
+    def _iter_batches(self, object_type, properties):
+        pairs = self._iter_collect(object_type, properties)
+        # the service content comes first
+        for key, value in pairs:
+            yield key, value
+            break
+
+        objects = ((key._wsdlName, key._moId, value) for key, value in pairs)
+        batch_size = (self._max_objects or
+                      CONF.vmware.collector_max_objects or 1000)
+        for batch in iter_column_batches(objects, self._columns, batch_size):
+            yield batch.type_name, batch
+
+    def _iter_collect(self, object_type, properties):
         si = self.si
         if si is None:
-            return {}
+            return
 
-        result = dict(content=si.content)
+        yield 'content', si.content
         container = si.content.rootFolder
-        objs = self.get_container_view(container, object_type)
         props = parse_propspec(properties)
-        try:
-            objects = self.collect_object_property(objs, props)
-        except vmodl.query.InvalidProperty:
-            raise
+        if self._use_view:
+            objects = self.iter_view_property(container, props, object_type,
+                                              maxObjects=self._max_objects,
+                                              raw=self._fast)
+        else:
+            objs = self.get_container_view(container, object_type)
+            objects = self.iter_object_property(objs, props,
+                                                self._max_objects,
+                                                raw=self._fast)
+        if self._fast:
+            for item in objects:
+                yield item
+            return
+
         for obj in objects:
-            key = obj.obj
             value = dict()
             for prop in obj.propSet:
-                value.update({prop.name: prop.val})
-            result.update({key: value})
-        return result
+                value[prop.name] = prop.val
+            yield obj.obj, value
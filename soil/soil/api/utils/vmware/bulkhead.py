@@ -0,0 +1,182 @@
+# Copyright 2020 Soil, Inc.
+
+import threading
+import time
+
+import eventlet
+from eventlet import semaphore
+from oslo_log import log as logging
+from six.moves import http_client
+
+import soil.conf
+from soil.api.utils.vmware.exception import vCenterUnavailable
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def is_unavailable_error(exc):
+    """Whether exc means the vCenter did not answer, or too late
+
+    Faults returned by the vCenter prove it answers and do not count.
+    """
+    return isinstance(exc, (IOError, http_client.HTTPException,
+                            eventlet.Timeout))
+
+
+class vCenterBulkhead(object):
+    """Bounds the calls in flight to one vCenter and cuts off a failing one
+
+    At most [vmware]bulkhead_max_in_flight connections of a process use
+    the vCenter at a time; the others wait for a free slot at most
+    [vmware]bulkhead_queue_timeout seconds, so greenthreads can not pile
+    up behind a slow vCenter. Long-lived background connections have
+    their own [vmware]bulkhead_max_background slots, a wait in vain for
+    one of them does not count as a failure. After
+    [vmware]breaker_failure_threshold
+    consecutive calls failed, timed out or waited for a slot in vain, the
+    breaker opens and connections are refused right away. After
+    [vmware]breaker_reset_timeout seconds it is half open: one probe call
+    is let through, every breaker_reset_timeout seconds while none
+    completes, and the first call which completes closes the breaker or
+    opens it again. The state is the one of the calls of this process.
+
+    useage:
+        bulkhead = get_bulkhead(('vc1.example.com', 443))
+        bulkhead.acquire()
+        try:
+            ...
+        except Exception as e:
+            bulkhead.release(failed=is_unavailable_error(e))
+            raise
+        else:
+            bulkhead.release()
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.background = 0
+        self._probed_at = None
+        self._semaphore = semaphore.Semaphore(
+            CONF.vmware.bulkhead_max_in_flight)
+        self._background = semaphore.Semaphore(
+            CONF.vmware.bulkhead_max_background)
+
+    def status(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened_at': self.opened_at,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'background': self.background,
+        }
+
+    def acquire(self, background=False):
+        """Takes a slot, raises vCenterUnavailable when none is given
+
+        :param background: take a slot of the long-lived connections
+        """
+        self._admit()
+        if background:
+            acquired = self._background.acquire(
+                timeout=CONF.vmware.bulkhead_queue_timeout)
+        else:
+            self.waiting += 1
+            try:
+                acquired = self._semaphore.acquire(
+                    timeout=CONF.vmware.bulkhead_queue_timeout)
+            finally:
+                self.waiting -= 1
+        if not acquired:
+            # background slots are held long, running out of them says
+            # nothing about the vCenter
+            if not background:
+                self._record(failed=True)
+            raise vCenterUnavailable(
+                "vCenter %s is busy, no connection slot was freed within "
+                "%s seconds" % (self.host, CONF.vmware.bulkhead_queue_timeout))
+        if background:
+            self.background += 1
+        else:
+            self.in_flight += 1
+
+    def release(self, failed=False, background=False):
+        """Gives the slot back and records the outcome of the call"""
+        if background:
+            self.background -= 1
+            self._background.release()
+        else:
+            self.in_flight -= 1
+            self._semaphore.release()
+        self._record(failed)
+
+    def _admit(self):
+        if self.state == CLOSED:
+            return
+        now = time.time()
+        if self.state == OPEN:
+            if now - self.opened_at < CONF.vmware.breaker_reset_timeout:
+                raise vCenterUnavailable(
+                    "vCenter %s is unavailable, its circuit breaker is open "
+                    "after %d failures" % (self.host, self.failures))
+            LOG.info("Circuit breaker of vCenter %s is half open, probing",
+                     self.host)
+            self.state = HALF_OPEN
+        elif (self._probed_at is not None and
+                now - self._probed_at < CONF.vmware.breaker_reset_timeout):
+            raise vCenterUnavailable(
+                "vCenter %s is unavailable, its circuit breaker is probing "
+                "it" % self.host)
+        self._probed_at = now
+
+    def _record(self, failed):
+        if not failed:
+            if self.state == OPEN:
+                # a call let through before the breaker opened
+                return
+            if self.state != CLOSED:
+                LOG.info("Circuit breaker of vCenter %s is closed",
+                         self.host)
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._probed_at = None
+            return
+
+        self.failures += 1
+        if (self.state == HALF_OPEN or
+                (self.state == CLOSED and
+                 self.failures >= CONF.vmware.breaker_failure_threshold)):
+            LOG.warning("Circuit breaker of vCenter %s is open after %d "
+                        "failures", self.host, self.failures)
+            self.state = OPEN
+            self.opened_at = time.time()
+            self._probed_at = None
+
+
+_BULKHEADS = {}
+_BULKHEADS_LOCK = threading.Lock()
+
+
+def get_bulkhead(key):
+    """Returns the bulkhead of the vCenter identified by key
+
+    :param key: the (host, port) tuple of the vCenter
+    """
+    with _BULKHEADS_LOCK:
+        bulkhead = _BULKHEADS.get(key)
+        if bulkhead is None:
+            bulkhead = _BULKHEADS[key] = vCenterBulkhead(key[0])
+        return bulkhead
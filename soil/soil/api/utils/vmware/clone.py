@@ -0,0 +1,303 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+import time
+
+import eventlet
+from eventlet import event
+from eventlet import queue
+from oslo_log import log as logging
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.exception import vCenterNotConnect
+from soil.db import api as db_api
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+_TEMPLATE_PROPERTIES = ['name', 'parent', 'runtime.host', 'datastore',
+                        'snapshot.currentSnapshot']
+
+
+class CloneError(Exception):
+    """The template or the placement of a clone pipeline is invalid"""
+
+
+class _Placement(object):
+    """Hands out (host, datastore) pairs with a free slot
+
+    A pair is usable when the host sees the datastore and neither of them
+    has reached its in-flight limit; among the usable pairs the least
+    loaded one is picked, so the clones spread over the hosts and
+    datastores as they complete.
+    """
+
+    def __init__(self, pools):
+        """:param pools: (host, datastore) -> resource pool of the host"""
+        self.pools = pools
+        self._host_load = collections.Counter()
+        self._datastore_load = collections.Counter()
+        self._released = event.Event()
+
+    def acquire(self):
+        while True:
+            pair = self._pick()
+            if pair is not None:
+                host, datastore = pair
+                self._host_load[host] += 1
+                self._datastore_load[datastore] += 1
+                return pair
+            self._released.wait()
+
+    def release(self, pair):
+        host, datastore = pair
+        self._host_load[host] -= 1
+        self._datastore_load[datastore] -= 1
+        released, self._released = self._released, event.Event()
+        released.send()
+
+    def _pick(self):
+        best = None
+        best_load = None
+        for host, datastore in self.pools:
+            host_load = self._host_load[host]
+            datastore_load = self._datastore_load[datastore]
+            if (host_load >= CONF.vmware.clone_max_in_flight_per_host or
+                    datastore_load >=
+                    CONF.vmware.clone_max_in_flight_per_datastore):
+                continue
+            load = (datastore_load, host_load)
+            if best is None or load < best_load:
+                best, best_load = (host, datastore), load
+        return best
+
+
+class ClonePipeline(object):
+    """Deploys many virtual machines from one template of a vCenter
+
+    The clones are submitted by [vmware]clone_max_in_flight workers, each
+    one on the least loaded (host, datastore) pair having a free slot
+    under [vmware]clone_max_in_flight_per_host and
+    clone_max_in_flight_per_datastore, so a new clone starts as soon as
+    one completes. The clone tasks are followed by the task watcher of the
+    vCenter. A template with a snapshot is cloned as linked clones of its
+    current snapshot unless linked is False. run() yields the outcome of
+    every clone as soon as it is known, and every outcome is recorded in
+    the vcenter_log table.
+
+    useage:
+        pipeline = ClonePipeline(vcenter, 'vm-42', ['web-1', 'web-2'],
+                                 hosts=['host-10', 'esx11.example.com'],
+                                 datastores=['datastore-20'],
+                                 customization='linux-dhcp')
+        for result in pipeline.run():
+            ...
+    """
+
+    def __init__(self, vcenter, template, names, hosts=None,
+                 datastores=None, folder=None, customization=None,
+                 linked=None, power_on=False, operator=None):
+        self.vcenter = vcenter
+        self.template = template
+        # keep the order, drop the duplicates
+        self.names = list(collections.OrderedDict.fromkeys(names))
+        self.hosts = list(hosts or [])
+        self.datastores = list(datastores or [])
+        self.folder = folder
+        self.customization = customization
+        self.linked = linked
+        self.power_on = power_on
+        self.operator = operator
+
+    def run(self):
+        """Yields one result dict per clone, then a summary"""
+        counts = collections.Counter()
+        with vCenterSmartConnect(self.vcenter) as vc:
+            if vc.si is None:
+                raise vCenterNotConnect()
+
+            template = self._template(vc)
+            snapshot = template.get('snapshot.currentSnapshot')
+            linked = bool(snapshot) and self.linked is not False
+            if self.linked and not snapshot:
+                raise CloneError("Template %s has no snapshot to link "
+                                 "clones to." % self.template)
+            placement = _Placement(self._pairs(vc, template))
+            folder = vc._make_ref('Folder', self.folder or
+                                  template.get('parent'))
+            customization = self._customization(vc)
+
+            names = queue.LightQueue()
+            for name in self.names:
+                names.put(name)
+            results = queue.LightQueue()
+            workers = min(CONF.vmware.clone_max_in_flight, len(self.names))
+            pool = eventlet.GreenPool(max(workers, 1))
+            for _i in range(workers):
+                pool.spawn_n(self._worker, vc, names, results, placement,
+                             folder, customization,
+                             snapshot if linked else None)
+            try:
+                for _i in range(len(self.names)):
+                    result = results.get()
+                    counts[result['status']] += 1
+                    yield result
+            finally:
+                # when the client went away, start no more clones and wait
+                # for those in flight before the session is given back
+                while not names.empty():
+                    names.get_nowait()
+                pool.waitall()
+
+        yield {'done': True, 'template': self.template, 'linked': linked,
+               'success': counts['success'], 'error': counts['error']}
+
+    def _template(self, vc):
+        ref = vim.VirtualMachine(self.template, vc.si._stub)
+        try:
+            for _moref, props in vc.iter_object_property(
+                    [ref], [(vim.VirtualMachine, _TEMPLATE_PROPERTIES)],
+                    raw=True):
+                return props
+        except vmodl.fault.ManagedObjectNotFound:
+            pass
+        raise CloneError("Template %s could not be found." % self.template)
+
+    @staticmethod
+    def _resolve(vc, motype, label, values):
+        """Returns the moids of values, each one a moid or a name"""
+        moids = []
+        for value in values:
+            if vc._lookup_by_id([motype], value) is None:
+                ref = vc.get_obj(None, [motype], value)
+                if ref is None:
+                    raise CloneError("%s %s could not be found." %
+                                     (label, value))
+                value = ref._moId
+            moids.append(value)
+        return moids
+
+    def _pairs(self, vc, template):
+        """Returns the usable placements, (host, datastore) -> pool"""
+        hosts = (self._resolve(vc, vim.HostSystem, 'Host', self.hosts) or
+                 [template.get('runtime.host')])
+        hosts = [host for host in hosts if host]
+        if not hosts:
+            raise CloneError("No host to place the clones on.")
+
+        host_props = {}
+        refs = [vim.HostSystem(host, vc.si._stub) for host in hosts]
+        try:
+            for moref, props in vc.iter_object_property(
+                    refs, [(vim.HostSystem, ['parent', 'datastore'])],
+                    raw=True):
+                host_props[moref._moId] = props
+        except vmodl.fault.ManagedObjectNotFound as e:
+            raise CloneError("Host %s could not be found." % e.obj._moId)
+
+        # the parent of a host may be a cluster, the index knows its type
+        computes = set(props.get('parent') for props in host_props.values())
+        refs = [vc._lookup_by_id([vim.ComputeResource], moid)
+                for moid in computes if moid]
+        refs = [ref for ref in refs if ref is not None]
+        resource_pools = {}
+        if refs:
+            for moref, props in vc.iter_object_property(
+                    refs, [(vim.ComputeResource, ['resourcePool'])],
+                    raw=True):
+                resource_pools[moref._moId] = props.get('resourcePool')
+
+        datastores = (self._resolve(vc, vim.Datastore, 'Datastore',
+                                    self.datastores) or
+                      template.get('datastore') or [])
+        pools = collections.OrderedDict()
+        for host in hosts:
+            props = host_props.get(host, {})
+            pool = resource_pools.get(props.get('parent'))
+            if pool is None:
+                continue
+            mounted = set(props.get('datastore') or [])
+            for datastore in datastores:
+                if datastore in mounted:
+                    pools[(host, datastore)] = pool
+        if not pools:
+            raise CloneError("None of the hosts sees any of the datastores.")
+        return pools
+
+    def _customization(self, vc):
+        if not self.customization:
+            return None
+        manager = vc.si.content.customizationSpecManager
+        try:
+            return manager.GetCustomizationSpec(self.customization).spec
+        except vim.fault.NotFound:
+            raise CloneError("Customization specification %s could not be "
+                             "found." % self.customization)
+
+    def _worker(self, vc, names, results, placement, folder, customization,
+                snapshot):
+        while True:
+            try:
+                name = names.get_nowait()
+            except queue.Empty:
+                return
+            pair = placement.acquire()
+            try:
+                result = self._clone(vc, name, pair, placement.pools[pair],
+                                     folder, customization, snapshot)
+            finally:
+                placement.release(pair)
+            self._log(result)
+            results.put(result)
+
+    def _clone(self, vc, name, pair, pool, folder, customization, snapshot):
+        started = time.time()
+        host, datastore = pair
+        result = {'name': name, 'host': host, 'datastore': datastore,
+                  'linked': snapshot is not None}
+        try:
+            relocate = vim.vm.RelocateSpec(
+                host=vc._make_ref('HostSystem', host),
+                datastore=vc._make_ref('Datastore', datastore),
+                pool=vc._make_ref('ResourcePool', pool))
+            spec = vim.vm.CloneSpec(location=relocate, template=False,
+                                    powerOn=self.power_on,
+                                    customization=customization)
+            if snapshot is not None:
+                relocate.diskMoveType = 'createNewChildDiskBacking'
+                spec.snapshot = vc._make_ref('VirtualMachineSnapshot',
+                                             snapshot)
+            template = vim.VirtualMachine(self.template, vc.si._stub)
+            task = template.CloneVM_Task(folder=folder, name=name, spec=spec)
+            vm = vc.watch_task(task).wait()
+            result.update(status='success',
+                          vm=getattr(vm, '_moId', None))
+        except vmodl.MethodFault as e:
+            result.update(status='error', error=e.msg or
+                          e.__class__.__name__)
+        except Exception as e:
+            LOG.exception("Clone %s of template %s failed", name,
+                          self.template)
+            result.update(status='error', error=str(e))
+        result['elapsed'] = round(time.time() - started, 3)
+        return result
+
+    def _log(self, result):
+        try:
+            db_api.vcenter_log_create(
+                name=self.vcenter.name,
+                vcenter_type=self.vcenter.vcenter_type,
+                hostname=self.vcenter.host,
+                action='clone',
+                status=result['status'],
+                resource=result['name'],
+                res_type='VirtualMachine',
+                res_operator=self.operator,
+                res_op_action=self.template)
+        except Exception:
+            LOG.exception("Could not record the clone %s of template %s",
+                          result['name'], self.template)
@@ -0,0 +1,108 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+
+import numpy as np
+import six
+from pyVmomi import vim
+
+from soil.api.utils.vmware.common import get_field
+from soil.api.utils.vmware.index import is_instance_type
+
+
+class ColumnBatch(object):
+    """The fields of a batch of objects of one type, column by column
+
+    Integer and boolean fields are int64 arrays with unset values as 0,
+    float fields float64 arrays and any other field an object array, so
+    metrics are reduced with one vectorized operation per batch.
+    """
+
+    __slots__ = ('type_name', 'moids', 'columns')
+
+    def __init__(self, type_name, moids, columns):
+        self.type_name = type_name
+        self.moids = moids
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.moids)
+
+    @classmethod
+    def concat(cls, batches):
+        """Returns one batch holding the rows of batches, all of one type"""
+        batches = list(batches)
+        first = batches[0]
+        if len(batches) == 1:
+            return first
+        moids = np.concatenate([batch.moids for batch in batches])
+        columns = dict(
+            (field, np.concatenate([batch.columns[field]
+                                    for batch in batches]))
+            for field in first.columns)
+        return cls(first.type_name, moids, columns)
+
+
+def _object_column(values):
+    column = np.empty(len(values), dtype=object)
+    # assigned one by one, numpy would broadcast list values otherwise
+    for i, value in enumerate(values):
+        column[i] = value
+    return column
+
+
+def to_column(values):
+    """Returns the numpy column best holding values"""
+    if all(value is None or isinstance(value, six.integer_types)
+           for value in values):
+        return np.fromiter((value or 0 for value in values), np.int64,
+                           len(values))
+    if all(value is None or isinstance(value, six.integer_types + (float,))
+           for value in values):
+        return np.fromiter((value or 0.0 for value in values), np.float64,
+                           len(values))
+    return _object_column(values)
+
+
+def _fields_of(type_name, fields):
+    """Returns the fields declared for type_name or any of its supertypes"""
+    result = []
+    for declared, declared_fields in fields.items():
+        if is_instance_type(type_name, [getattr(vim, declared)]):
+            result.extend(field for field in declared_fields
+                          if field not in result)
+    return result
+
+
+def _make_batch(type_name, names, rows):
+    moids = _object_column([moid for moid, _values in rows])
+    columns = dict((name, to_column([values[i] for _moid, values in rows]))
+                   for i, name in enumerate(names))
+    return ColumnBatch(type_name, moids, columns)
+
+
+def iter_column_batches(objects, fields, batch_size=1000):
+    """Yields the fields of objects as ColumnBatch, per type
+
+    :param objects: iterable of (type name, moid, properties) where the
+        properties are readable with get_field, e.g. a collector page
+    :param fields: managed object type name -> fields, as passed to
+        plan_propspec; objects of subtypes get the fields of their
+        supertypes
+    :param batch_size: the maximum number of rows of a batch
+    """
+    rows = collections.defaultdict(list)
+    type_fields = {}
+    for type_name, moid, props in objects:
+        names = type_fields.get(type_name)
+        if names is None:
+            names = type_fields[type_name] = _fields_of(type_name, fields)
+        pending = rows[type_name]
+        pending.append((moid, [get_field(props, name) for name in names]))
+        if len(pending) >= batch_size:
+            yield _make_batch(type_name, names, pending)
+            rows[type_name] = []
+
+    for type_name, pending in rows.items():
+        if pending:
+            yield _make_batch(type_name, type_fields[type_name], pending)
@@ -1,9 +1,162 @@
+# Copyright 2020 Soil, Inc.
+import datetime
+
 import six
 from pyVmomi import vim
+from pyVmomi import VmomiSupport
+from six.moves import intern
 
 from soil.api.utils.vmware.exception import vCenterPropertyNotExist
+from soil.api.utils.vmware.exception import vCenterPropertyPathInvalid
 
 
 def sizeof_fmt(num):
-    """Returns the h 
     """
+    Returns the human readable version if a file size
+    Unified conversion of units to GB
+    """
+    if isinstance(num, (six.integer_types, float)):
+        convert_to_GB = 1024.0 * 1024.0 * 1024.0
+        num /= convert_to_GB
+        return "%3.1f%s" % (num, 'GB')
+
+
+def parse_propspec(propspec):
+    """Parses property specifications
+
+    :param propspec: the property specifications need to be parses,
+        '{'VirtualMachine': ['name']}' for example
+    :return: a sequence of 2-tuples. each containing a managed object type
+    and a list of properties applicable to that type
+
+    useage:
+        propspec = {
+            'VirtualMachine': ['name'],
+            'Datastore': ['name']
+        }
+        properties = parse_propspec(propspec)
+    """
+    props = []
+    for objtype, objprops in propspec.items():
+        motype = getattr(vim, objtype, None)
+        if motype is None:
+            raise vCenterPropertyNotExist(objtype)
+        props.append((motype, objprops))
+    return props
+
+
+def _plan_path(motype, field):
+    """Returns the longest valid pathSet entry which contains field"""
+    current = motype
+    path = []
+    for name in field.replace('[]', '').split('.'):
+        try:
+            info = current._GetPropertyInfo(name)
+        except AttributeError:
+            raise vCenterPropertyPathInvalid(motype._wsdlName, field)
+        path.append(name)
+        # a pathSet can not reach into arrays, references or primitives
+        if (issubclass(info.type, list) or
+                not issubclass(info.type, VmomiSupport.DataObject)):
+            break
+        current = info.type
+    return '.'.join(path)
+
+
+def plan_propspec(fields):
+    """Plans the narrowest property specifications for the fields a view reads
+
+    :param fields: the fields read per managed object type. Array elements
+        are marked with '[]', '{'VirtualMachine': ['guest.net[].ipAddress']}'
+        for example
+    :return: property specifications for parse_propspec. Every field is
+    narrowed to the deepest valid property path containing it, and paths
+    contained in another planned path are dropped
+
+    useage:
+        fields = {
+            'VirtualMachine': ['guest.hostName', 'guest.net[].ipAddress'],
+        }
+        propspec = plan_propspec(fields)
+        # {'VirtualMachine': ['guest.hostName', 'guest.net']}
+    """
+    propspec = {}
+    for objtype, objfields in fields.items():
+        motype = getattr(vim, objtype, None)
+        if motype is None:
+            raise vCenterPropertyNotExist(objtype)
+        paths = set(_plan_path(motype, field) for field in objfields)
+        propspec[objtype] = sorted(
+            path for path in paths
+            if not any(path.startswith(other + '.') for other in paths))
+    return propspec
+
+
+def _get_attr(value, name):
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+
+def get_field(props, field, default=None):
+    """Reads a field planned by plan_propspec out of collected properties
+
+    Works on pyVmomi values as well as on their primitive form. Fields
+    going through arrays return the flat list of the values found.
+
+    :param props: dict of property path -> value of one object
+    :param field: the field as declared to plan_propspec
+    """
+    names = field.replace('[]', '').split('.')
+    for i in range(len(names), 0, -1):
+        path = '.'.join(names[:i])
+        if path in props:
+            values = [props[path]]
+            break
+    else:
+        return default
+
+    for name in names[i:]:
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(_get_attr(item, name) for item in value)
+            else:
+                found.append(_get_attr(value, name))
+        values = [value for value in found if value is not None]
+
+    if '[]' in field:
+        flat = []
+        for value in values:
+            flat.extend(value if isinstance(value, list) else [value])
+        return flat
+    if not values:
+        return default
+    return values[0]
+
+
+def to_primitive(value):
+    """Converts a pyVmomi value into plain python primitives
+
+    Data objects become dicts, managed object references become their
+    moid and datetimes become ISO 8601 strings, so the result holds no
+    reference to the pyVmomi object graph and can be serialized as is.
+    """
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return intern(value._moId)
+    if isinstance(value, VmomiSupport.DataObject):
+        result = {}
+        for prop in value._GetPropertyList():
+            if prop.name in ('dynamicType', 'dynamicProperty'):
+                continue
+            val = getattr(value, prop.name, None)
+            if val is not None:
+                result[prop.name] = to_primitive(val)
+        return result
+    if isinstance(value, list):
+        return [to_primitive(val) for val in value]
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, type):
+        return getattr(value, '_wsdlName', value.__name__)
+    return value
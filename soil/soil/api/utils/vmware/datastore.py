@@ -0,0 +1,193 @@
+# Copyright 2020 Soil, Inc.
+
+import ssl
+
+from oslo_log import log as logging
+from six.moves import http_client
+from six.moves.urllib import parse as urlparse
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.bulkhead import is_unavailable_error
+from soil.api.utils.vmware.exception import vCenterNotConnect
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# headers of a datastore file response passed on to the client
+DOWNLOAD_HEADERS = ('Content-Length', 'Content-Range', 'Content-Type',
+                    'Accept-Ranges', 'ETag', 'Last-Modified')
+
+
+class DatastoreFile(object):
+    """A file of a datastore, through the /folder HTTP interface of vCenter
+
+    Requests are authenticated with the cookie of a pooled session of the
+    vCenter, no login is needed. The session stays checked out until the
+    transfer ends, so the pool can not log it out meanwhile. Bodies are
+    streamed both ways in [vmware]datastore_chunk_size chunks, so the memory
+    used by a transfer does not depend on the size of the file.
+
+    useage:
+        ds_file = DatastoreFile(vcenter, 'dc1', 'datastore1', 'iso/a.iso')
+        status, headers, chunks = ds_file.download('bytes=1024-')
+        for chunk in chunks:
+            ...
+    """
+
+    def __init__(self, vcenter, datacenter, datastore, path):
+        self.vcenter = vcenter
+        self.datacenter = datacenter
+        self.datastore = datastore
+        self.path = path.lstrip('/')
+
+    @property
+    def url(self):
+        query = urlparse.urlencode([('dcPath', self.datacenter),
+                                    ('dsName', self.datastore)])
+        return '/folder/%s?%s' % (urlparse.quote(self.path), query)
+
+    def download(self, range_header=None):
+        """Starts the download of the file
+
+        :param range_header: the Range header of the client, passed on to
+            resume or split a download
+        :return: the status, the headers of DOWNLOAD_HEADERS and an
+            iterator over the chunks of the body, which closes the
+            connection once exhausted or closed
+        """
+        headers = {}
+        if range_header:
+            headers['Range'] = range_header
+        vc = self._checkout()
+        conn = self._connect()
+        try:
+            conn.request('GET', self.url, headers=self._headers(vc, headers))
+            resp = conn.getresponse()
+        except Exception as e:
+            conn.close()
+            vc.disconnect(failed=is_unavailable_error(e))
+            raise
+
+        response_headers = [(name, resp.getheader(name))
+                            for name in DOWNLOAD_HEADERS
+                            if resp.getheader(name) is not None]
+        return resp.status, response_headers, _Chunks(vc, conn, resp)
+
+    def upload(self, body_file, length):
+        """Uploads length bytes read from body_file as the file
+
+        The file is overwritten if it exists.
+        :return: the status and the reason of the response of vCenter
+        """
+        chunk_size = CONF.vmware.datastore_chunk_size
+        vc = self._checkout()
+        conn = self._connect()
+        failed = False
+        try:
+            conn.putrequest('PUT', self.url, skip_accept_encoding=True)
+            headers = self._headers(vc, {
+                'Content-Type': 'application/octet-stream',
+                'Content-Length': str(length),
+            })
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.endheaders()
+
+            remaining = length
+            while remaining > 0:
+                chunk = self._read_body(body_file, min(chunk_size, remaining),
+                                        remaining)
+                conn.send(chunk)
+                remaining -= len(chunk)
+
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status, resp.reason
+        except _ClientBodyError:
+            raise
+        except Exception as e:
+            # only the errors of the vCenter connection count, not those of
+            # the body sent by the client
+            failed = is_unavailable_error(e)
+            raise
+        finally:
+            conn.close()
+            vc.disconnect(failed=failed)
+
+    def _read_body(self, body_file, size, remaining):
+        try:
+            chunk = body_file.read(size)
+        except Exception as e:
+            raise _ClientBodyError("Upload of %s failed reading the body: "
+                                   "%s" % (self.path, e))
+        if not chunk:
+            raise _ClientBodyError("Upload of %s ended %d bytes early" %
+                                   (self.path, remaining))
+        return chunk
+
+    def _checkout(self):
+        """Checks a pooled session out, the caller disconnects it"""
+        vc = vCenterSmartConnect(self.vcenter, background=True)
+        vc.connect()
+        if vc.si is None:
+            vc.disconnect()
+            raise vCenterNotConnect()
+        return vc
+
+    @staticmethod
+    def _headers(vc, headers):
+        # SmartConnect wraps the SOAP stub in a SessionOrientedStub
+        stub = getattr(vc.si._stub, 'soapStub', vc.si._stub)
+        headers['Cookie'] = stub.cookie
+        return headers
+
+    def _connect(self):
+        return http_client.HTTPSConnection(
+            self.vcenter.host, int(self.vcenter.port),
+            timeout=CONF.vmware.datastore_timeout,
+            context=ssl._create_unverified_context())
+
+
+class _ClientBodyError(IOError):
+    """The body of an upload could not be read from the client"""
+
+
+class _Chunks(object):
+    """Iterates over the body of a download in chunks
+
+    The connection is closed and the session it was authenticated with is
+    given back once the body is exhausted or close() is called, also when
+    the iteration never started, which a generator would not do.
+    """
+
+    def __init__(self, vc, conn, resp):
+        self._vc = vc
+        self._conn = conn
+        self._resp = resp
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._conn is None:
+            raise StopIteration()
+        try:
+            chunk = self._resp.read(CONF.vmware.datastore_chunk_size)
+        except Exception as e:
+            self.close(failed=is_unavailable_error(e))
+            raise
+        if not chunk:
+            self.close()
+            raise StopIteration()
+        return chunk
+
+    next = __next__
+
+    def close(self, failed=False):
+        if self._conn is None:
+            return
+        self._conn.close()
+        self._conn = self._resp = None
+        self._vc.disconnect(failed=failed)
@@ -0,0 +1,185 @@
+# Copyright 2020 Soil, Inc.
+
+import datetime
+
+import eventlet
+from oslo_log import log as logging
+from oslo_utils import timeutils
+from pyVmomi import vim
+from pyVmomi.Iso8601 import TZManager
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.exception import vCenterNotConnect
+from soil.db import api as db_api
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# event argument -> type of the resource it names, the first one set wins
+_EVENT_RESOURCES = (
+    ('vm', 'VirtualMachine'),
+    ('host', 'HostSystem'),
+    ('ds', 'Datastore'),
+    ('computeResource', 'ComputeResource'),
+    ('datacenter', 'Datacenter'),
+)
+
+# seconds to wait before reconnecting a failed collector
+_RETRY_INTERVAL = 10
+
+
+class _CursorMoved(Exception):
+    """Another collector copied events of the vcenter meanwhile"""
+
+
+def _truncate(value, length):
+    if value is None:
+        return None
+    return value[:length]
+
+
+class EventLogCollector(object):
+    """Copies the events of one vCenter into the vcenter_log table
+
+    An EventHistoryCollector is created from the cursor of the vCenter,
+    the latest event already copied, and read forward with ReadNextEvents,
+    [vmware]event_page_size events at a time. Each page is inserted in a
+    single transaction together with the new cursor, so a restart resumes
+    right after the last copied event instead of reading the whole event
+    history again. Without a cursor, copying starts
+    [vmware]event_backfill_seconds in the past.
+
+    useage:
+        collector = EventLogCollector(vcenter)
+        collector.start()
+    """
+
+    def __init__(self, vcenter):
+        self.vcenter = vcenter
+        self.uuid = vcenter.uuid
+        self.log_fields = {
+            'name': vcenter.name,
+            'vcenter_type': vcenter.vcenter_type,
+            'hostname': vcenter.host,
+        }
+        self.state = 'init'
+        self.error = None
+        self.last_key = None
+        self.last_created_at = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = eventlet.spawn(self._run)
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+
+    def status(self):
+        return {
+            'state': self.state,
+            'error': self.error,
+            'last_key': self.last_key,
+            'last_created_at': self.last_created_at,
+        }
+
+    # collector loop
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self._load_cursor()
+                with vCenterSmartConnect(self.vcenter, background=True) as vc:
+                    if vc.si is None:
+                        raise vCenterNotConnect()
+                    self._follow(vc)
+            except _CursorMoved:
+                LOG.info("Events of vCenter %s were copied by another "
+                         "collector, resuming from its cursor",
+                         self.log_fields['hostname'])
+            except Exception as e:
+                LOG.warning("Event collector of vCenter %s failed: %s",
+                            self.log_fields['hostname'], e)
+                self.state = 'error'
+                self.error = str(e) or e.__class__.__name__
+                eventlet.sleep(_RETRY_INTERVAL)
+
+    def _load_cursor(self):
+        cursor = db_api.vcenter_event_cursor_get(self.uuid)
+        if cursor is None or cursor.last_key is None:
+            self.last_key = None
+            self.last_created_at = None
+        else:
+            self.last_key = cursor.last_key
+            self.last_created_at = cursor.last_created_at
+
+    def _follow(self, vc):
+        begin = self.last_created_at
+        if begin is None:
+            begin = timeutils.utcnow() - datetime.timedelta(
+                seconds=CONF.vmware.event_backfill_seconds)
+        # createdTime is stored as naive UTC
+        begin = timeutils.normalize_time(begin).replace(
+            tzinfo=TZManager.GetTZInfo())
+        spec = vim.event.EventFilterSpec(
+            time=vim.event.EventFilterSpec.ByTime(beginTime=begin))
+        collector = vc.si.content.eventManager.CreateCollectorForEvents(spec)
+        try:
+            # from the oldest event of the filter on
+            collector.RewindCollector()
+            self.state = 'ready'
+            self.error = None
+            page_size = CONF.vmware.event_page_size
+            while not self._stopped:
+                events = collector.ReadNextEvents(page_size)
+                if events:
+                    self._copy(events)
+                if len(events or ()) < page_size:
+                    eventlet.sleep(CONF.vmware.event_interval)
+        finally:
+            try:
+                collector.DestroyCollector()
+            except Exception:
+                pass
+
+    def _copy(self, events):
+        # the begin time is inclusive, keys only grow
+        if self.last_key is not None:
+            events = [event for event in events if event.key > self.last_key]
+        if not events:
+            return
+        last = max(events, key=lambda event: event.key)
+        last_created_at = timeutils.normalize_time(last.createdTime)
+        logs = [self._log(event) for event in events]
+        if not db_api.vcenter_log_create_events(self.uuid, logs,
+                                                self.last_key, last.key,
+                                                last_created_at):
+            raise _CursorMoved()
+        self.last_key = last.key
+        self.last_created_at = last_created_at
+
+    def _log(self, event):
+        resource, res_type = None, None
+        for argument, type_name in _EVENT_RESOURCES:
+            value = getattr(event, argument, None)
+            if value is not None and value.name:
+                resource, res_type = value.name, type_name
+                break
+        event_type = getattr(event, 'eventTypeId', None) or event._wsdlName
+        log = dict(self.log_fields)
+        log.update(
+            action='event',
+            status=_truncate(getattr(event, 'severity', None) or 'info', 32),
+            resource=_truncate(resource, 64),
+            res_type=res_type,
+            res_operator=_truncate(event.userName, 64),
+            res_op_action=_truncate(event_type, 64),
+            res_op_at=timeutils.normalize_time(event.createdTime))
+        return log
@@ -8,6 +8,10 @@ class vCenterNotConnect(VMwareEx):
     pass
 
 
+class vCenterUnavailable(vCenterNotConnect):
+    """The bulkhead of the vCenter refused the connection"""
+
+
 class vCenterPropertyNotExist(VMwareEx):
     def __init__(self, object_type):
         self.message = ("referenced type %s in property specification "
@@ -17,3 +21,13 @@ class vCenterPropertyNotExist(VMwareEx):
 
     def __str__(self):
         return self.message
+
+
+class vCenterPropertyPathInvalid(VMwareEx):
+    def __init__(self, object_type, path):
+        self.message = ("property path %s does not exist on type %s, "
+                        "\nconsult the managed object type reference in the "
+                        "vSphere API documentation" % (path, object_type))
+
+    def __str__(self):
+        return self.message
@@ -0,0 +1,366 @@
+# Copyright 2020 Soil, Inc.
+
+import datetime
+import os
+import shutil
+import ssl
+import tarfile
+import time
+import uuid
+
+import eventlet
+from eventlet import tpool
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+from pyVmomi import vim
+from six.moves import http_client
+from six.moves.urllib import parse as urlparse
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.exception import vCenterNotConnect
+from soil.db import api as db_api
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('ovf', 'ova')
+
+# states of a job which will not change anymore
+DONE_STATES = ('success', 'error')
+
+# seconds between two reads of the state of a lease being initialized
+_LEASE_POLL_INTERVAL = 1
+
+
+class ExportError(Exception):
+    """The export lease of a virtual machine failed"""
+
+
+class ExportJob(object):
+    """Exports one virtual machine as OVF or OVA into a directory
+
+    An HttpNfcLease is acquired with ExportVm and the disks it offers are
+    downloaded at most [vmware]export_max_parallel_disks at a time, each
+    streamed to its file in [vmware]datastore_chunk_size chunks, while a
+    green thread keeps the lease alive with HttpNfcLeaseProgress every
+    [vmware]export_lease_update_interval seconds. The OVF descriptor is
+    then built by the OvfManager from the downloaded files, and with the
+    'ova' format the descriptor and the disks are packed into a single OVA
+    archive. status() reports the progress of the job while it runs, the
+    status is also written to the database on every change of state and
+    every [vmware]export_lease_update_interval seconds while the job runs,
+    for get_job_status() in any soil process. The directory of a failed job
+    is removed.
+
+    useage:
+        job = ExportJob(vcenter, 'vm-42', 'ova')
+        job.start()
+        job.status()
+    """
+
+    def __init__(self, vcenter, moid, fmt='ovf'):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("format must be one of %s" %
+                             ', '.join(EXPORT_FORMATS))
+        self.id = uuid.uuid4().hex
+        self.vcenter = vcenter
+        self.moid = moid
+        self.format = fmt
+        self.directory = os.path.join(CONF.vmware.export_dir, self.id)
+        self.state = 'queued'
+        self.error = None
+        self.name = None
+        self.files = []
+        self.total_bytes = 0
+        self.started_at = None
+        self.finished_at = None
+        self._done_bytes = {}
+        self._thread = None
+
+    @property
+    def done(self):
+        return self.state in DONE_STATES
+
+    @property
+    def progress(self):
+        """Percentage of the disks downloaded, an estimate while running
+
+        The size of the disks is their capacity, exported disks are stream
+        optimized and usually smaller.
+        """
+        if self.state == 'success':
+            return 100
+        if not self.total_bytes:
+            return 0
+        done = sum(self._done_bytes.values())
+        return min(int(100 * done / self.total_bytes), 99)
+
+    def status(self):
+        return {
+            'id': self.id,
+            'vcenter': self.vcenter.uuid,
+            'vm': self.moid,
+            'name': self.name,
+            'format': self.format,
+            'state': self.state,
+            'progress': self.progress,
+            'bytes': sum(self._done_bytes.values()),
+            'directory': self.directory,
+            'files': list(self.files),
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def _record(self):
+        status = self.status()
+        return {
+            'vcenter_uuid': status['vcenter'],
+            'moid': status['vm'],
+            'name': status['name'],
+            'format': status['format'],
+            'state': status['state'],
+            'progress': status['progress'],
+            'bytes': status['bytes'],
+            'directory': status['directory'],
+            'files': jsonutils.dumps(status['files']),
+            'error': status['error'],
+            'started_at': status['started_at'],
+            'finished_at': status['finished_at'],
+        }
+
+    def _save(self):
+        db_api.vcenter_export_job_update(self.id, **self._record())
+
+    def _set_state(self, state):
+        self.state = state
+        self._save()
+
+    def start(self):
+        if self._thread is None:
+            db_api.vcenter_export_job_create(self.id, **self._record())
+            self._thread = eventlet.spawn(self.run)
+
+    def run(self):
+        self.started_at = time.time()
+        heartbeat = eventlet.spawn(self._heartbeat)
+        try:
+            with vCenterSmartConnect(self.vcenter, background=True) as vc:
+                if vc.si is None:
+                    raise vCenterNotConnect()
+                self._export(vc)
+            self.state = 'success'
+        except Exception as e:
+            LOG.exception("Export of virtual machine %s failed", self.moid)
+            self.state = 'error'
+            self.error = str(e) or e.__class__.__name__
+            # partial disks may take gigabytes
+            tpool.execute(shutil.rmtree, self.directory, True)
+            self.files = []
+        finally:
+            heartbeat.kill()
+        self.finished_at = time.time()
+        try:
+            self._save()
+        except Exception:
+            LOG.exception("Could not save the status of export job %s",
+                          self.id)
+
+    def _export(self, vc):
+        vm = vc._make_ref('VirtualMachine', self.moid)
+        self.name = vm.name
+        # the name of the virtual machine names the exported files
+        filename = self.name.replace('/', '_').replace(os.sep, '_')
+        os.makedirs(self.directory)
+
+        self._set_state('initializing')
+        lease = vm.ExportVm()
+        try:
+            info = self._wait_ready(lease)
+            self.total_bytes = info.totalDiskCapacityInKB * 1024
+            self._set_state('downloading')
+            keepalive = eventlet.spawn(self._keep_alive, lease)
+            try:
+                ovf_files = self._download(vc, info)
+            finally:
+                keepalive.kill()
+            lease.HttpNfcLeaseProgress(100)
+            lease.HttpNfcLeaseComplete()
+        except Exception:
+            try:
+                lease.HttpNfcLeaseAbort()
+            except Exception:
+                pass
+            raise
+
+        self._set_state('packaging')
+        descriptor = self._descriptor(vc, vm, filename, ovf_files)
+        if self.format == 'ova':
+            # packing copies whole disks, out of the eventlet hub
+            tpool.execute(self._pack, filename, descriptor, ovf_files)
+
+    def _wait_ready(self, lease):
+        while True:
+            state = lease.state
+            if state == vim.HttpNfcLease.State.ready:
+                return lease.info
+            if state == vim.HttpNfcLease.State.error:
+                error = lease.error
+                raise ExportError(error.msg if error is not None else
+                                  "Export lease failed")
+            if state == vim.HttpNfcLease.State.done:
+                raise ExportError("Export lease completed unexpectedly")
+            eventlet.sleep(_LEASE_POLL_INTERVAL)
+
+    def _keep_alive(self, lease):
+        while True:
+            eventlet.sleep(CONF.vmware.export_lease_update_interval)
+            try:
+                lease.HttpNfcLeaseProgress(self.progress)
+            except Exception as e:
+                LOG.warning("Could not update the export lease of virtual "
+                            "machine %s: %s", self.moid, e)
+
+    def _heartbeat(self):
+        # the job is known alive while its status is updated, see
+        # fail_stale_jobs()
+        while True:
+            eventlet.sleep(CONF.vmware.export_lease_update_interval)
+            try:
+                self._save()
+            except Exception as e:
+                LOG.warning("Could not save the progress of export job %s: "
+                            "%s", self.id, e)
+
+    def _download(self, vc, info):
+        """Downloads the disks of the lease, returns their OvfFile"""
+        stub = getattr(vc.si._stub, 'soapStub', vc.si._stub)
+        cookie = stub.cookie
+        device_urls = [device_url for device_url in info.deviceUrl
+                       if device_url.disk]
+        pool = eventlet.GreenPool(CONF.vmware.export_max_parallel_disks)
+        threads = [pool.spawn(self._download_disk, device_url, cookie)
+                   for device_url in device_urls]
+        try:
+            return [thread.wait() for thread in threads]
+        except Exception:
+            # one failed disk fails the export, stop the others
+            for thread in threads:
+                thread.kill()
+            raise
+
+    def _download_disk(self, device_url, cookie):
+        # an ESXi host may answer as '*' when it does not know its name
+        url = urlparse.urlparse(device_url.url.replace(
+            '*', self.vcenter.host))
+        path = os.path.join(self.directory, device_url.targetId)
+        conn = http_client.HTTPSConnection(
+            url.hostname, url.port or 443,
+            timeout=CONF.vmware.datastore_timeout,
+            context=ssl._create_unverified_context())
+        chunk_size = CONF.vmware.datastore_chunk_size
+        size = 0
+        try:
+            target = url.path + ('?' + url.query if url.query else '')
+            conn.request('GET', target, headers={'Cookie': cookie})
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise ExportError("Download of disk %s failed: %s %s" %
+                                  (device_url.targetId, resp.status,
+                                   resp.reason))
+            with open(path, 'wb') as disk:
+                while True:
+                    chunk = resp.read(chunk_size)
+                    if not chunk:
+                        break
+                    disk.write(chunk)
+                    size += len(chunk)
+                    self._done_bytes[device_url.key] = size
+        finally:
+            conn.close()
+        self.files.append(path)
+        return vim.OvfManager.OvfFile(deviceId=device_url.key,
+                                      path=device_url.targetId, size=size)
+
+    def _descriptor(self, vc, vm, filename, ovf_files):
+        params = vim.OvfManager.CreateDescriptorParams(
+            name=self.name, ovfFiles=ovf_files)
+        result = vc.si.content.ovfManager.CreateDescriptor(obj=vm, cdp=params)
+        if result.error:
+            raise ExportError(result.error[0].msg or
+                              "Could not create the OVF descriptor")
+        path = os.path.join(self.directory, '%s.ovf' % filename)
+        with open(path, 'w') as descriptor:
+            descriptor.write(result.ovfDescriptor)
+        self.files.insert(0, path)
+        return path
+
+    def _pack(self, filename, descriptor, ovf_files):
+        """Packs the descriptor then the disks into an OVA archive"""
+        path = os.path.join(self.directory, '%s.ova' % filename)
+        members = [descriptor] + [os.path.join(self.directory, ovf_file.path)
+                                  for ovf_file in ovf_files]
+        # ustar headers, but with the GNU base-256 size of members of 8GiB
+        # or more, which plain ustar can not hold; no extra members like pax
+        with tarfile.open(path, 'w', format=tarfile.GNU_FORMAT) as ova:
+            for member in members:
+                ova.add(member, arcname=os.path.basename(member))
+        for member in members:
+            os.remove(member)
+        self.files = [path]
+
+
+def get_job_status(job_id):
+    """Returns the status of an export job, None if it is unknown
+
+    The status is read from the database, the job may run in another
+    process.
+    """
+    record = db_api.vcenter_export_job_get(job_id)
+    if record is None:
+        return None
+    return {
+        'id': record.job_id,
+        'vcenter': record.vcenter_uuid,
+        'vm': record.moid,
+        'name': record.name,
+        'format': record.format,
+        'state': record.state,
+        'progress': record.progress,
+        'bytes': record.bytes,
+        'directory': record.directory,
+        'files': jsonutils.loads(record.files) if record.files else [],
+        'error': record.error,
+        'started_at': record.started_at,
+        'finished_at': record.finished_at,
+    }
+
+
+def prune_jobs():
+    """Forgets the finished export jobs but the latest export_jobs_kept
+
+    The directories of the forgotten jobs are removed with their files.
+    """
+    directories = db_api.vcenter_export_job_prune(
+        CONF.vmware.export_jobs_kept, DONE_STATES)
+    for directory in directories:
+        tpool.execute(shutil.rmtree, directory, True)
+
+
+def fail_stale_jobs():
+    """Sets to error the unfinished jobs of soil processes which stopped
+
+    A running job updates its status every export_lease_update_interval
+    seconds, one not updated for three intervals has no process anymore.
+    Their directories are removed.
+    """
+    updated_before = timeutils.utcnow() - datetime.timedelta(
+        seconds=3 * CONF.vmware.export_lease_update_interval)
+    directories = db_api.vcenter_export_job_fail_stale(
+        DONE_STATES, updated_before,
+        "The soil process running the export stopped")
+    for directory in directories:
+        tpool.execute(shutil.rmtree, directory, True)
@@ -0,0 +1,215 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+import threading
+import time
+
+from pyVmomi import vim
+
+
+class ManagedObjectIndex(object):
+    """moid and name index of the managed objects of one vCenter
+
+    Keeps moid -> type and (type, name) -> moid maps so that a managed
+    object can be looked up without enumerating the inventory on the
+    server. The index is fed incrementally by the inventory mirror when
+    there is one in the process, and reloaded per type from a single
+    'name' collection otherwise.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._names = {}
+        self._by_name = collections.defaultdict(set)
+        self._loaded_at = {}
+
+    def add(self, moid, type_name, name=None):
+        with self._lock:
+            self._discard(moid)
+            self._types[moid] = type_name
+            if name is not None:
+                self._names[moid] = name
+                self._by_name[name].add(moid)
+
+    def remove(self, moid):
+        with self._lock:
+            self._discard(moid)
+
+    def load(self, type_names, objects):
+        """Replaces the objects of the given types
+
+        :param type_names: the managed object type names which were
+            collected, objects of these types or their subtypes missing
+            from objects are removed from the index
+        :param objects: iterable of (moid, type name, name)
+        """
+        type_names = set(type_names)
+        motypes = [getattr(vim, type_name) for type_name in type_names]
+        objects = list(objects)
+        with self._lock:
+            for moid, type_name in list(self._types.items()):
+                if is_instance_type(type_name, motypes):
+                    self._discard(moid)
+            for moid, type_name, name in objects:
+                self._types[moid] = type_name
+                if name is not None:
+                    self._names[moid] = name
+                    self._by_name[name].add(moid)
+            loaded_at = time.time()
+            for type_name in type_names:
+                self._loaded_at[type_name] = loaded_at
+
+    def loaded_since(self, type_names, seconds):
+        """Returns True if all type_names were loaded in the last seconds"""
+        now = time.time()
+        return all(now - self._loaded_at.get(type_name, 0) < seconds
+                   for type_name in type_names)
+
+    def get_type(self, moid):
+        """Returns the type name of moid, None if it is not indexed"""
+        return self._types.get(moid)
+
+    def find(self, motypes, name):
+        """Returns the moid and type name of the object called name
+
+        :param motypes: the pyVmomi managed object types the object may be
+            an instance of, any type when empty
+        :return: a 2-tuple (moid, type name), (None, None) if not indexed
+        """
+        with self._lock:
+            moids = sorted(self._by_name.get(name, ()))
+            for moid in moids:
+                type_name = self._types.get(moid)
+                if is_instance_type(type_name, motypes):
+                    return moid, type_name
+        return None, None
+
+    def _discard(self, moid):
+        self._types.pop(moid, None)
+        name = self._names.pop(moid, None)
+        if name is not None:
+            moids = self._by_name.get(name)
+            if moids is not None:
+                moids.discard(moid)
+                if not moids:
+                    del self._by_name[name]
+
+
+class GuestIndex(object):
+    """Reverse index of guest addresses to virtual machines
+
+    Maps the IP addresses, MAC addresses and DNS names reported by the
+    guests of the virtual machines of every vCenter to the (vCenter,
+    moid) pairs of the virtual machines, so that the owner of an address
+    is found with one dict lookup instead of a scan of the guests. It is
+    fed by the inventory mirrors of the process.
+    """
+
+    KINDS = ('ip', 'mac', 'hostname')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = collections.defaultdict(set)
+        self._keys_of = {}
+
+    @staticmethod
+    def normalize(kind, value):
+        """Returns the key of value, an address or name of kind"""
+        value = (value or '').strip().lower()
+        if kind == 'mac':
+            value = value.replace('-', ':')
+        elif kind == 'hostname':
+            value = value.rstrip('.')
+        return (kind, value) if value else None
+
+    def _keys(self, ips, macs, hostname):
+        keys = set()
+        for ip in ips or ():
+            keys.add(self.normalize('ip', ip))
+        for mac in macs or ():
+            keys.add(self.normalize('mac', mac))
+        key = self.normalize('hostname', hostname)
+        if key is not None:
+            keys.add(key)
+            # a fully qualified name is found by its short name as well
+            keys.add(self.normalize('hostname', key[1].split('.', 1)[0]))
+        keys.discard(None)
+        return keys
+
+    def update(self, vcenter, moid, ips=None, macs=None, hostname=None):
+        """Indexes the current addresses and name of a virtual machine"""
+        owner = (vcenter, moid)
+        keys = self._keys(ips, macs, hostname)
+        with self._lock:
+            previous = self._keys_of.get(owner, frozenset())
+            if keys == previous:
+                return
+            self._discard(owner, previous - keys)
+            for key in keys - previous:
+                self._by_key[key].add(owner)
+            if keys:
+                self._keys_of[owner] = frozenset(keys)
+            else:
+                self._keys_of.pop(owner, None)
+
+    def remove(self, vcenter, moid):
+        owner = (vcenter, moid)
+        with self._lock:
+            self._discard(owner, self._keys_of.pop(owner, ()))
+
+    def remove_vcenter(self, vcenter):
+        """Forgets all the virtual machines of vcenter"""
+        with self._lock:
+            for owner in [owner for owner in self._keys_of
+                          if owner[0] == vcenter]:
+                self._discard(owner, self._keys_of.pop(owner))
+
+    def lookup(self, kind, value):
+        """Returns the sorted (vcenter, moid) pairs owning value"""
+        key = self.normalize(kind, value)
+        if key is None:
+            return []
+        return sorted(self._by_key.get(key, ()))
+
+    def _discard(self, owner, keys):
+        for key in keys:
+            owners = self._by_key.get(key)
+            if owners is not None:
+                owners.discard(owner)
+                if not owners:
+                    del self._by_key[key]
+
+
+def is_instance_type(type_name, motypes):
+    """Returns True if type_name is one of or a subtype of motypes"""
+    cls = getattr(vim, type_name or '', None)
+    if cls is None:
+        return False
+    if not motypes:
+        return True
+    return issubclass(cls, tuple(motypes))
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(key):
+    """Returns the index of the vCenter identified by key
+
+    :param key: the (host, port, user) tuple of the vCenter
+    """
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = _INDEXES[key] = ManagedObjectIndex()
+        return index
+
+
+_GUEST_INDEX = GuestIndex()
+
+
+def get_guest_index():
+    """Returns the guest address index of all the vCenters"""
+    return _GUEST_INDEX
@@ -0,0 +1,630 @@
+# Copyright 2020 Soil, Inc.
+
+import base64
+import collections
+import errno
+import os
+import time
+import uuid
+
+import eventlet
+from eventlet import tpool
+from oslo_log import log as logging
+from six.moves import cPickle as pickle
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.columns import iter_column_batches
+from soil.api.utils.vmware.common import get_field
+from soil.api.utils.vmware.common import parse_propspec
+from soil.api.utils.vmware.common import plan_propspec
+from soil.api.utils.vmware.common import to_primitive
+from soil.api.utils.vmware.index import get_guest_index
+from soil.api.utils.vmware.index import get_index
+from soil.api.utils.vmware.query import QUERY_FIELDS
+from soil.api.utils.vmware.query import QueryIndex
+from soil.api.utils.vmware.records import RecordSet
+from soil.api.utils.vmware.records import intern_moid
+from soil.api.utils.vmware.exception import vCenterNotConnect
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+
+# fields read by the vCenter summary, per managed object type
+SUMMARY_FIELDS = {
+    'ComputeResource': ['summary.numHosts', 'summary.numEffectiveHosts',
+                        'summary.totalCpu', 'summary.totalMemory',
+                        'summary.numCpuCores', 'summary.numCpuThreads',
+                        'summary.effectiveCpu', 'summary.effectiveMemory'],
+    'HostSystem': ['hardware.cpuInfo.numCpuPackages'],
+    'Datastore': ['summary.capacity'],
+    'VirtualMachine': ['config.template', 'guest.hostName',
+                       'guest.net[].ipAddress'],
+}
+
+# fields placing objects in their cluster and datacenter
+TOPOLOGY_FIELDS = {
+    'ComputeResource': ['name', 'parent'],
+    'HostSystem': ['parent'],
+    'Datastore': ['parent'],
+    'VirtualMachine': ['runtime.host'],
+    'Folder': ['parent'],
+    'Datacenter': ['name'],
+}
+
+# fields mirrored for every managed object type
+INVENTORY_FIELDS = {
+    'ComputeResource': (['name'] + SUMMARY_FIELDS['ComputeResource'] +
+                        TOPOLOGY_FIELDS['ComputeResource']),
+    'HostSystem': (['name'] + SUMMARY_FIELDS['HostSystem'] +
+                   TOPOLOGY_FIELDS['HostSystem'] +
+                   QUERY_FIELDS['HostSystem']),
+    'Datastore': (['name'] + SUMMARY_FIELDS['Datastore'] +
+                  TOPOLOGY_FIELDS['Datastore'] +
+                  QUERY_FIELDS['Datastore']),
+    'VirtualMachine': (['name', 'guest.net[].macAddress'] +
+                       SUMMARY_FIELDS['VirtualMachine'] +
+                       TOPOLOGY_FIELDS['VirtualMachine'] +
+                       QUERY_FIELDS['VirtualMachine']),
+    'Folder': ['name'] + TOPOLOGY_FIELDS['Folder'],
+    'Datacenter': ['name'],
+}
+
+SUMMARY_COUNTERS = (
+    'numVms', 'numTemplates', 'numHosts', 'numEffectiveHosts', 'numCpus',
+    'totalCpuMhz', 'totalMemory', 'numCpuCores', 'numCpuThreads',
+    'effectiveCpuMhz', 'effectiveMemory', 'dataStore',
+)
+
+# summary counter -> ComputeResource field it sums up
+_COMPUTE_COUNTERS = (
+    ('numHosts', 'summary.numHosts'),
+    ('numEffectiveHosts', 'summary.numEffectiveHosts'),
+    ('totalCpuMhz', 'summary.totalCpu'),
+    ('totalMemory', 'summary.totalMemory'),
+    ('numCpuCores', 'summary.numCpuCores'),
+    ('numCpuThreads', 'summary.numCpuThreads'),
+    ('effectiveCpuMhz', 'summary.effectiveCpu'),
+    ('effectiveMemory', 'summary.effectiveMemory'),
+)
+
+# seconds to wait before reconnecting a failed mirror
+_RETRY_INTERVAL = 10
+
+# bumped whenever the layout of the inventory snapshots changes, snapshots
+# of another schema are ignored
+SNAPSHOT_SCHEMA = 1
+
+vCenterRef = collections.namedtuple(
+    'vCenterRef', ['uuid', 'host', 'port', 'username', 'password'])
+
+
+def _is_a(type_name, motype):
+    cls = getattr(vim, type_name, None)
+    return cls is not None and issubclass(cls, motype)
+
+
+def summary_contribution(type_name, props, vcenter_host):
+    """Returns what one object adds to the summary of its vCenter
+
+    :param type_name: the managed object type name of the object
+    :param props: the SUMMARY_FIELDS of the object, as collected
+    :param vcenter_host: the address the vCenter is registered with
+    :return: a 2-tuple of the summary counters of the object and the
+    guest hostname when the object is the vCenter appliance, else None
+    """
+    if _is_a(type_name, vim.ComputeResource):
+        return dict((counter, get_field(props, field, 0))
+                    for counter, field in _COMPUTE_COUNTERS), None
+
+    if _is_a(type_name, vim.VirtualMachine):
+        hostname = None
+        if vcenter_host in get_field(props, 'guest.net[].ipAddress', []):
+            hostname = get_field(props, 'guest.hostName')
+        if get_field(props, 'config.template', False):
+            return {'numTemplates': 1}, hostname
+        return {'numVms': 1}, hostname
+
+    if _is_a(type_name, vim.HostSystem):
+        return {'numCpus': get_field(
+            props, 'hardware.cpuInfo.numCpuPackages', 0)}, None
+
+    if _is_a(type_name, vim.Datastore):
+        return {'dataStore': get_field(props, 'summary.capacity', 0)}, None
+
+    return {}, None
+
+
+class InventoryMirror(object):
+    """In-memory mirror of the inventory of one vCenter
+
+    A long-lived PropertyCollector filter over a ContainerView of the whole
+    inventory is created once, and the change sets returned by
+    WaitForUpdatesEx are applied to a moid keyed object graph holding plain
+    python values. The vCenter summary is maintained incrementally from the
+    per-object contributions, so reading it costs O(1) and applying an
+    update costs O(changed objects).
+
+    When the server forgets the collector version the mirror resyncs from
+    an empty version while it keeps serving the previous objects.
+    Only a mirror created with save_snapshots writes the snapshot file of
+    the vCenter, any mirror may load it.
+    """
+
+    def __init__(self, vcenter, fields=None, save_snapshots=True):
+        self.vcenter = vCenterRef(vcenter.uuid, vcenter.host, vcenter.port,
+                                  vcenter.username, vcenter.password)
+        self.properties = plan_propspec(fields or INVENTORY_FIELDS)
+        # keeps the lookups by moid and name of this process current
+        self.index = get_index((vcenter.host, int(vcenter.port),
+                                vcenter.username))
+        # keeps the guest addresses of all the vCenters current
+        self.guests = get_guest_index()
+        # secondary indexes answering the inventory queries
+        self.query_index = QueryIndex()
+        # slotted records of primitives, no pyVmomi object is kept
+        self.objects = RecordSet(self.properties)
+        self.types = {}
+        self.version = None
+        self.state = 'init'
+        self.error = None
+        self.synced_at = None
+        self.updated_at = None
+        self.checked_at = None
+        self._summary = dict.fromkeys(SUMMARY_COUNTERS, 0)
+        self._contributions = {}
+        self._about = ''
+        self._epoch = None
+        self._seq = 0
+        self._journal = collections.deque()
+        self._resync_seen = None
+        self._saved_seq = None
+        self._saved_epoch = None
+        self.snapshot_at = None
+        self.save_snapshots = save_snapshots
+        # the objects come from a snapshot, no sync completed since
+        self.restored = False
+        self._stopped = False
+        self._thread = None
+
+    # public interface
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = eventlet.spawn(self._run)
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+            self._save_if_changed()
+        self.guests.remove_vcenter(self.vcenter.uuid)
+
+    @property
+    def stale(self):
+        if self.state != 'ready' or self.checked_at is None:
+            return True
+        max_age = 2 * CONF.vmware.inventory_wait_seconds + _RETRY_INTERVAL
+        return time.time() - self.checked_at > max_age
+
+    def status(self):
+        """Returns the staleness metadata of the mirror"""
+        return {
+            'state': self.state,
+            'stale': self.stale,
+            'version': self.version,
+            'error': self.error,
+            'num_objects': len(self.objects),
+            'snapshot_at': self.snapshot_at,
+            'restored': self.restored,
+            'synced_at': self.synced_at,
+            'updated_at': self.updated_at,
+            'checked_at': self.checked_at,
+        }
+
+    def summary(self):
+        summary_ref = dict(self._summary)
+        summary_ref['version'] = self._about
+        summary_ref['hostname'] = self.hostname()
+        return summary_ref
+
+    def hostname(self):
+        """Returns the guest hostname of the vCenter appliance, if found
+
+        The appliance is the virtual machine whose guest reports the
+        address, or the name, the vCenter is registered with.
+        """
+        for kind in ('ip', 'hostname'):
+            for vcenter, moid in self.guests.lookup(kind, self.vcenter.host):
+                props = self.objects.get(moid)
+                if vcenter == self.vcenter.uuid and props is not None:
+                    return props.get('guest.hostName', '')
+        return ''
+
+    def changes(self, since=None):
+        """Returns the objects changed since the version token since
+
+        Tokens are opaque to the client. Every PropertyCollector update
+        applied to the mirror advances the token, and the changes between
+        two tokens are coalesced per object into added objects, modified
+        properties and removed moids. A full listing is returned instead
+        when since is empty, comes from another mirror epoch (a resync or a
+        restart) or is older than the journal.
+        """
+        token = self._token(self._seq)
+        since_seq = self._parse_token(since)
+        if since_seq is None:
+            return {'full': True, 'token': token, 'version': self.version,
+                    'objects': self.list_objects()}
+
+        entries = []
+        for entry in reversed(self._journal):
+            if entry[0] <= since_seq:
+                break
+            entries.append(entry)
+
+        touched = collections.OrderedDict()
+        for _seq, moid, kind, names in reversed(entries):
+            previous = touched.get(moid)
+            if kind == 'leave':
+                if previous is not None and previous[0] == 'added':
+                    del touched[moid]
+                else:
+                    touched[moid] = ('removed', None)
+            elif kind == 'enter' or previous is None:
+                touched[moid] = ('added' if kind == 'enter' else 'modified',
+                                 set(names or ()))
+            elif previous[0] == 'modified':
+                previous[1].update(names or ())
+            elif previous[0] == 'removed':
+                touched[moid] = ('added', None)
+
+        added, modified, removed = [], [], []
+        for moid, (kind, names) in touched.items():
+            if kind == 'removed' or moid not in self.objects:
+                removed.append(moid)
+                continue
+            props = self.objects[moid]
+            if kind == 'modified':
+                props = dict((name, props.get(name)) for name in names)
+            obj = dict(props)
+            obj.update(moid=moid, type=self.types[moid])
+            (added if kind == 'added' else modified).append(obj)
+
+        return {'full': False, 'token': token, 'version': self.version,
+                'added': added, 'modified': modified, 'removed': removed}
+
+    def _token(self, seq):
+        raw = ('%s:%d' % (self._epoch, seq)).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def _parse_token(self, token):
+        """Returns the sequence number of a token still in the journal"""
+        if not token or self._epoch is None:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(str(token)).decode('utf-8')
+            epoch, seq = raw.rsplit(':', 1)
+            seq = int(seq)
+        except (TypeError, ValueError):
+            return None
+        if epoch != self._epoch or seq > self._seq:
+            return None
+        # the journal is trimmed by entry, the entries of its first seq
+        # may be partly gone, and it is empty when it keeps no entry at all
+        if seq < self._seq and (not self._journal or
+                                seq < self._journal[0][0]):
+            return None
+        return seq
+
+    def _journal_add(self, moid, kind, names=None):
+        self._journal.append((self._seq, moid, kind, names))
+        while len(self._journal) > CONF.vmware.inventory_journal_size:
+            self._journal.popleft()
+
+    def list_objects(self, object_type=None):
+        """Returns the mirrored objects, optionally of one managed type"""
+        motype = getattr(vim, object_type) if object_type else None
+        result = []
+        for moid, props in self.objects.items():
+            type_name = self.types[moid]
+            if motype is not None and not _is_a(type_name, motype):
+                continue
+            obj = dict(props)
+            obj.update(moid=moid, type=type_name)
+            result.append(obj)
+        return result
+
+    def query(self, query, limit):
+        """Returns a page of the objects matching a query
+
+        :param query: a query of query.build_query
+        :param limit: the maximum number of objects of the page
+        :return: the objects of the page ordered by name, and the marker of
+            the next page, None on the last page
+        """
+        moids, marker = self.query_index.query(
+            query['type'], match=query.get('match'),
+            ranges=query.get('ranges'), name=query.get('name'),
+            limit=limit, marker=query.get('marker'))
+        objects = []
+        for moid in moids:
+            obj = dict(self.objects[moid])
+            obj.update(moid=moid, type=self.types[moid])
+            objects.append(obj)
+        return objects, marker
+
+    def column_batches(self, fields):
+        """Yields the fields of the mirrored objects as ColumnBatch
+
+        :param fields: managed object type name -> fields, see
+            columns.iter_column_batches
+        """
+        objects = ((self.types[moid], moid, props)
+                   for moid, props in self.objects.items())
+        for batch in iter_column_batches(objects, fields):
+            yield batch
+
+    def perf_entities(self):
+        """Yields the (type name, moid) of the objects having realtime
+        performance metrics: the hosts and the powered on virtual machines
+        """
+        for moid, type_name in list(self.types.items()):
+            if _is_a(type_name, vim.HostSystem):
+                yield type_name, moid
+            elif _is_a(type_name, vim.VirtualMachine):
+                props = self.objects.get(moid)
+                if (props is not None and
+                        props.get('runtime.powerState') == 'poweredOn' and
+                        not props.get('config.template')):
+                    yield type_name, moid
+
+    @property
+    def snapshot_path(self):
+        if not CONF.vmware.snapshot_dir:
+            return None
+        return os.path.join(CONF.vmware.snapshot_dir,
+                            '%s.pickle' % self.vcenter.uuid)
+
+    def save_snapshot(self):
+        """Writes the mirrored objects to the snapshot file of the vCenter
+
+        Objects are stored per type as rows of values in the order of the
+        property paths of the type. The file is replaced atomically, so
+        it is never read half written.
+        """
+        path = self.snapshot_path
+        if path is None:
+            return
+        types = collections.defaultdict(lambda: ([], []))
+        for moid, type_name in self.types.items():
+            record = self.objects[moid]
+            paths, rows = types[type_name]
+            if not paths:
+                paths.extend(record.paths)
+            rows.append((moid, tuple(record.get(p) for p in record.paths)))
+        snapshot = {
+            'schema': SNAPSHOT_SCHEMA,
+            'host': self.vcenter.host,
+            'version': self.version,
+            'about': self._about,
+            'synced_at': self.synced_at,
+            'saved_at': time.time(),
+            'types': dict((type_name, (tuple(paths), rows))
+                          for type_name, (paths, rows) in types.items()),
+        }
+        # pickling a large inventory takes a while, keep the hub free
+        tpool.execute(self._write_snapshot, path, snapshot)
+        self.snapshot_at = snapshot['saved_at']
+
+    @staticmethod
+    def _write_snapshot(path, snapshot):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=2)
+        os.rename(tmp_path, path)
+
+    def load_snapshot(self):
+        """Loads the objects saved by save_snapshot, before start()
+
+        The restored objects are served as stale until the first sync of
+        the mirror, which keeps them meanwhile and drops those gone from
+        the vCenter at its end. The collector version is informative only:
+        versions do not survive the collector, so the mirror syncs in full.
+        :returns: True if a snapshot was loaded
+        """
+        path = self.snapshot_path
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            # unpickling a large inventory takes a while, keep the hub free
+            snapshot = tpool.execute(self._read_snapshot, path)
+        except Exception as e:
+            LOG.warning("Could not load the inventory snapshot %s: %s",
+                        path, e)
+            return False
+        if (not isinstance(snapshot, dict) or
+                snapshot.get('schema') != SNAPSHOT_SCHEMA or
+                snapshot.get('host') != self.vcenter.host):
+            LOG.info("Ignoring the inventory snapshot %s of another schema "
+                     "or vCenter", path)
+            return False
+
+        for type_name, (paths, rows) in snapshot['types'].items():
+            for moid, values in rows:
+                self._store(moid, type_name, dict(
+                    (path, value) for path, value in zip(paths, values)
+                    if value is not None))
+        self.version = snapshot['version']
+        self._about = snapshot['about']
+        self.synced_at = snapshot['synced_at']
+        self.snapshot_at = snapshot['saved_at']
+        self.state = 'stale'
+        self.restored = True
+        LOG.info("Loaded %d objects of vCenter %s from its inventory "
+                 "snapshot", len(self.objects), self.vcenter.host)
+        return True
+
+    @staticmethod
+    def _read_snapshot(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _save_if_changed(self, interval=0):
+        if (not self.save_snapshots or self.state != 'ready' or
+                (self._saved_epoch, self._saved_seq) == (self._epoch,
+                                                         self._seq) or
+                time.time() - (self.snapshot_at or 0) < interval):
+            return
+        try:
+            self.save_snapshot()
+            self._saved_epoch, self._saved_seq = self._epoch, self._seq
+        except Exception as e:
+            LOG.warning("Could not save the inventory snapshot of vCenter "
+                        "%s: %s", self.vcenter.host, e)
+
+    # mirror loop
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                with vCenterSmartConnect(self.vcenter, background=True) as vc:
+                    if vc.si is None:
+                        raise vCenterNotConnect()
+                    self._watch(vc)
+            except Exception as e:
+                LOG.warning("Inventory mirror of vCenter %s failed: %s",
+                            self.vcenter.host, e)
+                self.state = 'stale' if self.objects else 'error'
+                self.error = str(e) or e.__class__.__name__
+                eventlet.sleep(_RETRY_INTERVAL)
+
+    def _watch(self, vc):
+        content = vc.si.content
+        about = content.about
+        self._about = ' '.join([about.apiVersion, about.build])
+        props = parse_propspec(self.properties)
+        object_types = [motype for motype, _props in props]
+        # NOTE: a private collector keeps our filter and version apart
+        # from other users of the same (possibly shared) session
+        pc = content.propertyCollector.CreatePropertyCollector()
+        view = content.viewManager.CreateContainerView(
+            content.rootFolder, object_types, True)
+        try:
+            pc.CreateFilter(vc.create_view_filter_spec(view, props),
+                            partialUpdates=False)
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=CONF.vmware.inventory_wait_seconds)
+            self._begin_sync()
+            version = ''
+            while not self._stopped:
+                try:
+                    update = pc.WaitForUpdatesEx(version, options)
+                except vmodl.query.InvalidCollectorVersion:
+                    LOG.info("Collector version of vCenter %s lost, "
+                             "resyncing the inventory", self.vcenter.host)
+                    self._begin_sync()
+                    version = ''
+                    continue
+
+                self.checked_at = time.time()
+                if update is None:
+                    continue
+                self._apply(update)
+                version = self.version = update.version
+                self.updated_at = self.checked_at
+                if not update.truncated and self.state != 'ready':
+                    self._end_sync()
+                if CONF.vmware.snapshot_interval > 0:
+                    self._save_if_changed(CONF.vmware.snapshot_interval)
+        finally:
+            for obj in (pc, view):
+                try:
+                    obj.Destroy()
+                except Exception:
+                    pass
+
+    def _begin_sync(self):
+        self.state = 'syncing'
+        self._resync_seen = set()
+        # tokens of the previous epoch can not be served incrementally
+        self._epoch = uuid.uuid4().hex
+        self._seq = 0
+        self._journal.clear()
+
+    def _end_sync(self):
+        # objects which did not show up in a full resync are gone
+        for moid in set(self.objects) - self._resync_seen:
+            self._remove(moid)
+            self._journal_add(moid, 'leave')
+        self._resync_seen = None
+        self.state = 'ready'
+        self.restored = False
+        self.error = None
+        self.synced_at = time.time()
+
+    def _apply(self, update):
+        self._seq += 1
+        for filter_set in update.filterSet:
+            for obj_update in filter_set.objectSet:
+                moid = obj_update.obj._moId
+                if obj_update.kind == 'leave':
+                    self._remove(moid)
+                    self._journal_add(moid, 'leave')
+                    continue
+
+                if self._resync_seen is not None:
+                    self._resync_seen.add(moid)
+                props = {}
+                if obj_update.kind == 'modify':
+                    props.update(self.objects.get(moid, {}))
+                for change in obj_update.changeSet:
+                    if change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = to_primitive(change.val)
+                self._store(moid, obj_update.obj._wsdlName, props)
+                self._journal_add(moid, obj_update.kind, tuple(
+                    change.name for change in obj_update.changeSet))
+
+    def _store(self, moid, type_name, props):
+        if moid in self.types:
+            self._remove(moid)
+        moid = intern_moid(moid)
+        self.objects.add(type_name, moid, props)
+        self.types[moid] = type_name
+        self.index.add(moid, type_name, props.get('name'))
+        self.query_index.add(moid, type_name, props)
+        # the appliance is found through the guest index, see hostname()
+        contribution, _hostname = summary_contribution(type_name, props,
+                                                       None)
+        for key, value in contribution.items():
+            self._summary[key] += value
+        self._contributions[moid] = contribution
+        if _is_a(type_name, vim.VirtualMachine):
+            self.guests.update(
+                self.vcenter.uuid, moid,
+                ips=get_field(props, 'guest.net[].ipAddress', []),
+                macs=get_field(props, 'guest.net[].macAddress', []),
+                hostname=get_field(props, 'guest.hostName'))
+
+    def _remove(self, moid):
+        self.objects.pop(moid, None)
+        self.types.pop(moid, None)
+        self.index.remove(moid)
+        self.query_index.remove(moid)
+        self.guests.remove(self.vcenter.uuid, moid)
+        contribution = self._contributions.pop(moid, {})
+        for key, value in contribution.items():
+            self._summary[key] -= value
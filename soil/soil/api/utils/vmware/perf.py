@@ -0,0 +1,301 @@
+# Copyright 2020 Soil, Inc.
+
+import datetime
+import time
+
+import eventlet
+import numpy as np
+from oslo_log import log as logging
+from pyVmomi import vim
+from pyVmomi import vmodl
+from pyVmomi.Iso8601 import TZManager
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.exception import vCenterNotConnect
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# metric -> (performance counter, scale applied to its raw values)
+METRICS = {
+    # hundredths of percent
+    'cpu': ('cpu.usage.average', 0.01),
+    'mem': ('mem.usage.average', 0.01),
+    # KBps
+    'disk': ('disk.usage.average', 1),
+    'net': ('net.usage.average', 1),
+}
+
+# seconds between two realtime samples of hosts and virtual machines
+_REALTIME_INTERVAL = 20
+
+# seconds to wait before reconnecting a failed collector
+_RETRY_INTERVAL = 10
+
+
+class RingBuffer(object):
+    """Fixed-size buffer of the latest (timestamp, value) samples
+
+    Timestamps are epoch seconds in an int64 array, values a float64 array
+    with unavailable samples as NaN; once full the oldest samples are
+    overwritten, so the memory of a buffer never grows.
+    """
+
+    __slots__ = ('timestamps', 'values', 'head', 'count')
+
+    def __init__(self, size):
+        self.timestamps = np.zeros(size, dtype=np.int64)
+        self.values = np.full(size, np.nan, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def last(self):
+        """The timestamp of the latest sample, None when empty"""
+        if not self.count:
+            return None
+        return int(self.timestamps[self.head - 1])
+
+    def extend(self, timestamps, values):
+        """Appends the samples newer than the latest one"""
+        last = self.last
+        if last is not None:
+            newer = timestamps > last
+            timestamps, values = timestamps[newer], values[newer]
+        size = len(self.timestamps)
+        if len(timestamps) > size:
+            timestamps, values = timestamps[-size:], values[-size:]
+        positions = (self.head + np.arange(len(timestamps))) % size
+        self.timestamps[positions] = timestamps
+        self.values[positions] = values
+        self.head = (self.head + len(timestamps)) % size
+        self.count = min(self.count + len(timestamps), size)
+
+    def series(self, start=None, end=None):
+        """Returns the timestamps and values in [start, end], oldest first"""
+        size = len(self.timestamps)
+        order = (self.head - self.count + np.arange(self.count)) % size
+        timestamps, values = self.timestamps[order], self.values[order]
+        mask = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps <= end
+        return timestamps[mask], values[mask]
+
+
+def downsample(timestamps, values, step):
+    """Averages the samples over step seconds long buckets
+
+    :return: the start of every non empty bucket and the mean of the
+        available values of the bucket, NaN when none was available
+    """
+    if not step or not len(timestamps):
+        return timestamps, values
+    buckets = timestamps // step
+    unique, inverse = np.unique(buckets, return_inverse=True)
+    available = ~np.isnan(values)
+    sums = np.bincount(inverse, weights=np.where(available, values, 0),
+                       minlength=len(unique))
+    counts = np.bincount(inverse, weights=available, minlength=len(unique))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return unique * step, means
+
+
+def _parse_timestamps(sample_info):
+    """Returns the epoch seconds of a sampleInfoCSV string
+
+    The string alternates intervals and ISO 8601 UTC timestamps.
+    """
+    fields = sample_info.split(',')
+    stamps = [stamp.rstrip('Z') for stamp in fields[1::2]]
+    return np.array(stamps, dtype='datetime64[s]').astype(np.int64)
+
+
+def _parse_values(value_csv, scale):
+    values = np.array(value_csv.split(','), dtype=np.float64)
+    # the server reports unavailable samples as -1
+    values[values < 0] = np.nan
+    return values * scale
+
+
+class PerfCollector(object):
+    """Collects the realtime performance metrics of one vCenter
+
+    Every [vmware]perf_interval seconds the entities returned by the
+    entities callable are queried [vmware]perf_batch_size at a time, one
+    PerformanceManager.QueryPerf call per batch in CSV format, each entity
+    from its latest sample on. The counter ids of METRICS are looked up
+    once per collector. Samples are kept in one RingBuffer of
+    [vmware]perf_buffer_size samples per entity and metric, and series()
+    reads them without calling the vCenter.
+
+    useage:
+        collector = PerfCollector(vcenter, mirror.perf_entities)
+        collector.start()
+        collector.series('host-10', ['cpu'], step=300)
+    """
+
+    def __init__(self, vcenter, entities):
+        """:param entities: callable returning (type name, moid) pairs"""
+        self.vcenter = vcenter
+        self.entities = entities
+        self.state = 'init'
+        self.error = None
+        self.collected_at = None
+        self._counters = None
+        self._buffers = {}
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = eventlet.spawn(self._run)
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+
+    def status(self):
+        return {
+            'state': self.state,
+            'error': self.error,
+            'num_entities': len(self._buffers),
+            'collected_at': self.collected_at,
+        }
+
+    def series(self, moid, metrics=None, start=None, end=None, step=None):
+        """Returns the samples of one entity, per metric
+
+        :param metrics: the metrics to read, all of METRICS by default
+        :param start: epoch seconds of the oldest sample to return
+        :param end: epoch seconds of the latest sample to return
+        :param step: seconds over which samples are averaged, raw samples
+            are returned when not set
+        :return: None when the entity is not collected, else
+            {metric: {'timestamps': [...], 'values': [...]}} where missing
+            values are None
+        """
+        buffers = self._buffers.get(moid)
+        if buffers is None:
+            return None
+        result = {}
+        for metric in metrics or sorted(METRICS):
+            buf = buffers.get(metric)
+            if buf is None:
+                continue
+            timestamps, values = buf.series(start, end)
+            timestamps, values = downsample(timestamps, values, step)
+            result[metric] = {
+                'timestamps': timestamps.tolist(),
+                'values': [None if np.isnan(value) else round(value, 2)
+                           for value in values.tolist()],
+            }
+        return result
+
+    # collector loop
+
+    def _run(self):
+        while not self._stopped:
+            started = time.time()
+            try:
+                with vCenterSmartConnect(self.vcenter, background=True) as vc:
+                    if vc.si is None:
+                        raise vCenterNotConnect()
+                    self._collect(vc)
+                self.state = 'ready'
+                self.error = None
+                self.collected_at = time.time()
+            except Exception as e:
+                LOG.warning("Performance collector of vCenter %s failed: %s",
+                            self.vcenter.host, e)
+                self.state = 'error'
+                self.error = str(e) or e.__class__.__name__
+                eventlet.sleep(_RETRY_INTERVAL)
+                continue
+            eventlet.sleep(max(CONF.vmware.perf_interval -
+                               (time.time() - started), 0))
+
+    def _collect(self, vc):
+        perf_manager = vc.si.content.perfManager
+        if self._counters is None:
+            self._counters = self._counter_ids(perf_manager)
+
+        entities = list(self.entities())
+        current = set(moid for _type_name, moid in entities)
+        for moid in set(self._buffers) - current:
+            del self._buffers[moid]
+
+        batch_size = CONF.vmware.perf_batch_size
+        for i in range(0, len(entities), batch_size):
+            specs = [self._query_spec(vc, type_name, moid)
+                     for type_name, moid in entities[i:i + batch_size]]
+            try:
+                result = perf_manager.QueryPerf(specs)
+            except vmodl.MethodFault as e:
+                # e.g. an entity removed since it was listed, the next
+                # collection does not list it anymore
+                LOG.warning("Performance query of vCenter %s failed: %s",
+                            self.vcenter.host, e.msg or e)
+                continue
+            for entity_metric in result or []:
+                self._store(entity_metric)
+
+    def _counter_ids(self, perf_manager):
+        """Returns performance counter id -> (metric, scale)"""
+        names = dict((counter, (metric, scale))
+                     for metric, (counter, scale) in METRICS.items())
+        counters = {}
+        for counter in perf_manager.perfCounter:
+            name = '%s.%s.%s' % (counter.groupInfo.key,
+                                 counter.nameInfo.key, counter.rollupType)
+            if name in names:
+                counters[counter.key] = names[name]
+        return counters
+
+    def _query_spec(self, vc, type_name, moid):
+        spec = vim.PerformanceManager.QuerySpec(
+            entity=vc._make_ref(type_name, moid),
+            metricId=[vim.PerformanceManager.MetricId(counterId=key,
+                                                      instance='')
+                      for key in self._counters],
+            intervalId=_REALTIME_INTERVAL,
+            format='csv')
+        last = self._last(moid)
+        if last is None:
+            spec.maxSample = CONF.vmware.perf_buffer_size
+        else:
+            spec.startTime = datetime.datetime.fromtimestamp(
+                last, TZManager.GetTZInfo())
+        return spec
+
+    def _last(self, moid):
+        buffers = self._buffers.get(moid)
+        if not buffers:
+            return None
+        lasts = [buf.last for buf in buffers.values() if buf.last]
+        return min(lasts) if lasts else None
+
+    def _store(self, entity_metric):
+        if not entity_metric.sampleInfoCSV:
+            return
+        timestamps = _parse_timestamps(entity_metric.sampleInfoCSV)
+        buffers = self._buffers.setdefault(entity_metric.entity._moId, {})
+        for series in entity_metric.value:
+            metric = self._counters.get(series.id.counterId)
+            if metric is None or not series.value:
+                continue
+            name, scale = metric
+            buf = buffers.get(name)
+            if buf is None:
+                buf = buffers[name] = RingBuffer(CONF.vmware.perf_buffer_size)
+            buf.extend(timestamps, _parse_values(series.value, scale))
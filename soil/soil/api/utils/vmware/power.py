@@ -0,0 +1,160 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+import time
+
+import eventlet
+from eventlet import queue
+from eventlet import semaphore
+from oslo_log import log as logging
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import soil.conf
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.exception import vCenterNotConnect
+from soil.db import api as db_api
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# power action -> VirtualMachine method
+POWER_ACTIONS = {
+    'on': 'PowerOnVM_Task',
+    'off': 'PowerOffVM_Task',
+    'reset': 'ResetVM_Task',
+    'shutdownGuest': 'ShutdownGuest',
+}
+
+# actions which do not return a task, they complete once accepted
+_NO_TASK_ACTIONS = ('shutdownGuest',)
+
+_VM_PROPERTIES = [(vim.VirtualMachine, ['name', 'runtime.host'])]
+
+
+class BulkPowerOperation(object):
+    """Runs one power action on many virtual machines of a vCenter
+
+    The tasks are submitted concurrently, at most
+    [vmware]power_max_in_flight at a time on the vCenter and
+    [vmware]power_max_in_flight_per_host on any one host, and followed by
+    the task watcher of the vCenter, so all of them cost a single
+    WaitForUpdatesEx loop. run() yields the outcome of every virtual
+    machine as soon as it is known, and every outcome is recorded in the
+    vcenter_log table.
+
+    useage:
+        operation = BulkPowerOperation(vcenter, 'on', ['vm-1', 'vm-2'])
+        for result in operation.run():
+            ...
+    """
+
+    def __init__(self, vcenter, action, moids, operator=None):
+        if action not in POWER_ACTIONS:
+            raise ValueError("action must be one of %s" %
+                             ', '.join(sorted(POWER_ACTIONS)))
+        self.vcenter = vcenter
+        self.action = action
+        # keep the order, drop the duplicates
+        self.moids = list(collections.OrderedDict.fromkeys(moids))
+        self.operator = operator
+        self._vcenter_slots = semaphore.Semaphore(
+            CONF.vmware.power_max_in_flight)
+        self._host_slots = collections.defaultdict(
+            lambda: semaphore.Semaphore(
+                CONF.vmware.power_max_in_flight_per_host))
+        self._cancelled = False
+
+    def run(self):
+        """Yields one result dict per virtual machine, then a summary"""
+        counts = collections.Counter()
+        with vCenterSmartConnect(self.vcenter) as vc:
+            if vc.si is None:
+                raise vCenterNotConnect()
+
+            vms, missing = self._lookup(vc)
+            for moid in missing:
+                result = {'vm': moid, 'status': 'error',
+                          'error': 'virtual machine not found'}
+                counts[result['status']] += 1
+                yield result
+
+            results = queue.LightQueue()
+            # the semaphores bound the tasks in flight, not the pool: a
+            # busy host must not hold the slots of the others
+            pool = eventlet.GreenPool(max(len(vms), 1))
+            for moid, (name, host) in vms.items():
+                pool.spawn_n(self._power, vc, moid, name, host, results)
+            try:
+                for _i in range(len(vms)):
+                    result = results.get()
+                    counts[result['status']] += 1
+                    yield result
+            finally:
+                # when the client went away, submit no more tasks and wait
+                # for those in flight before the session is given back
+                self._cancelled = True
+                pool.waitall()
+
+        yield {'done': True, 'action': self.action,
+               'success': counts['success'], 'error': counts['error']}
+
+    def _lookup(self, vc):
+        """Returns {moid: (name, host moid)} and the moids not found"""
+        moids = list(self.moids)
+        missing = []
+        while moids:
+            objs = [vim.VirtualMachine(moid, vc.si._stub) for moid in moids]
+            try:
+                found = {}
+                for obj in vc.iter_object_property(objs, _VM_PROPERTIES,
+                                                   raw=True):
+                    moref, props = obj
+                    found[moref._moId] = (props.get('name'),
+                                          props.get('runtime.host'))
+                return found, missing
+            except vmodl.fault.ManagedObjectNotFound as e:
+                # the whole retrieval fails on the first unknown object
+                moids.remove(e.obj._moId)
+                missing.append(e.obj._moId)
+        return {}, missing
+
+    def _power(self, vc, moid, name, host, results):
+        started = time.time()
+        result = {'vm': moid, 'name': name, 'host': host}
+        try:
+            with self._host_slots[host], self._vcenter_slots:
+                if self._cancelled:
+                    return
+                vm = vim.VirtualMachine(moid, vc.si._stub)
+                task = getattr(vm, POWER_ACTIONS[self.action])()
+                if self.action not in _NO_TASK_ACTIONS:
+                    vc.watch_task(task).wait()
+            result['status'] = 'success'
+        except vmodl.MethodFault as e:
+            result.update(status='error', error=e.msg or
+                          e.__class__.__name__)
+        except Exception as e:
+            LOG.exception("Power %s of virtual machine %s failed",
+                          self.action, moid)
+            result.update(status='error', error=str(e))
+        result['elapsed'] = round(time.time() - started, 3)
+        self._log(result)
+        results.put(result)
+
+    def _log(self, result):
+        try:
+            db_api.vcenter_log_create(
+                name=self.vcenter.name,
+                vcenter_type=self.vcenter.vcenter_type,
+                hostname=self.vcenter.host,
+                action='power',
+                status=result['status'],
+                resource=result.get('name') or result['vm'],
+                res_type='VirtualMachine',
+                res_operator=self.operator,
+                res_op_action=self.action)
+        except Exception:
+            LOG.exception("Could not record the power %s of virtual "
+                          "machine %s", self.action, result['vm'])
@@ -0,0 +1,438 @@
+# Copyright 2020 Soil, Inc.
+
+import base64
+import bisect
+import collections
+import json
+
+import six
+from oslo_utils import strutils
+from pyVmomi import vim
+
+from soil.api.utils.vmware.common import get_field
+
+
+# managed object types which can be queried
+QUERY_TYPES = ('VirtualMachine', 'HostSystem', 'Datastore')
+
+
+def _free_percent(props):
+    capacity = get_field(props, 'summary.capacity')
+    free = get_field(props, 'summary.freeSpace')
+    if not capacity or free is None:
+        return None
+    return 100.0 * free / capacity
+
+
+# type -> filter -> field the objects are matched on by equality, a list
+# field matches when any of its values does
+MATCH_FILTERS = {
+    'VirtualMachine': {
+        'power_state': 'runtime.powerState',
+        'host': 'runtime.host',
+        'datastore': 'datastore',
+        'template': 'config.template',
+    },
+    'HostSystem': {
+        'power_state': 'runtime.powerState',
+        'cluster': 'parent',
+        'datastore': 'datastore',
+    },
+    'Datastore': {
+        'fs_type': 'summary.type',
+    },
+}
+
+# type -> filter -> (filter of the type, type, filter of the other type):
+# the objects whose filter value is an object of the other type matching
+# the filter of the other type, e.g. the virtual machines of the hosts of
+# a cluster
+VIA_FILTERS = {
+    'VirtualMachine': {
+        'cluster': ('host', 'HostSystem', 'cluster'),
+    },
+}
+
+# type -> filter -> field, or callable of the properties, the objects are
+# matched on by range
+RANGE_FILTERS = {
+    'VirtualMachine': {
+        'memory_mb': 'config.hardware.memoryMB',
+        'num_cpu': 'config.hardware.numCPU',
+    },
+    'HostSystem': {
+        'memory': 'hardware.memorySize',
+        'num_cpu': 'hardware.cpuInfo.numCpuPackages',
+    },
+    'Datastore': {
+        'capacity': 'summary.capacity',
+        'free_space': 'summary.freeSpace',
+        'free_percent': _free_percent,
+    },
+}
+
+# fields the query index reads besides the name, per managed object type
+QUERY_FIELDS = {
+    'VirtualMachine': ['runtime.powerState', 'runtime.host', 'datastore',
+                       'config.template', 'config.hardware.memoryMB',
+                       'config.hardware.numCPU'],
+    'HostSystem': ['runtime.powerState', 'parent', 'datastore',
+                   'hardware.memorySize', 'hardware.cpuInfo.numCpuPackages'],
+    'Datastore': ['summary.type', 'summary.capacity', 'summary.freeSpace'],
+}
+
+_BOOL_FILTERS = ('template',)
+
+
+class _Top(object):
+    """Sorts after any moid, bounds the keys of one value"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+
+_TOP = _Top()
+
+
+def _query_type(type_name):
+    cls = getattr(vim, type_name or '', None)
+    if cls is None:
+        return None
+    for query_type in QUERY_TYPES:
+        if issubclass(cls, getattr(vim, query_type)):
+            return query_type
+    return None
+
+
+def _name_key(name):
+    return (name or '').lower()
+
+
+def _prefix_end(prefix):
+    """Returns the first string after all the strings starting with prefix"""
+    return prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
+
+
+def encode_marker(name_key, moid):
+    raw = json.dumps([name_key, moid]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_marker(marker):
+    """Returns the (name key, moid) of a marker, raises ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(str(marker)).decode('utf-8')
+        name_key, moid = json.loads(raw)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid marker %s." % marker)
+    if not (isinstance(name_key, six.string_types) and
+            isinstance(moid, six.string_types)):
+        raise ValueError("Invalid marker %s." % marker)
+    return name_key, moid
+
+
+def build_query(type_name, params):
+    """Returns the query of type_name described by request parameters
+
+    :param params: a webob MultiDict; every filter of MATCH_FILTERS or
+        VIA_FILTERS may be given several times to match any of the values,
+        range filters are given as <filter>_min and <filter>_max, both
+        inclusive, and names with name_prefix, name_min and name_max,
+        compared case-insensitively
+    :raises ValueError: when a parameter is invalid
+    """
+    if type_name not in QUERY_TYPES:
+        raise ValueError("Invalid type %s, must be one of %s." %
+                         (type_name, ', '.join(QUERY_TYPES)))
+    query = {'type': type_name, 'match': {}, 'ranges': {}, 'name': {}}
+
+    filters = (list(MATCH_FILTERS[type_name]) +
+               list(VIA_FILTERS.get(type_name, {})))
+    for name in filters:
+        values = [value for value in params.getall(name) if value]
+        if name in _BOOL_FILTERS:
+            values = [strutils.bool_from_string(value, strict=True)
+                      for value in values]
+        if values:
+            query['match'][name] = values
+
+    for name in RANGE_FILTERS[type_name]:
+        bounds = []
+        for suffix in ('_min', '_max'):
+            value = params.get(name + suffix)
+            try:
+                bounds.append(float(value) if value else None)
+            except ValueError:
+                raise ValueError("%s%s must be a number." % (name, suffix))
+        if bounds != [None, None]:
+            query['ranges'][name] = bounds
+
+    for key in ('prefix', 'min', 'max'):
+        value = params.get('name_' + key)
+        if value:
+            query['name'][key] = _name_key(value)
+
+    marker = params.get('marker')
+    if marker:
+        decode_marker(marker)
+        query['marker'] = marker
+    return query
+
+
+class QueryIndex(object):
+    """Secondary indexes over the mirrored objects of one vCenter
+
+    Objects of QUERY_TYPES are kept in a hash index per filter of
+    MATCH_FILTERS, in a sorted (value, moid) list per filter of
+    RANGE_FILTERS and in a sorted (lowercased name, moid) list, which is
+    also the order of the results. A query starts from its most selective
+    constraint, a hash bucket, a range slice or the name slice, and checks
+    the other constraints on those candidates only, so its cost depends on
+    the size of the page and of the selected objects, not of the
+    inventory. The mirror feeding it and the queries run in green threads
+    which do not yield while indexing or querying, so it takes no lock.
+
+    useage:
+        index = QueryIndex()
+        index.add('vm-42', 'VirtualMachine', props)
+        moids, marker = index.query('VirtualMachine',
+                                    match={'power_state': ['poweredOff']},
+                                    name={'prefix': 'web-'}, limit=50)
+    """
+
+    def __init__(self):
+        self._types = {}
+        self._names = dict((query_type, []) for query_type in QUERY_TYPES)
+        self._name_keys = {}
+        self._buckets = dict(
+            ((query_type, name), collections.defaultdict(set))
+            for query_type, filters in MATCH_FILTERS.items()
+            for name in filters)
+        self._match_keys = {}
+        self._sorted = dict(((query_type, name), [])
+                            for query_type, filters in RANGE_FILTERS.items()
+                            for name in filters)
+        self._values = {}
+
+    def __len__(self):
+        return len(self._types)
+
+    def add(self, moid, type_name, props):
+        query_type = _query_type(type_name)
+        if query_type is None:
+            return
+        if moid in self._types:
+            self.remove(moid)
+        self._types[moid] = query_type
+
+        key = (_name_key(props.get('name')), moid)
+        self._name_keys[moid] = key
+        bisect.insort(self._names[query_type], key)
+
+        match_keys = {}
+        for name, field in MATCH_FILTERS[query_type].items():
+            value = get_field(props, field)
+            if value is None:
+                continue
+            values = value if isinstance(value, list) else [value]
+            buckets = self._buckets[(query_type, name)]
+            for value in values:
+                buckets[value].add(moid)
+            match_keys[name] = values
+        self._match_keys[moid] = match_keys
+
+        values = {}
+        for name, field in RANGE_FILTERS[query_type].items():
+            if callable(field):
+                value = field(props)
+            else:
+                value = get_field(props, field)
+            if value is None:
+                continue
+            bisect.insort(self._sorted[(query_type, name)], (value, moid))
+            values[name] = value
+        self._values[moid] = values
+
+    def remove(self, moid):
+        query_type = self._types.pop(moid, None)
+        if query_type is None:
+            return
+        self._discard(self._names[query_type], self._name_keys.pop(moid))
+        for name, values in self._match_keys.pop(moid).items():
+            buckets = self._buckets[(query_type, name)]
+            for value in values:
+                bucket = buckets.get(value)
+                if bucket is not None:
+                    bucket.discard(moid)
+                    if not bucket:
+                        del buckets[value]
+        for name, value in self._values.pop(moid).items():
+            self._discard(self._sorted[(query_type, name)], (value, moid))
+
+    @staticmethod
+    def _discard(entries, entry):
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+    def query(self, type_name, match=None, ranges=None, name=None,
+              limit=100, marker=None):
+        """Returns a page of the objects of type_name matching a query
+
+        :param match: filter -> values, an object matches one of them
+        :param ranges: filter -> [min, max], inclusive, None for unbounded
+        :param name: optional 'prefix', 'min' and 'max' of the lowercased
+            names, 'min' and 'max' inclusive
+        :param marker: the marker returned with the previous page
+        :return: the moids of the page ordered by name, and the marker of
+            the next page, None on the last page
+        """
+        names = self._names[type_name]
+        name = name or {}
+        matches = [self._match(type_name, filter_name, values)
+                   for filter_name, values in (match or {}).items()]
+        bounds = [(filter_name, low, high)
+                  for filter_name, (low, high) in (ranges or {}).items()]
+
+        lower, upper = ('', ''), None
+        if name.get('prefix'):
+            lower = max(lower, (name['prefix'], ''))
+            upper = (_prefix_end(name['prefix']), '')
+        if name.get('min'):
+            lower = max(lower, (name['min'], ''))
+        if name.get('max'):
+            upper = min(upper or (name['max'], _TOP), (name['max'], _TOP))
+        after = tuple(decode_marker(marker)) if marker else None
+
+        start = bisect.bisect_left(names, lower)
+        if after is not None:
+            start = max(start, bisect.bisect_right(names, after))
+        end = len(names) if upper is None else bisect.bisect_left(names,
+                                                                  upper)
+        end = max(start, end)
+
+        # the smallest hash or range constraint is the candidate set
+        total = float(len(names)) or 1.0
+        walk = end - start
+        selectivity = walk / total
+        driver, size = None, None
+        for i, (_filter_name, _values, _buckets, count) in enumerate(
+                matches):
+            selectivity *= count / total
+            if size is None or count < size:
+                driver, size = ('match', i, None, None), count
+        for i, (filter_name, low, high) in enumerate(bounds):
+            first, last = self._range_slice(type_name, filter_name, low, high)
+            selectivity *= (last - first) / total
+            if size is None or last - first < size:
+                driver, size = ('range', i, first, last), last - first
+
+        # walking the names stops after a page of matches, checking about
+        # limit / selectivity objects against every constraint, while every
+        # candidate is checked against the other constraints and the names,
+        # then sorted
+        checks = len(matches) + len(bounds)
+        walked = min(walk, (limit + 1) / (selectivity or 1.0))
+        if size == 0 or walk == 0:
+            keys = []
+        elif driver is None or walked * checks <= size * (checks + 1):
+            # a set of several buckets is cheaper to build in C than to
+            # check per object, unless it is much larger than the walk
+            matches = [(filter_name, values,
+                        [set().union(*buckets)] if count <= 8 * walked else
+                        buckets, count)
+                       for filter_name, values, buckets, count in matches]
+            keys = self._walk(names, start, end, matches, bounds, limit + 1)
+        else:
+            kind, i, first, last = driver
+            if kind == 'match':
+                buckets = matches[i][2]
+                candidates = (buckets[0] if len(buckets) == 1 else
+                              set().union(*buckets))
+                matches = matches[:i] + matches[i + 1:]
+                # intersect the single buckets in C rather than one object
+                # at a time
+                for match_ in [match_ for match_ in matches
+                               if len(match_[2]) == 1]:
+                    candidates = candidates & match_[2][0]
+                    matches.remove(match_)
+            else:
+                entries = self._sorted[(type_name, bounds[i][0])]
+                candidates = [moid for _value, moid in entries[first:last]]
+                bounds = bounds[:i] + bounds[i + 1:]
+            keys = []
+            for moid in candidates:
+                key = self._name_keys[moid]
+                if (key < lower or (upper is not None and key >= upper) or
+                        (after is not None and key <= after)):
+                    continue
+                if self._matches(moid, matches, bounds):
+                    keys.append(key)
+            keys.sort()
+            keys = keys[:limit + 1]
+
+        next_marker = None
+        if len(keys) > limit:
+            keys = keys[:limit]
+            next_marker = encode_marker(*keys[-1])
+        return [moid for _name, moid in keys], next_marker
+
+    def _match(self, type_name, filter_name, values):
+        """Returns the (filter, values, buckets, size) of a match filter
+
+        The size is the sum of the sizes of the buckets, an object of a list
+        field may be in several of them.
+        """
+        via = VIA_FILTERS.get(type_name, {}).get(filter_name)
+        if via is not None:
+            filter_name, other_type, other_filter = via
+            other_buckets = self._match(other_type, other_filter, values)[2]
+            values = set().union(*other_buckets) if other_buckets else ()
+        values = set(values)
+        buckets = self._buckets[(type_name, filter_name)]
+        buckets = [buckets[value] for value in values if value in buckets]
+        return (filter_name, values, buckets,
+                sum(len(bucket) for bucket in buckets))
+
+    def _range_slice(self, type_name, filter_name, low, high):
+        entries = self._sorted[(type_name, filter_name)]
+        first = 0 if low is None else bisect.bisect_left(entries, (low, ''))
+        last = (len(entries) if high is None else
+                bisect.bisect_right(entries, (high, _TOP)))
+        return first, max(first, last)
+
+    def _matches(self, moid, matches, bounds):
+        for filter_name, values, buckets, _size in matches:
+            if len(buckets) == 1:
+                if moid not in buckets[0]:
+                    return False
+            elif values.isdisjoint(
+                    self._match_keys[moid].get(filter_name, ())):
+                return False
+        if bounds:
+            values = self._values[moid]
+            for filter_name, low, high in bounds:
+                value = values.get(filter_name)
+                if (value is None or (low is not None and value < low) or
+                        (high is not None and value > high)):
+                    return False
+        return True
+
+    def _walk(self, names, start, end, matches, bounds, count):
+        keys = []
+        for i in range(start, end):
+            key = names[i]
+            if self._matches(key[1], matches, bounds):
+                keys.append(key)
+                if len(keys) == count:
+                    break
+        return keys
@@ -0,0 +1,192 @@
+# Copyright 2020 Soil, Inc.
+
+import collections
+from xml.etree import ElementTree
+
+from pyVmomi import SoapAdapter
+from pyVmomi import VmomiSupport
+from pyVmomi import vim
+from pyVmomi import vmodl
+from six.moves import http_client
+
+from soil.api.utils.vmware.records import intern_moid
+
+
+_VIM_NS = '{urn:vim25}'
+_XSI_TYPE = '{%s}type' % VmomiSupport.XMLNS_XSI
+_OBJECTS = _VIM_NS + 'objects'
+_TOKEN = _VIM_NS + 'token'
+
+_MOREF = 'ManagedObjectReference'
+_MOREF_ARRAY = 'ArrayOfManagedObjectReference'
+
+RawRetrieveResult = collections.namedtuple('RawRetrieveResult',
+                                           ['objects', 'token'])
+
+_TYPE_CACHE = {}
+
+
+def _xsi_type(elem):
+    """Returns the pyVmomi type named by the xsi:type of elem, if any"""
+    xsi_type = elem.get(_XSI_TYPE)
+    if xsi_type is None:
+        return None
+    typ = _TYPE_CACHE.get(xsi_type)
+    if typ is None:
+        prefix, _sep, name = xsi_type.rpartition(':')
+        if name in (_MOREF, _MOREF_ARRAY):
+            typ = name
+        else:
+            ns = VmomiSupport.XMLNS_XSD if prefix == 'xsd' else 'urn:vim25'
+            try:
+                typ = VmomiSupport.GetWsdlType(ns, name)
+            except KeyError:
+                typ = str
+        _TYPE_CACHE[xsi_type] = typ
+    return typ
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _decode(elem, typ):
+    """Decodes elem of type typ into python primitives
+
+    Mirrors common.to_primitive: data objects become dicts, managed object
+    references their moid, enums and datetimes the text the server sent.
+    """
+    typ = _xsi_type(elem) or typ
+
+    if typ == _MOREF:
+        return intern_moid(elem.text)
+    if typ == _MOREF_ARRAY:
+        return [intern_moid(child.text) for child in elem]
+    if isinstance(typ, type):
+        if issubclass(typ, list):
+            return [_decode(child, typ.Item) for child in elem]
+        if issubclass(typ, VmomiSupport.ManagedObject):
+            return intern_moid(elem.text)
+        if issubclass(typ, VmomiSupport.DataObject):
+            result = {}
+            for child in elem:
+                name = _local_name(child.tag)
+                if name in ('dynamicType', 'dynamicProperty'):
+                    continue
+                try:
+                    prop_type = typ._GetPropertyInfo(name).type
+                except AttributeError:
+                    # a property newer than the bindings, keep it as text
+                    result[name] = child.text
+                    continue
+                if issubclass(prop_type, list):
+                    result.setdefault(name, []).append(
+                        _decode(child, prop_type.Item))
+                else:
+                    result[name] = _decode(child, prop_type)
+            return result
+        if issubclass(typ, bool):
+            return elem.text == 'true'
+        if issubclass(typ, int):
+            return int(elem.text)
+        if issubclass(typ, float):
+            return float(elem.text)
+    return elem.text if elem.text is not None else ''
+
+
+def _object_content(elem, stub):
+    """Returns the (managed object, properties) pair of an ObjectContent"""
+    moref = None
+    props = {}
+    for child in elem:
+        name = _local_name(child.tag)
+        if name == 'obj':
+            moref = getattr(vim, child.get('type'))(child.text, stub)
+        elif name == 'propSet':
+            path = None
+            value = None
+            for prop in child:
+                if _local_name(prop.tag) == 'name':
+                    path = prop.text
+                else:
+                    value = _decode(prop, object)
+            props[path] = value
+    return moref, props
+
+
+class RawPropertyCollector(object):
+    """PropertyCollector decoding results straight into python primitives
+
+    Requests are serialized by pyVmomi, but RetrievePropertiesEx and
+    ContinueRetrievePropertiesEx responses are parsed incrementally with
+    iterparse: each ObjectContent is decoded into a (managed object,
+    {path: primitive}) pair and its XML is dropped right away, no pyVmomi
+    data object is ever built. Faults are still deserialized by pyVmomi
+    and raised as usual.
+    """
+
+    def __init__(self, si):
+        self._pc = si.content.propertyCollector
+        # SmartConnect wraps the SOAP stub in a SessionOrientedStub
+        self._stub = getattr(si._stub, 'soapStub', si._stub)
+        self._ref_stub = si._stub
+
+    def RetrievePropertiesEx(self, specSet, options):
+        return self._invoke('RetrievePropertiesEx', [specSet, options])
+
+    def ContinueRetrievePropertiesEx(self, token):
+        return self._invoke('ContinueRetrievePropertiesEx', [token])
+
+    def CancelRetrievePropertiesEx(self, token):
+        self._pc.CancelRetrievePropertiesEx(token)
+
+    def _invoke(self, method, args):
+        stub = self._stub
+        info = vmodl.query.PropertyCollector._GetMethodInfo(method)
+        request = stub.SerializeRequest(self._pc, info, args)
+        headers = {'Cookie': stub.cookie,
+                   'SOAPAction': stub.versionId,
+                   'Content-Type': 'text/xml; charset=%s' %
+                                   SoapAdapter.XML_ENCODING}
+
+        conn = stub.GetConnection()
+        try:
+            conn.request('POST', stub.path, request, headers)
+            resp = conn.getresponse()
+            if resp.status == 200:
+                result = self._parse(resp)
+            elif resp.status == 500:
+                fault = SoapAdapter.SoapResponseDeserializer(
+                    stub).Deserialize(resp.read(), info.result)
+                stub.ReturnConnection(conn)
+                raise fault
+            else:
+                raise http_client.HTTPException(
+                    '%s %s' % (resp.status, resp.reason))
+        except vmodl.MethodFault:
+            raise
+        except Exception:
+            stub.DropConnections()
+            raise
+        resp.read()
+        stub.ReturnConnection(conn)
+        return result
+
+    def _parse(self, resp):
+        objects = []
+        token = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(resp, ('start', 'end')):
+            if elem.tag == _OBJECTS:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                objects.append(_object_content(elem, self._ref_stub))
+                elem.clear()
+            elif elem.tag == _TOKEN and event == 'end' and not depth:
+                # a property value may hold a 'token' as well
+                token = elem.text
+        if not objects and token is None:
+            return None
+        return RawRetrieveResult(objects, token)
@@ -0,0 +1,155 @@
+# Copyright 2020 Soil, Inc.
+
+import threading
+
+from pyVmomi import vim
+from six.moves import intern
+
+from soil.api.utils.vmware.index import is_instance_type
+
+
+def intern_moid(moid):
+    """Returns the interned moid so every reference to it shares one str"""
+    return intern(str(moid)) if moid is not None else None
+
+
+class Record(object):
+    """Compact property record of one managed object
+
+    Subclasses built by record_class hold one slot per property path of
+    their managed object type and no per-instance dict. A record reads
+    like the {path: value} dict collected for the object, so get_field
+    and summary_contribution work on it unchanged; unset paths read as
+    missing.
+    """
+
+    __slots__ = ('moid',)
+
+    type_name = None
+    paths = ()
+    _slot_of = {}
+
+    def __init__(self, moid, props=None):
+        self.moid = intern_moid(moid)
+        for slot in self._slot_of.values():
+            setattr(self, slot, None)
+        if props:
+            self.update(props)
+
+    def __contains__(self, path):
+        slot = self._slot_of.get(path)
+        return slot is not None and getattr(self, slot) is not None
+
+    def __getitem__(self, path):
+        slot = self._slot_of.get(path)
+        value = getattr(self, slot) if slot is not None else None
+        if value is None:
+            raise KeyError(path)
+        return value
+
+    def __setitem__(self, path, value):
+        slot = self._slot_of.get(path)
+        if slot is None:
+            raise KeyError(path)
+        setattr(self, slot, value)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, path, default=None):
+        slot = self._slot_of.get(path)
+        value = getattr(self, slot) if slot is not None else None
+        return default if value is None else value
+
+    def pop(self, path, default=None):
+        value = self.get(path, default)
+        if path in self._slot_of:
+            setattr(self, self._slot_of[path], None)
+        return value
+
+    def update(self, props):
+        for path, value in props.items():
+            slot = self._slot_of.get(path)
+            if slot is not None:
+                setattr(self, slot, value)
+
+    def keys(self):
+        return [path for path in self.paths
+                if getattr(self, self._slot_of[path]) is not None]
+
+    def items(self):
+        return [(path, self[path]) for path in self.keys()]
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.moid,
+                               dict(self.items()))
+
+
+_RECORD_CLASSES = {}
+_RECORD_CLASSES_LOCK = threading.Lock()
+
+
+def record_class(type_name, paths):
+    """Returns the Record subclass of type_name holding paths
+
+    Classes are built once per (type, paths) and shared by every
+    collection, slots are named after the position of the path so any
+    property path can be held.
+    """
+    paths = tuple(sorted(set(paths)))
+    key = (type_name, paths)
+    cls = _RECORD_CLASSES.get(key)
+    if cls is None:
+        with _RECORD_CLASSES_LOCK:
+            cls = _RECORD_CLASSES.get(key)
+            if cls is None:
+                slot_of = dict((path, '_p%d' % i)
+                               for i, path in enumerate(paths))
+                cls = type(str('%sRecord' % type_name), (Record,), {
+                    '__slots__': tuple(slot_of.values()),
+                    'type_name': type_name,
+                    'paths': paths,
+                    '_slot_of': slot_of,
+                })
+                _RECORD_CLASSES[key] = cls
+    return cls
+
+
+class RecordSet(dict):
+    """Compact result of a property collection, moid -> Record
+
+    Keys are interned moids instead of managed object references, values
+    the records of the objects, which hold primitives only, so the result
+    keeps no pyVmomi object alive. The 'content' key holds the service
+    content like in the result of vCenterPropertyCollector._collect.
+    """
+
+    def __init__(self, properties):
+        """:param properties: type name -> property paths, as collected"""
+        super(RecordSet, self).__init__()
+        self._classes = dict(
+            (type_name, record_class(type_name, paths))
+            for type_name, paths in properties.items())
+
+    def add(self, type_name, moid, props):
+        cls = self._classes.get(type_name)
+        if cls is None:
+            # a subtype of collected types, e.g. ClusterComputeResource
+            paths = set()
+            for parent in list(self._classes.values()):
+                if is_instance_type(type_name,
+                                    [getattr(vim, parent.type_name)]):
+                    paths.update(parent.paths)
+            cls = self._classes[type_name] = record_class(type_name, paths)
+        record = cls(moid, props)
+        self[record.moid] = record
+        return record
+
+    def by_type(self, type_name):
+        """Yields the records of the objects of type_name"""
+        for moid, record in self.items():
+            if isinstance(record, Record) and record.type_name == type_name:
+                yield record
@@ -5,6 +5,85 @@
 from pyVmomi import vim, vmodl
 
 
+# Edges of the inventory tree a TraversalSpec can follow. Each edge is
+# (name, managed object type, property path, types reachable through the
+# edge, names of the edges to follow next).
+_TRAVERSAL_EDGES = (
+    ('visitFolders', 'Folder', 'childEntity', ('ManagedEntity',),
+     ('visitFolders', 'dcToHf', 'dcToVmf', 'dcToNet', 'dcToDs', 'crToH',
+      'crToRp', 'vappToVm')),
+    ('dcToHf', 'Datacenter', 'hostFolder',
+     ('Folder', 'ComputeResource', 'HostSystem', 'ResourcePool'),
+     ('visitFolders',)),
+    ('dcToVmf', 'Datacenter', 'vmFolder',
+     ('Folder', 'VirtualMachine', 'VirtualApp'),
+     ('visitFolders',)),
+    ('dcToNet', 'Datacenter', 'networkFolder',
+     ('Folder', 'Network', 'DistributedVirtualSwitch'),
+     ('visitFolders',)),
+    ('dcToDs', 'Datacenter', 'datastore', ('Datastore',), ()),
+    ('crToH', 'ComputeResource', 'host', ('HostSystem',), ()),
+    ('crToRp', 'ComputeResource', 'resourcePool', ('ResourcePool',),
+     ('rpToRp',)),
+    ('rpToRp', 'ResourcePool', 'resourcePool', ('ResourcePool',),
+     ('rpToRp',)),
+    ('vappToVm', 'VirtualApp', 'vm', ('VirtualMachine',), ()),
+)
+
+_TRAVERSAL_CACHE = {}
+
+
+def _reaches(edge_types, object_types):
+    for edge_type in edge_types:
+        edge_type = getattr(vim, edge_type)
+        for motype in object_types:
+            if issubclass(edge_type, motype) or issubclass(motype, edge_type):
+                return True
+    return False
+
+
+def build_traversal(object_types=None):
+    """
+    Builds the minimal traversal spec that reaches the managed objects of
+    object_types from the root folder.
+
+    Only the edges of the inventory tree leading to one of the requested
+    types are followed, e.g. a Datastore-only collection never walks host
+    folders, resource pools or virtual machines. The specs are compiled
+    once per set of types and shared by all callers afterwards, so they
+    must not be modified.
+
+    :param object_types: managed object types or their names, all the
+        managed entities when empty
+    """
+    object_types = [getattr(vim, motype) if isinstance(motype, str)
+                    else motype for motype in object_types or ()]
+    if not object_types:
+        object_types = [vim.ManagedEntity]
+    key = frozenset(motype._wsdlName for motype in object_types)
+    traversal = _TRAVERSAL_CACHE.get(key)
+    if traversal is not None:
+        return traversal
+
+    TraversalSpec = vmodl.query.PropertyCollector.TraversalSpec
+    SelectionSpec = vmodl.query.PropertyCollector.SelectionSpec
+
+    edges = [edge for edge in _TRAVERSAL_EDGES
+             if edge[0] == 'visitFolders' or _reaches(edge[3], object_types)]
+    names = set(edge[0] for edge in edges)
+    traversal = []
+    for name, motype, path, _types, selects in edges:
+        spec = TraversalSpec(name=name, type=getattr(vim, motype),
+                             path=path, skip=False)
+        spec.selectSet = [SelectionSpec(name=select) for select in selects
+                          if select in names]
+        traversal.append(spec)
+
+    traversal = SelectionSpec.Array(traversal)
+    _TRAVERSAL_CACHE[key] = traversal
+    return traversal
+
+
 def build_full_traversal():
     """
     Builds a traversal spec that will recurse through all objects .. or at
@@ -12,114 +91,24 @@ def build_full_traversal():
 
     See com.vmware.apputils.vim25.ServiceUtil.buildFullTraversal in the java
     API. Extended bu Sebastian Tello's examples from pysphere to reach networks
-    and datastores.
+    and datastores. Kept for compatibility, it is the compiled traversal of
+    all the managed entities, see build_traversal.
     """
+    return build_traversal()
 
-    TraversalSpec = vmodl.query.PropertyCollector.TraversalSpec
-    SelectionSpec = vmodl.query.PropertyCollector.SelectionSpec
 
-    # Recurse through all resourcepools
-
-    rpToRp = TraversalSpec(name='rpToRp', type=vim.ResourcePool,
-                           path="resourcePool", skip=False)
-
-    rpToRp.selectSet.extend
-    (
-        (
-            SelectionSpec(name="rpToRp"),
-            SelectionSpec(name="rpToVm"),
-        )
-    )
-
-    rpToVm = TraversalSpec(name='rpToVm', type=vim.ResourcePool,
-                           path="vm", skip=False)
-
-    # Traversal through resourcepool branch
-    crToRp = TraversalSpec(name='crToRp', type=vim.ComputeResource,
-                           path='resourcePool', skip=False)
-    crToRp.selectSet.extend
-    (
-        (
-            SelectionSpec(name='rpToRp'),
-            SelectionSpec(name='rpToVm'),
-        )
-    )
-
-    # Traversal through host branch
-    crToH = TraversalSpec(name='crToH', type=vim.ComputeResource,
-                          host='host', skip=False)
-
-    # Traversal through hostFolder branch
-    dcToHf = TraversalSpec(name='dcToHf', type=vim.Datacenter,
-                           path='hostFolder', skip=False)
-    dcToHf.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-        )
-    )
-
-    # Traversal through vmFolder branch
-    dcToVmf = TraversalSpec(name='dcToVmf', type=vim.Datacenter,
-                            path='vmFolder', skip=False)
-    dcToVmf.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-        )
-    )
-
-    # Traversal through network folder branch
-    dcToNet = TraversalSpec(name='dcToNet', type=vim.Datacenter,
-                            path='networkFolder', skip=False)
-    dcToNet.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-        )
-    )
-
-    # Traversal through datastore branch
-    dcToDs = TraversalSpec(name='dcToDs', type=vim.Datacenter,
-                           path='datastore', skip=False)
-    dcToDs.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-        )
-    )
-
-    # Resource through all hosts
-    hToVm = TraversalSpec(name='hToVm', type=vim.HostSystem,
-                          path='vm', skip=False)
-    hToVm.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-        )
-    )
-
-    # Recurse through the folders
-    visitFolders = TraversalSpec(name='visitFolders', type=vim.Folder,
-                                 path='childEntity', skip=False)
-    visitFolders.selectSet.extend
-    (
-        (
-            SelectionSpec(name='visitFolders'),
-            SelectionSpec(name='dcToHf'),
-            SelectionSpec(name='dcToVmf'),
-            SelectionSpec(name='dcToNet'),
-            SelectionSpec(name='crToH'),
-            SelectionSpec(name='crToRp'),
-            SelectionSpec(name='dcToDs'),
-            SelectionSpec(name='hToVm'),
-            SelectionSpec(name='rpToVm'),
-        )
-    )
-
-    fullTraversal = SelectionSpec.Array(
-        (visitFolders, dcToHf, dcToVmf, dcToNet, crToH, crToRp, dcToDs, rpToRp,
-         hToVm, rpToVm)
-    )
-
-    return fullTraversal
+def build_view_traversal():
+    """
+    Builds the traversal spec from a ContainerView to the objects in its
+    view, to be used with an ObjectSpec on the view itself with skip=True.
+    """
+    traversal = _TRAVERSAL_CACHE.get('view')
+    if traversal is None:
+        TraversalSpec = vmodl.query.PropertyCollector.TraversalSpec
+        SelectionSpec = vmodl.query.PropertyCollector.SelectionSpec
+        traversal = SelectionSpec.Array([
+            TraversalSpec(name='traverseView', type=vim.view.ContainerView,
+                          path='view', skip=False)
+        ])
+        _TRAVERSAL_CACHE['view'] = traversal
+    return traversal
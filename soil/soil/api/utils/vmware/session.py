@@ -0,0 +1,115 @@
+# Copyright 2020 Soil, Inc.
+
+import os
+import socket
+import threading
+import time
+
+from oslo_log import log as logging
+
+import soil.conf
+from soil.db import api as db_api
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+_LEASE_POLL_INTERVAL = 0.5
+
+
+def _owner():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+class SharedSessionStore(object):
+    """vCenter session cookies shared across processes
+
+    The vmware_soap_session cookie of every vCenter is kept in the
+    vcenter_session table, so soil-api workers and soil-engine attach to
+    one authenticated session instead of logging in once per process.
+
+    A dead session is replaced under a lease: the first process which finds
+    the published cookie dead takes the lease and logs in, the others wait
+    for the new cookie generation and attach to it. The lease is owned by a
+    process, so within a process the green threads of a vCenter go through
+    it one at a time, the later ones attach to the cookie of the first.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, session_key):
+        with self._locks_lock:
+            lock = self._locks.get(session_key)
+            if lock is None:
+                lock = self._locks[session_key] = threading.Lock()
+            return lock
+
+    def login(self, key, attach, login):
+        """Returns a service instance for key, and whether it is shared
+
+        The service instance is shared when its session is the one
+        published in the store, and must then not be logged out.
+
+        :param key: the (host, port, user) tuple of the vCenter
+        :param attach: callable taking a cookie, returns a service instance
+            using that cookie or None when the session behind it is dead
+        :param login: callable doing a fresh login, returns a service
+            instance or None
+        :returns: a (service instance, shared) tuple
+        """
+        session_key = '%s:%s:%s' % key
+        with self._lock(session_key):
+            return self._login(key, session_key, attach, login)
+
+    def _login(self, key, session_key, attach, login):
+        owner = _owner()
+        deadline = time.time() + CONF.vmware.session_lease_timeout
+        dead_generation = None
+
+        while True:
+            try:
+                record = db_api.vcenter_session_get(session_key)
+            except Exception:
+                LOG.exception("Could not read shared session of vCenter "
+                              "%s, logging in directly", key[0])
+                return login(), False
+
+            if (record is not None and record.cookie and
+                    record.generation != dead_generation):
+                si = attach(record.cookie)
+                if si is not None:
+                    return si, True
+                dead_generation = record.generation
+
+            if db_api.vcenter_session_acquire_lease(
+                    session_key, owner, CONF.vmware.session_lease_timeout):
+                si = None
+                published = None
+                try:
+                    si = login()
+                finally:
+                    if si is not None:
+                        published = db_api.vcenter_session_update(
+                            session_key, owner, si._stub.cookie)
+                    else:
+                        db_api.vcenter_session_release_lease(session_key,
+                                                             owner)
+                # the lease may have been taken over meanwhile
+                return si, published is not None
+
+            if time.time() > deadline:
+                LOG.warning("Timed out waiting for the shared session of "
+                            "vCenter %s, logging in directly", key[0])
+                return login(), False
+
+            # another process is logging in, wait for its cookie
+            time.sleep(_LEASE_POLL_INTERVAL)
+
+
+_SESSION_STORE = SharedSessionStore()
+
+
+def get_session_store():
+    return _SESSION_STORE
@@ -9,9 +9,36 @@ This code has been released under the terms of the Apache 2 licenses
 http://www.apache.org/licenses/LICENSE-2.0.html
 Helper module for task operations.
 """
+import threading
+import time
+
+import eventlet
+from eventlet import event
+from oslo_log import log as logging
 from pyVmomi import vim
 from pyVmomi import vmodl
 
+import soil.conf
+from soil.api.utils.vmware.bulkhead import is_unavailable_error
+from soil.api.utils.vmware.exception import vCenterNotConnect
+
+
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
+
+# task info properties followed by the task watchers
+_TASK_PROPERTIES = ['info.state', 'info.result', 'info.error']
+
+# seconds after which a task the watcher has not seen is read directly
+_UNSEEN_TASK_POLL = 10
+
+# seconds a long poll of a task watcher waits for changes, and a watcher
+# without pending tasks waits before it stops
+_WAIT_SECONDS = 30
+
+# seconds to wait before reconnecting a failed watcher
+_RETRY_INTERVAL = 5
+
 
 def wait_for_tasks(service_instance, tasks):
     """Given the service instance si and tasks, it returns after all the
@@ -61,3 +88,213 @@ def wait_for_tasks(service_instance, tasks):
     finally:
         if pcfilter:
             pcfilter.Destroy()
+
+
+class TaskFuture(object):
+    """The outcome of a vSphere task followed by a TaskWatcher"""
+
+    def __init__(self, task):
+        self.task = task
+        self.moid = task._moId
+        self.registered_at = time.time()
+        self._event = event.Event()
+
+    def done(self):
+        return self._event.ready()
+
+    def wait(self, timeout=None):
+        """Returns the result of the task, raises its error if it failed
+
+        :param timeout: seconds to wait at most, eventlet.Timeout is raised
+            when the task is still running then
+        """
+        with eventlet.Timeout(timeout):
+            state, value = self._event.wait()
+        if state == vim.TaskInfo.State.error:
+            raise value
+        return value
+
+    def _resolve(self, state, value):
+        if not self._event.ready():
+            self._event.send((state, value))
+
+
+class TaskWatcher(object):
+    """Follows the tasks of one vCenter with a single long poll
+
+    One private PropertyCollector with one filter, rooted at the
+    TaskManager and traversing its recentTask property, reports the state
+    of every task of the session, so any number of tasks in flight costs a
+    single WaitForUpdatesEx loop instead of one polling loop per task.
+    Callers register tasks with watch() and get a TaskFuture back; the
+    loop resolves the futures as the completions arrive and stops when no
+    task has been pending for a while.
+    """
+
+    def __init__(self, host, connect):
+        """
+        :param host: the address of the vCenter, for logging
+        :param connect: callable returning a connected vCenterBase
+        """
+        self._host = host
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._states = {}
+        self._thread = None
+
+    def watch(self, task):
+        """Returns a TaskFuture resolved when task completes"""
+        future = TaskFuture(task)
+        with self._lock:
+            self._pending.setdefault(future.moid, []).append(future)
+            known = self._states.get(future.moid)
+            if self._thread is None:
+                self._thread = eventlet.spawn(self._run)
+        if known is not None:
+            self._resolve(future.moid, known)
+        return future
+
+    def _run(self):
+        try:
+            while self._pending:
+                vc = None
+                try:
+                    vc = self._connect()
+                    if vc.si is None:
+                        raise vCenterNotConnect()
+                    self._watch(vc)
+                except Exception as e:
+                    LOG.warning("Task watcher of vCenter %s failed: %s",
+                                self._host, e)
+                    if vc is not None:
+                        vc.disconnect(discard=True,
+                                      failed=is_unavailable_error(e))
+                    eventlet.sleep(_RETRY_INTERVAL)
+                else:
+                    vc.disconnect()
+        finally:
+            with self._lock:
+                # restarted when a task was registered as the loop ended
+                self._thread = (eventlet.spawn(self._run) if self._pending
+                                else None)
+
+    def _filter_spec(self, content):
+        PC = vmodl.query.PropertyCollector
+        recent_task = PC.TraversalSpec(name='recentTask',
+                                       type=vim.TaskManager,
+                                       path='recentTask', skip=False)
+        return PC.FilterSpec(
+            objectSet=[PC.ObjectSpec(obj=content.taskManager, skip=True,
+                                     selectSet=[recent_task])],
+            propSet=[PC.PropertySpec(type=vim.Task, all=False,
+                                     pathSet=_TASK_PROPERTIES)])
+
+    def _watch(self, vc):
+        content = vc.si.content
+        # NOTE: a private collector keeps our filter and version apart
+        # from other users of the same (possibly shared) session
+        pc = content.propertyCollector.CreatePropertyCollector()
+        try:
+            pc.CreateFilter(self._filter_spec(content), partialUpdates=True)
+            version = ''
+            idle_since = None
+            while True:
+                options = vmodl.query.PropertyCollector.WaitOptions(
+                    maxWaitSeconds=self._max_wait())
+                update = pc.WaitForUpdatesEx(version, options)
+                if update is not None:
+                    version = update.version
+                    self._apply(update)
+                self._poll_unseen(vc)
+
+                if self._pending:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.time()
+                elif time.time() - idle_since > _WAIT_SECONDS:
+                    return
+        finally:
+            try:
+                pc.Destroy()
+            except Exception:
+                pass
+
+    def _max_wait(self):
+        # tasks not seen yet are read once _UNSEEN_TASK_POLL old, the long
+        # poll has to return in time for it
+        with self._lock:
+            unseen = any(moid not in self._states for moid in self._pending)
+        return _UNSEEN_TASK_POLL if unseen else _WAIT_SECONDS
+
+    def _apply(self, update):
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                moid = obj_set.obj._moId
+                if obj_set.kind == 'leave':
+                    self._states.pop(moid, None)
+                    continue
+                state = self._states.setdefault(moid, {})
+                for change in obj_set.changeSet:
+                    if change.op in ('remove', 'indirectRemove'):
+                        state.pop(change.name, None)
+                    else:
+                        state[change.name] = change.val
+                self._resolve(moid, state)
+
+    def _poll_unseen(self, vc):
+        """Reads the tasks not reported by recentTask in one request
+
+        Covers tasks which completed and left recentTask before they were
+        registered, or were started by another session.
+        """
+        now = time.time()
+        with self._lock:
+            unseen = [futures[0].task
+                      for moid, futures in self._pending.items()
+                      if moid not in self._states and
+                      now - futures[0].registered_at > _UNSEEN_TASK_POLL]
+        if not unseen:
+            return
+
+        props = [(vim.Task, _TASK_PROPERTIES)]
+        try:
+            for obj in vc.iter_object_property(unseen, props):
+                state = dict((prop.name, prop.val) for prop in obj.propSet)
+                self._resolve(obj.obj._moId, state)
+        except vmodl.fault.ManagedObjectNotFound as e:
+            # the task expired on the server, it is failed with the fault
+            self._resolve(e.obj._moId, {'info.state':
+                                        vim.TaskInfo.State.error,
+                                        'info.error': e})
+
+    def _resolve(self, moid, state):
+        task_state = state.get('info.state')
+        if task_state == vim.TaskInfo.State.success:
+            value = state.get('info.result')
+        elif task_state == vim.TaskInfo.State.error:
+            value = state.get('info.error')
+        else:
+            return
+        with self._lock:
+            futures = self._pending.pop(moid, ())
+        for future in futures:
+            future._resolve(task_state, value)
+
+
+_WATCHERS = {}
+_WATCHERS_LOCK = threading.Lock()
+
+
+def get_task_watcher(key, connect):
+    """Returns the task watcher of the vCenter identified by key
+
+    :param key: the (host, port, user) tuple of the vCenter
+    :param connect: callable returning a connected vCenterBase, used when
+        the watcher has to (re)connect
+    """
+    with _WATCHERS_LOCK:
+        watcher = _WATCHERS.get(key)
+        if watcher is None:
+            watcher = _WATCHERS[key] = TaskWatcher(key[0], connect)
+        return watcher
@@ -66,6 +66,37 @@ ROUTE_LIST = (
     }),
     ('/vmware/vcenter', {
         'GET': [vcenter_controller, 'index']
+    }),
+    ('/vmware/vcenter/overview', {
+        'GET': [vcenter_controller, 'overview']
+    }),
+    ('/vmware/vcenter/lookup', {
+        'GET': [vcenter_controller, 'lookup']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/changes', {
+        'GET': [vcenter_controller, 'changes']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/query', {
+        'GET': [vcenter_controller, 'query']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/metrics/{moid}', {
+        'GET': [vcenter_controller, 'metrics']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/datastore/{datastore}/file', {
+        'GET': [vcenter_controller, 'download'],
+        'PUT': [vcenter_controller, 'upload'],
+    }),
+    ('/vmware/vcenter/{vcenter_id}/export', {
+        'POST': [vcenter_controller, 'export']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/export/{job_id}', {
+        'GET': [vcenter_controller, 'show_export']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/power', {
+        'POST': [vcenter_controller, 'power']
+    }),
+    ('/vmware/vcenter/{vcenter_id}/clone', {
+        'POST': [vcenter_controller, 'clone']
     })
 )
 
@@ -2,16 +2,30 @@
 
 import uuid
 import webob
+import webob.exc
 import six
 from six.moves import http_client
 
+import soil.conf
 from soil.api.server import wsgi
+from soil.api.utils.vmware import aggregate
+from soil.api.utils.vmware import clone
+from soil.api.utils.vmware import datastore as ds_utils
+from soil.api.utils.vmware import export
+from soil.api.utils.vmware.index import GuestIndex
+from soil.api.utils.vmware import perf
+from soil.api.utils.vmware import power
+from soil.api.utils.vmware import query as query_utils
 from soil.api.utils.vmware.base import vCenterSmartConnect
 from soil.api.views.vmware import vcenter as vcenter_view
 from soil.api.v1.license.rsa_license import check_provider_nums
 from soil.db import api as db_api
 
 
+CONF = soil.conf.CONF
+CONF.import_opt('use_rpc', 'soil.service')
+
+
 class vCenterController(wsgi.Controller):
     """The vCenter API controller for the Soil API"""
 
@@ -26,6 +40,40 @@ class vCenterController(wsgi.Controller):
     def show(self, req, vcenter_id):
         return self._vcenter_get_by_uuid(req, vcenter_id)
 
+    def changes(self, req, vcenter_id):
+        return self._vcenter_changes(req, vcenter_id)
+
+    def overview(self, req):
+        return self._vcenter_overview(req)
+
+    def lookup(self, req):
+        return self._vcenter_lookup(req)
+
+    def query(self, req, vcenter_id):
+        return self._vcenter_query(req, vcenter_id)
+
+    def metrics(self, req, vcenter_id, moid):
+        return self._vcenter_metrics(req, vcenter_id, moid)
+
+    def download(self, req, vcenter_id, datastore):
+        return self._vcenter_download(req, vcenter_id, datastore)
+
+    def upload(self, req, vcenter_id, datastore):
+        return self._vcenter_upload(req, vcenter_id, datastore)
+
+    @wsgi.response(202)
+    def export(self, req, vcenter_id, body):
+        return self._vcenter_export(req, vcenter_id, body)
+
+    def show_export(self, req, vcenter_id, job_id):
+        return self._vcenter_show_export(req, vcenter_id, job_id)
+
+    def power(self, req, vcenter_id, body):
+        return self._vcenter_power(req, vcenter_id, body)
+
+    def clone(self, req, vcenter_id, body):
+        return self._vcenter_clone(req, vcenter_id, body)
+
     def _vcenter_get(self, req):
         vcenters = db_api.vcenter_get_all()
         result = self._view_builder._list(req, vcenters)
@@ -35,3 +83,210 @@ class vCenterController(wsgi.Controller):
         vcenter = db_api.vcenter_get_by_uuid(uuid)
         result = self._view_builder._detail(req, vcenter)
         return result
+
+    def _vcenter_changes(self, req, uuid):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        since = req.GET.get('since')
+        result = self._view_builder._changes(req, vcenter, since)
+        return result
+
+    def _vcenter_overview(self, req):
+        group_by = req.GET.get('group_by') or None
+        if group_by is not None and group_by not in aggregate.GROUP_BY:
+            msg = ("Invalid group_by %s, must be one of %s." %
+                   (group_by, ', '.join(aggregate.GROUP_BY)))
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        result = self._view_builder._overview(req, group_by)
+        return result
+
+    def _vcenter_query(self, req, uuid):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+
+        try:
+            query = query_utils.build_query(req.GET.get('type'), req.GET)
+        except ValueError as e:
+            raise webob.exc.HTTPBadRequest(explanation=six.text_type(e))
+        limit = req.GET.get('limit') or CONF.vmware.query_default_limit
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            msg = "limit must be a positive integer."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        limit = min(limit, CONF.vmware.query_max_limit)
+        return self._view_builder._query(req, vcenter, query, limit)
+
+    def _vcenter_metrics(self, req, uuid, moid):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        # NOTE: the performance collectors run in soil-engine only, API
+        # workers with a local engine manager never have the series
+        if not CONF.use_rpc:
+            msg = "Metrics are collected by soil-engine, set use_rpc."
+            raise webob.exc.HTTPConflict(explanation=msg)
+
+        metrics = req.GET.getall('metric') or None
+        for metric in metrics or []:
+            if metric not in perf.METRICS:
+                msg = ("Invalid metric %s, must be one of %s." %
+                       (metric, ', '.join(sorted(perf.METRICS))))
+                raise webob.exc.HTTPBadRequest(explanation=msg)
+        params = {}
+        for key in ('start', 'end', 'step'):
+            value = req.GET.get(key)
+            if value is None:
+                continue
+            try:
+                params[key] = int(value)
+            except ValueError:
+                msg = "%s must be an integer of seconds." % key
+                raise webob.exc.HTTPBadRequest(explanation=msg)
+        if params.get('step') is not None and params['step'] <= 0:
+            msg = "step must be a positive integer of seconds."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        result = self._view_builder._metrics(req, vcenter, moid, metrics,
+                                             **params)
+        collector = result['metrics'].get('collector') or {}
+        if collector.get('state') == 'disabled':
+            msg = "Metrics are not collected, perf_interval is 0."
+            raise webob.exc.HTTPConflict(explanation=msg)
+        if result['metrics'].get('metrics') is None:
+            msg = "No metrics are collected for %s." % moid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        return result
+
+    def _datastore_file(self, req, uuid, datastore):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        datacenter = req.GET.get('datacenter')
+        path = req.GET.get('path')
+        if not datacenter or not path:
+            msg = ("datacenter and path are required, the datacenter path "
+                   "and the file path in the datastore.")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        return ds_utils.DatastoreFile(vcenter, datacenter, datastore, path)
+
+    def _vcenter_download(self, req, uuid, datastore):
+        ds_file = self._datastore_file(req, uuid, datastore)
+        range_header = req.headers.get('Range')
+        if range_header and not range_header.startswith('bytes='):
+            msg = "Only byte ranges are supported."
+            raise webob.exc.HTTPRequestRangeNotSatisfiable(explanation=msg)
+        return self._view_builder._download(req, ds_file, range_header)
+
+    def _vcenter_upload(self, req, uuid, datastore):
+        ds_file = self._datastore_file(req, uuid, datastore)
+        if req.content_length is None:
+            msg = "Content-Length is required to upload a datastore file."
+            raise webob.exc.HTTPLengthRequired(explanation=msg)
+        # NOTE: read from the raw input, never buffered by webob
+        return self._view_builder._upload(req, ds_file, req.body_file_raw,
+                                          req.content_length)
+
+    def _vcenter_export(self, req, uuid, body):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+
+        export_ref = (body or {}).get('export') or {}
+        vm = export_ref.get('vm')
+        fmt = export_ref.get('format') or 'ovf'
+        if not vm or not isinstance(vm, six.string_types):
+            msg = "vm must be the id of a virtual machine."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        if fmt not in export.EXPORT_FORMATS:
+            msg = ("Invalid format %s, must be one of %s." %
+                   (fmt, ', '.join(export.EXPORT_FORMATS)))
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        return self._view_builder._export(req, vcenter, vm, fmt)
+
+    def _vcenter_show_export(self, req, uuid, job_id):
+        result = self._view_builder._show_export(req, job_id)
+        if result['export'] is None or result['export']['vcenter'] != uuid:
+            msg = "Export job %s could not be found." % job_id
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        return result
+
+    def _vcenter_lookup(self, req):
+        queries = [(kind, req.GET[kind]) for kind in GuestIndex.KINDS
+                   if req.GET.get(kind)]
+        if len(queries) != 1:
+            msg = ("Exactly one of %s must be looked up." %
+                   ', '.join(GuestIndex.KINDS))
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        kind, value = queries[0]
+        return self._view_builder._lookup(req, kind, value)
+
+    def _vcenter_power(self, req, uuid, body):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+
+        power_ref = (body or {}).get('power') or {}
+        action = power_ref.get('action')
+        vms = power_ref.get('vms')
+        if action not in power.POWER_ACTIONS:
+            msg = ("Invalid power action %s, must be one of %s." %
+                   (action, ', '.join(sorted(power.POWER_ACTIONS))))
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        if not vms or not isinstance(vms, list) or not all(
+                isinstance(vm, six.string_types) for vm in vms):
+            msg = "vms must be a non empty list of virtual machine ids."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        context = req.environ.get('soil.context')
+        operator = getattr(context, 'user_id', None)
+        operation = power.BulkPowerOperation(vcenter, action, vms,
+                                             operator=operator)
+        return self._view_builder._power(req, operation)
+
+    def _vcenter_clone(self, req, uuid, body):
+        vcenter = db_api.vcenter_get_by_uuid(uuid)
+        if vcenter is None:
+            msg = "vCenter %s could not be found." % uuid
+            raise webob.exc.HTTPNotFound(explanation=msg)
+
+        clone_ref = (body or {}).get('clone') or {}
+        template = clone_ref.get('template')
+        if not template or not isinstance(template, six.string_types):
+            msg = "template must be the id of a virtual machine template."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        for key in ('names', 'hosts', 'datastores'):
+            value = clone_ref.get(key)
+            if (value is None and key != 'names') or (
+                    value and isinstance(value, list) and all(
+                        isinstance(item, six.string_types)
+                        for item in value)):
+                continue
+            msg = "%s must be a non empty list of ids or names." % key
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        linked = clone_ref.get('linked')
+        if linked not in (None, True, False):
+            msg = "linked must be a boolean."
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        context = req.environ.get('soil.context')
+        pipeline = clone.ClonePipeline(
+            vcenter, template, clone_ref['names'],
+            hosts=clone_ref.get('hosts'),
+            datastores=clone_ref.get('datastores'),
+            folder=clone_ref.get('folder'),
+            customization=clone_ref.get('customization'),
+            linked=linked,
+            power_on=bool(clone_ref.get('power_on')),
+            operator=getattr(context, 'user_id', None))
+        return self._view_builder._clone(req, pipeline)
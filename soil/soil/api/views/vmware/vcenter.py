@@ -1,23 +1,54 @@
 # Copyright 2020 Soil, Inc.
 
+import time
+
 import eventlet
-from pyVmomi import vim
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+import webob
+
+import soil.conf
+from soil.api.utils.vmware import aggregate
+from soil.api.utils.vmware import inventory
+from soil.api.utils.vmware.base import vCenterPropertyCollector
+from soil.api.utils.vmware.bulkhead import get_bulkhead
+from soil.api.utils.vmware.common import plan_propspec
+from soil.api.utils.vmware.common import sizeof_fmt
+from soil.engine import api as engine_api
+
 
-from soil.api.utils.common import sizeof_fmt
-from soil.api.utils.vmware import vCenterPropertyCollector
+CONF = soil.conf.CONF
+LOG = logging.getLogger(__name__)
 
 
 class ViewBuilder(object):
 
     _collection_name = "vcenter"
 
+    # the fields read from the vCenter to build the summary
+    _summary_fields = inventory.SUMMARY_FIELDS
+
     def __init__(self):
         super(ViewBuilder, self).__init__()
+        self.engine_api = engine_api.get_api()
 
     def _detail(self, request, vcenter):
         if vcenter is None:
             return {"vcenter": {}}
-        # summary = self._summary(vcenter)
+        vcenter_ref = self._detail_without_summary(vcenter)
+
+        mirrored = self._mirrored_summary(request, vcenter)
+        if mirrored is not None:
+            vcenter_ref['vcenter']['summary'] = self._format_summary(
+                mirrored['summary'])
+            vcenter_ref['vcenter']['inventory'] = mirrored['inventory']
+        return vcenter_ref
+
+    @staticmethod
+    def _detail_without_summary(vcenter):
+        # the circuit breaker of the vCenter in this process
+        bulkhead = get_bulkhead((vcenter.get('host'),
+                                 int(vcenter.get('port') or 443)))
         vcenter_ref = {
             "vcenter": {
                 'id': vcenter.get('id'),
@@ -26,10 +57,10 @@ class ViewBuilder(object):
                 'type': vcenter.get('type'),
                 'host': vcenter.get('host'),
                 'port': vcenter.get('port'),
-                'status': vcenter.get('status'),
+                'status': bulkhead.state,
+                'bulkhead': bulkhead.status(),
                 'created_at': vcenter.get('created_at'),
                 'updated_at': vcenter.get('updated_at'),
-                # 'summary': summary
             }
         }
         return vcenter_ref
@@ -42,9 +73,11 @@ class ViewBuilder(object):
 
         # the pile acts as a collection of return values from the functions
         # if any exceptions are raised by the function they'll get raised here
-        pile = eventlet.GreenPile(len(vcenters))
+        # at most summary_pool_size vCenters are queried at the same time
+        pool = eventlet.GreenPool(CONF.vmware.summary_pool_size)
+        pile = eventlet.GreenPile(pool)
         for vcenter in vcenters:
-            pile.spawn(self._detail, request, vcenter)
+            pile.spawn(self._list_detail, request, vcenter)
 
         for result in pile:
             try:
@@ -55,82 +88,204 @@ class ViewBuilder(object):
 
         return {"vcenters": vcenters_list}
 
-    # backend private method
+    def _list_detail(self, request, vcenter):
+        """Returns the detail of vcenter with a summary, within a deadline
 
-    def _summary(self, vcenter):
-        summary_ref = {
-            'version': '',
-            'hostname': '',
-            'numVms': 0,
-            'numTemplates': 0,
-            'numHosts': 0,
-            'numEffectiveHosts': 0,
-            'numCpus': 0,
-            'totalCpuMhz': 0,
-            'totalMemory': 0,
-            'numCpuCores': 0,
-            'numCpuThreads': 0,
-            'effectiveCpuMhz': 0,
-            'effectiveMemory': 0,
-            'dataStore': 0
-        }
+        The mirrored summary is used while it is fresh, or while the mirror
+        serves the snapshot it was restored from until its first sync,
+        otherwise the summary is computed live. Both share one deadline of
+        [vmware]summary_timeout. The outcome is reported in summary_status:
+        'mirror', 'live', 'stale' (the summary of the snapshot, or the live
+        summary failed and the last mirrored one is shown), 'timeout' or
+        'unreachable'.
+        """
+        deadline = time.time() + CONF.vmware.summary_timeout
+        try:
+            with eventlet.Timeout(CONF.vmware.summary_timeout):
+                vcenter_ref = self._detail(request, vcenter)
+        except eventlet.Timeout:
+            vcenter_ref = self._detail_without_summary(vcenter)
+        detail = vcenter_ref['vcenter']
+        inventory_ref = detail.get('inventory')
+        if inventory_ref is not None and not inventory_ref.get('stale'):
+            detail['summary_status'] = 'mirror'
+            return vcenter_ref
+        if inventory_ref is not None and inventory_ref.get('restored'):
+            # a warm start, the first sync will refresh it soon
+            detail['summary_status'] = 'stale'
+            return vcenter_ref
 
-        object_type = []
-        properties = {
-            'ComputeResource': ['summary'],
-            'HostSystem': ['hardware.cpuInfo.numCpuPackages'],
-            'Datastore': ['summary.capacity'],
-            'VirtualMachine': ['config.template', 'guest'],
-        }
-        with vCenterPropertyCollector(vcenter, object_type, properties) as result:
-            for key, value in result.items():
-                if isinstance(key, str):
-                    about = value.about
-                    summary_ref['version'] = ' '.join(
-                        [about.apiVersion, about.build])
-                    continue
+        try:
+            # the live summary only gets what is left of the deadline
+            with eventlet.Timeout(max(deadline - time.time(), 0)):
+                detail['summary'] = self._summary(vcenter)
+            detail['summary_status'] = 'live'
+        except eventlet.Timeout:
+            LOG.warning("Summary of vCenter %s timed out after %s seconds",
+                        vcenter.get('host'), CONF.vmware.summary_timeout)
+            detail['summary_status'] = (
+                'stale' if 'summary' in detail else 'timeout')
+        except Exception as e:
+            LOG.warning("Could not compute the summary of vCenter %s: %s",
+                        vcenter.get('host'), e)
+            detail['summary_status'] = (
+                'stale' if 'summary' in detail else 'unreachable')
+        return vcenter_ref
 
-                if isinstance(key, vim.ComputeResource):
-                    summary = value['summary']
-                    summary_ref['numHosts'] += summary.numHosts
-                    summary_ref['numEffectiveHosts'] += summary.numEffectiveHosts
-                    summary_ref['totalCpuMhz'] += summary.totalCpu
-                    summary_ref['totalMemory'] += summary.totalMemory
-                    summary_ref['numCpuCores'] += summary.numCpuCores
-                    summary_ref['numCpuThreads'] += summary.numCpuThreads
-                    summary_ref['effectiveCpuMhz'] += summary.effectiveCpu
-                    summary_ref['effectiveMemory'] += summary.effectiveMemory
-                    continue
+    def _overview(self, request, group_by=None):
+        context = request.environ.get('soil.context')
+        overview = self.engine_api.get_vcenter_overview(context,
+                                                        group_by=group_by)
+        if overview is None:
+            return {"overview": {}}
+        if group_by is None:
+            overview['summary'] = self._format_summary(overview['summary'])
+        else:
+            for group in overview['summary']:
+                group['summary'] = self._format_summary(group['summary'])
+        return {"overview": overview}
 
-                if isinstance(key, vim.VirtualMachine):
-                    template = value.get('config.template', False)
-                    guest = value['guest']
+    def _metrics(self, request, vcenter, moid, metrics=None, start=None,
+                 end=None, step=None):
+        context = request.environ.get('soil.context')
+        result = self.engine_api.get_vcenter_metrics(
+            context, vcenter.get('uuid'), moid, metrics=metrics, start=start,
+            end=end, step=step)
+        return {"metrics": result or {}}
 
-                    if template:
-                        summary_ref['numTemplates'] += 1
-                    else:
-                        summary_ref['numVms'] += 1
+    def _download(self, request, ds_file, range_header=None):
+        """Streams a datastore file, passing Range requests on"""
+        status, headers, chunks = ds_file.download(range_header)
+        if status >= 400:
+            for _chunk in chunks:
+                pass
+            msg = "Datastore file %s: %s" % (ds_file.path, status)
+            raise webob.exc.status_map.get(status,
+                                           webob.exc.HTTPBadGateway)(
+                explanation=msg)
 
-                    ip_address = [
-                        net.ipAddress for net in guest.net if hasattr(net, 'ipAddress')]
-                    for ip in ip_address:
-                        if vcenter.host in ip:
-                            summary_ref['hostname'] = guest.hostName
+        response = webob.Response(status=status, app_iter=chunks,
+                                  content_type='application/octet-stream',
+                                  charset=None, conditional_response=False)
+        for name, value in headers:
+            response.headers[name] = value
+        response.content_disposition = 'attachment; filename="%s"' % (
+            ds_file.path.rsplit('/', 1)[-1])
+        return response
 
-                    continue
+    def _upload(self, request, ds_file, body_file, length):
+        status, reason = ds_file.upload(body_file, length)
+        if status >= 400:
+            msg = "Datastore file %s: %s %s" % (ds_file.path, status, reason)
+            raise webob.exc.status_map.get(status,
+                                           webob.exc.HTTPBadGateway)(
+                explanation=msg)
+        return {"file": {"datastore": ds_file.datastore,
+                         "datacenter": ds_file.datacenter,
+                         "path": ds_file.path,
+                         "size": length}}
 
-                if isinstance(key, vim.HostSystem):
-                    numCpuPackages = value['hardware.cpuInfo.numCpuPackages']
-                    summary_ref['numCpus'] += numCpuPackages
-                    continue
+    def _export(self, request, vcenter, moid, fmt):
+        context = request.environ.get('soil.context')
+        job = self.engine_api.export_vm(context, vcenter.get('uuid'), moid,
+                                        fmt=fmt)
+        return {"export": job}
 
-                if isinstance(key, vim.Datastore):
-                    capacity = value['summary.capacity']
-                    summary_ref['dataStore'] += capacity
+    def _show_export(self, request, job_id):
+        context = request.environ.get('soil.context')
+        return {"export": self.engine_api.get_export_job(context, job_id)}
 
-        summary_ref['totalMemory'] = sizeof_fmt(summary_ref['totalMemory'])
-        summary_ref['effectiveMemory'] = sizeof_fmt(
-            summary_ref['effectiveMemory'])
-        summary_ref['dataStore'] = sizeof_fmt(summary_ref['dataStore'])
+    def _lookup(self, request, kind, value):
+        context = request.environ.get('soil.context')
+        guests = self.engine_api.lookup_guest(context, kind, value)
+        return {"guests": guests or []}
 
+    def _power(self, request, operation):
+        """Streams the outcome of a bulk power operation, one JSON per line
+
+        Each virtual machine gets its line as soon as its task completes,
+        the last line sums the operation up.
+        """
+        return self._stream(operation.run(), {'action': operation.action})
+
+    def _clone(self, request, pipeline):
+        """Streams the outcome of a clone pipeline, one JSON per line
+
+        Each clone gets its line as soon as its task completes, the last
+        line sums the deployment up.
+        """
+        return self._stream(pipeline.run(), {'template': pipeline.template})
+
+    def _query(self, request, vcenter, query, limit):
+        context = request.environ.get('soil.context')
+        result = self.engine_api.query_vcenter(context, vcenter.get('uuid'),
+                                               query, limit)
+        return {"query": result or {}}
+
+    def _changes(self, request, vcenter, since=None):
+        context = request.environ.get('soil.context')
+        changes = self.engine_api.get_vcenter_changes(
+            context, vcenter.get('uuid'), since=since)
+        return {"changes": changes or {}}
+
+    # backend private method
+    def _stream(self, results, summary):
+        """Returns a response writing results as newline delimited JSON
+
+        A failure while results are produced ends the stream with summary
+        and the error, the status line being already sent.
+        """
+        def stream():
+            try:
+                for result in results:
+                    yield jsonutils.dump_as_bytes(result) + b'\n'
+            except Exception as e:
+                LOG.exception("Streaming %s failed", summary)
+                failure = dict(summary, done=True,
+                               error=str(e) or e.__class__.__name__)
+                yield jsonutils.dump_as_bytes(failure) + b'\n'
+
+        return webob.Response(app_iter=stream(),
+                              content_type='application/x-ndjson',
+                              charset=None)
+
+    def _mirrored_summary(self, request, vcenter):
+        """Returns the summary served by the inventory mirror of vcenter"""
+        context = request.environ.get('soil.context')
+        try:
+            return self.engine_api.get_vcenter_summary(context,
+                                                       vcenter.get('uuid'))
+        except Exception as e:
+            LOG.warning("Could not get the mirrored summary of vCenter "
+                        "%s: %s", vcenter.get('host'), e)
+            return None
+
+    @staticmethod
+    def _format_summary(summary_ref):
+        summary_ref = dict(summary_ref)
+        for key in ('totalMemory', 'effectiveMemory', 'dataStore'):
+            summary_ref[key] = sizeof_fmt(summary_ref[key])
         return summary_ref
+
+    def _summary(self, vcenter):
+        """Computes the summary of vcenter live from the vCenter"""
+        aggregator = aggregate.SummaryAggregator()
+        version = ''
+
+        object_type = []
+        properties = plan_propspec(self._summary_fields)
+        # the objects come in column batches page by page, every metric is
+        # then summed up with one vectorized reduction
+        with vCenterPropertyCollector(vcenter, object_type, properties,
+                                      stream=True,
+                                      columns=self._summary_fields) as result:
+            for key, value in result:
+                if key == 'content':
+                    about = value.about
+                    version = ' '.join([about.apiVersion, about.build])
+                    continue
+                aggregator.add(value, vcenter_host=vcenter.host)
+
+        summary_ref = aggregator.finish()
+        summary_ref.update(version=version, hostname=aggregator.hostname())
+        return self._format_summary(summary_ref)
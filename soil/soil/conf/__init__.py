@@ -25,6 +25,7 @@ from soil.conf import destination_cluster
 from soil.conf import rsa_license
 from soil.conf import rpc
 from soil.conf import source_cluster
+from soil.conf import vmware
 
 CONF = cfg.CONF
 
@@ -35,3 +36,4 @@ destination_cluster.register_opts(CONF)
 rsa_license.register_opts(CONF)
 rpc.register_opts(CONF)
 source_cluster.register_opts(CONF)
+vmware.register_opts(CONF)
@@ -0,0 +1,372 @@
+# Copyright 2020 Soil, Inc.
+
+from oslo_config import cfg
+
+
+vmware_group = cfg.OptGroup(
+    'vmware',
+    title='VMware Options',
+    help='''
+Options under this group are used to configure the connections to the
+vCenters registered in soil.
+'''
+)
+
+
+VMWARE_ALL_OPTS = [
+    cfg.IntOpt(
+        'session_pool_size',
+        default=4,
+        min=0,
+        help='''
+Maximum number of idle logged-in sessions kept per vCenter by every soil
+process. Set 0 to disable session pooling and log out after every call.
+'''
+    ),
+    cfg.IntOpt(
+        'bulkhead_max_in_flight',
+        default=32,
+        min=1,
+        help='''
+Maximum number of connections of a soil process using one vCenter at the
+same time, for the calls of the API. Long-lived connections have their own
+bulkhead_max_background slots.
+'''
+    ),
+    cfg.IntOpt(
+        'bulkhead_max_background',
+        default=16,
+        min=1,
+        help='''
+Maximum number of long-lived connections of a soil process to one vCenter:
+the inventory mirror, the task watcher, the event and performance
+collectors, datastore transfers and exports hold one each while they run.
+'''
+    ),
+    cfg.FloatOpt(
+        'bulkhead_queue_timeout',
+        default=10,
+        min=0,
+        help='''
+Seconds a connection waits for a free slot of its vCenter before it fails.
+A wait in vain counts as a failure of the vCenter for its circuit breaker.
+'''
+    ),
+    cfg.IntOpt(
+        'breaker_failure_threshold',
+        default=5,
+        min=1,
+        help='''
+Number of consecutive failed or timed out calls to a vCenter after which
+its circuit breaker opens and connections to it are refused right away.
+'''
+    ),
+    cfg.IntOpt(
+        'breaker_reset_timeout',
+        default=30,
+        min=1,
+        help='''
+Seconds an open circuit breaker refuses the connections before it lets one
+probe call through, which closes it again when it succeeds.
+'''
+    ),
+    cfg.IntOpt(
+        'session_check_interval',
+        default=60,
+        min=0,
+        help='''
+Idle time in seconds after which a pooled vCenter session is validated with
+SessionManager.SessionIsActive before it is handed out again.
+'''
+    ),
+    cfg.BoolOpt(
+        'share_sessions',
+        default=True,
+        help='''
+Share authenticated vCenter sessions between all soil-api workers and
+soil-engine through the vcenter_session table. A process attaches to the
+published vmware_soap_session cookie before it tries a fresh login, which
+keeps the number of sessions per vCenter independent of the worker count.
+'''
+    ),
+    cfg.IntOpt(
+        'session_lease_timeout',
+        default=30,
+        min=1,
+        help='''
+Seconds a process may hold the login lease of a shared vCenter session.
+Other processes wait for the new cookie up to this long before they log in
+on their own.
+'''
+    ),
+    cfg.IntOpt(
+        'collector_max_objects',
+        default=1000,
+        min=0,
+        help='''
+Page size (maxObjects) of RetrievePropertiesEx when properties are
+collected from a vCenter. Set 0 to use the server default.
+'''
+    ),
+    cfg.IntOpt(
+        'inventory_wait_seconds',
+        default=60,
+        min=1,
+        help='''
+Maximum time in seconds a WaitForUpdatesEx long poll of the inventory
+mirror waits for changes before it returns empty.
+'''
+    ),
+    cfg.IntOpt(
+        'inventory_sync_interval',
+        default=60,
+        help='''
+Interval in seconds at which soil-engine starts inventory mirrors for newly
+registered vCenters and stops the mirrors of removed ones. Set -1 to
+disable the inventory mirrors.
+'''
+    ),
+    cfg.IntOpt(
+        'inventory_journal_size',
+        default=100000,
+        min=0,
+        help='''
+Number of object changes every inventory mirror remembers to answer delta
+queries. Clients holding an older version token get a full listing.
+'''
+    ),
+    cfg.IntOpt(
+        'summary_pool_size',
+        default=8,
+        min=1,
+        help='''
+Maximum number of vCenters whose summary is computed concurrently when the
+vCenters are listed.
+'''
+    ),
+    cfg.IntOpt(
+        'summary_timeout',
+        default=10,
+        min=1,
+        help='''
+Seconds the live summary of one vCenter may take when the vCenters are
+listed. A vCenter exceeding it is listed with summary_status 'timeout', or
+'stale' with its last mirrored summary, instead of delaying the list.
+'''
+    ),
+    cfg.IntOpt(
+        'power_max_in_flight',
+        default=32,
+        min=1,
+        help='''
+Maximum number of power operations in flight on one vCenter during a bulk
+power action.
+'''
+    ),
+    cfg.IntOpt(
+        'power_max_in_flight_per_host',
+        default=4,
+        min=1,
+        help='''
+Maximum number of power operations in flight on one ESXi host during a bulk
+power action.
+'''
+    ),
+    cfg.IntOpt(
+        'clone_max_in_flight',
+        default=16,
+        min=1,
+        help='''
+Maximum number of clones in flight on one vCenter while virtual machines are
+deployed from a template.
+'''
+    ),
+    cfg.IntOpt(
+        'clone_max_in_flight_per_host',
+        default=4,
+        min=1,
+        help='''
+Maximum number of clones in flight on one ESXi host while virtual machines
+are deployed from a template.
+'''
+    ),
+    cfg.IntOpt(
+        'clone_max_in_flight_per_datastore',
+        default=2,
+        min=1,
+        help='''
+Maximum number of clones in flight on one datastore while virtual machines
+are deployed from a template. Full clones are bound by the datastore
+throughput, more clones at once only share it.
+'''
+    ),
+    cfg.IntOpt(
+        'perf_interval',
+        default=60,
+        min=0,
+        help='''
+Interval in seconds between two collections of the realtime performance
+metrics of the hosts and virtual machines of a vCenter by soil-engine. Set 0
+to disable the collection. The metrics are served only with use_rpc, API
+workers running a local engine manager do not collect them.
+'''
+    ),
+    cfg.IntOpt(
+        'perf_batch_size',
+        default=100,
+        min=1,
+        help='''
+Maximum number of entities queried by one PerformanceManager.QueryPerf call.
+'''
+    ),
+    cfg.IntOpt(
+        'perf_buffer_size',
+        default=360,
+        min=1,
+        help='''
+Number of samples kept per entity and metric. Realtime samples are 20
+seconds apart, 360 samples keep the last two hours.
+'''
+    ),
+    cfg.IntOpt(
+        'event_interval',
+        default=30,
+        min=0,
+        help='''
+Interval in seconds between two reads of the new events of a vCenter by
+soil-engine, which copies them into the vcenter_log table. Set 0 to disable
+the copy.
+'''
+    ),
+    cfg.IntOpt(
+        'event_page_size',
+        default=1000,
+        min=1,
+        max=1000,
+        help='''
+Number of events read by one ReadNextEvents call, and inserted into the
+vcenter_log table by one transaction.
+'''
+    ),
+    cfg.IntOpt(
+        'event_backfill_seconds',
+        default=86400,
+        min=0,
+        help='''
+How far back in seconds the events of a vCenter are copied the first time,
+before any event of it was copied. Later copies resume from the latest
+copied event.
+'''
+    ),
+    cfg.IntOpt(
+        'datastore_chunk_size',
+        default=1048576,
+        min=4096,
+        help='''
+Size in bytes of the chunks datastore files are streamed in, through the
+datastore file endpoint of the API. A transfer holds one chunk in memory at
+a time whatever the size of the file.
+'''
+    ),
+    cfg.IntOpt(
+        'datastore_timeout',
+        default=300,
+        min=1,
+        help='''
+Seconds a datastore file transfer may wait for vCenter to send or accept
+the next chunk.
+'''
+    ),
+    cfg.StrOpt(
+        'export_dir',
+        default='/var/lib/soil/exports',
+        help='''
+Directory virtual machines are exported into, one sub-directory per export
+job. It should be the same for all soil processes of a host.
+'''
+    ),
+    cfg.IntOpt(
+        'export_max_parallel_disks',
+        default=4,
+        min=1,
+        help='''
+Maximum number of disks of one virtual machine downloaded at the same time
+during an export.
+'''
+    ),
+    cfg.IntOpt(
+        'export_lease_update_interval',
+        default=30,
+        min=1,
+        help='''
+Interval in seconds between two progress updates of the export lease of a
+virtual machine. vCenter aborts a lease whose progress was not updated for
+the lease timeout, 5 minutes by default.
+'''
+    ),
+    cfg.IntOpt(
+        'export_jobs_kept',
+        default=100,
+        min=1,
+        help='''
+Number of finished export jobs whose status is kept in the database.
+'''
+    ),
+    cfg.IntOpt(
+        'query_default_limit',
+        default=100,
+        min=1,
+        help='''
+Number of objects of a page of inventory query results when the request
+does not set a limit.
+'''
+    ),
+    cfg.IntOpt(
+        'query_max_limit',
+        default=1000,
+        min=1,
+        help='''
+Maximum number of objects of a page of inventory query results.
+'''
+    ),
+    cfg.StrOpt(
+        'snapshot_dir',
+        default='/var/lib/soil/snapshots',
+        help='''
+Directory the inventory mirrors of soil-engine save their snapshot into, one
+file per vCenter. A mirror started with a snapshot serves it, marked stale,
+until its first sync completes. API workers running a local engine manager
+only load the snapshots. Leave empty to disable the snapshots.
+'''
+    ),
+    cfg.IntOpt(
+        'snapshot_interval',
+        default=300,
+        min=0,
+        help='''
+Minimum interval in seconds between two snapshots of the inventory of a
+vCenter; a snapshot is only written when the inventory changed. Set 0 to
+only save when the mirror stops.
+'''
+    ),
+    cfg.IntOpt(
+        'index_refresh_interval',
+        default=30,
+        min=0,
+        help='''
+Minimum interval in seconds between two reloads of the managed object index
+of a vCenter for one object type. Lookups by moid or name missing the index
+reload it from a single name collection at most this often; processes
+running an inventory mirror keep the index up to date without reloads.
+'''
+    ),
+]
+
+
+def register_opts(conf):
+    conf.register_group(vmware_group)
+    conf.register_opts(VMWARE_ALL_OPTS, group=vmware_group)
+
+
+def list_opts():
+    return {vmware_group: VMWARE_ALL_OPTS}
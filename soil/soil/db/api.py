@@ -27,6 +27,7 @@ implement a dictionary interface. However, a future goal is to have all of
 these objects be simple dictionaries.
 
 """
+import datetime
 import threading
 
 from oslo_config import cfg
@@ -35,6 +36,8 @@ from oslo_db import options
 from oslo_db.sqlalchemy import session as db_session
 from oslo_db import concurrency
 from oslo_log import log as logging
+from oslo_utils import timeutils
+from sqlalchemy import or_
 
 from soil.db import models
 from soil.db.models import BASE
@@ -199,6 +202,131 @@ def vcenter_delete_by_uuid(uuid):
 ###################
 
 
+def vcenter_session_get(session_key):
+    session = get_session()
+    query = session.query(models.vCenterSession)
+    return query.filter_by(session_key=session_key).first()
+
+
+def vcenter_session_acquire_lease(session_key, owner, lease_seconds):
+    """Takes the login lease of a shared vcenter session
+
+    Only one process at a time may hold the lease, so that a dead session
+    triggers exactly one re-login. A lease which is not released within
+    lease_seconds is considered abandoned and may be taken over.
+
+    :returns: True if owner holds the lease now
+    """
+    session = get_session()
+    try:
+        with session.begin():
+            session.add(models.vCenterSession(session_key=session_key,
+                                              generation=0))
+    except db_exc.DBDuplicateEntry:
+        pass
+
+    now = timeutils.utcnow()
+    expires_at = now + datetime.timedelta(seconds=lease_seconds)
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterSession)
+        count = query.filter_by(session_key=session_key).filter(
+            or_(models.vCenterSession.lease_owner == None,  # noqa: E711
+                models.vCenterSession.lease_owner == owner,
+                models.vCenterSession.lease_expires_at < now)
+        ).update({'lease_owner': owner, 'lease_expires_at': expires_at},
+                 synchronize_session=False)
+    return count == 1
+
+
+def vcenter_session_update(session_key, owner, cookie):
+    """Publishes the cookie of a new session and releases the lease"""
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterSession)
+        record = query.filter_by(session_key=session_key,
+                                 lease_owner=owner).first()
+        if record is None:
+            return None
+        record.cookie = cookie
+        record.generation = (record.generation or 0) + 1
+        record.lease_owner = None
+        record.lease_expires_at = None
+    return record
+
+
+def vcenter_session_release_lease(session_key, owner):
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterSession)
+        query.filter_by(session_key=session_key, lease_owner=owner).update(
+            {'lease_owner': None, 'lease_expires_at': None},
+            synchronize_session=False)
+
+
+###################
+
+
+def vcenter_export_job_create(job_id, **values):
+    session = get_session()
+    job = models.vCenterExportJob(job_id=job_id, **values)
+    with session.begin():
+        session.add(job)
+    return job
+
+
+def vcenter_export_job_update(job_id, **values):
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterExportJob)
+        query.filter_by(job_id=job_id).update(values,
+                                              synchronize_session=False)
+
+
+def vcenter_export_job_get(job_id):
+    session = get_session()
+    query = session.query(models.vCenterExportJob)
+    return query.filter_by(job_id=job_id).first()
+
+
+def vcenter_export_job_prune(kept, done_states):
+    """Deletes the finished export jobs but the latest kept ones
+
+    :returns: the directories of the deleted jobs
+    """
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterExportJob.id,
+                              models.vCenterExportJob.directory).filter(
+            models.vCenterExportJob.state.in_(done_states))
+        rows = query.order_by(models.vCenterExportJob.id.desc()).offset(
+            kept).all()
+        if rows:
+            session.query(models.vCenterExportJob).filter(
+                models.vCenterExportJob.id.in_([row.id for row in rows])
+            ).delete(synchronize_session=False)
+    return [row.directory for row in rows if row.directory]
+
+
+def vcenter_export_job_fail_stale(done_states, updated_before, error):
+    """Sets the unfinished export jobs not updated since to error
+
+    :returns: the directories of the failed jobs
+    """
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterExportJob).filter(
+            ~models.vCenterExportJob.state.in_(done_states),
+            models.vCenterExportJob.updated_at < updated_before)
+        directories = [row.directory for row in query if row.directory]
+        query.update({'state': 'error', 'error': error},
+                     synchronize_session=False)
+    return directories
+
+
+###################
+
+
 def vcenter_log_get(limit=10):
     session = get_session()
     query = session.query(models.vCenterLog)
@@ -231,6 +359,43 @@ def vcenter_log_create(**kw):
     return log_models
 
 
+def vcenter_event_cursor_get(vcenter_uuid):
+    session = get_session()
+    query = session.query(models.vCenterEventCursor)
+    return query.filter_by(vcenter_uuid=vcenter_uuid).first()
+
+
+def vcenter_log_create_events(vcenter_uuid, logs, previous_key, last_key,
+                              last_created_at):
+    """Inserts the logs of a page of vcenter events and moves the cursor
+
+    The logs and the cursor are written in one transaction, and only while
+    the cursor still is at previous_key, so that a page is never copied
+    twice even when two collectors follow the same vcenter.
+
+    :param logs: list of vCenterLog column -> value dicts
+    :returns: False if the cursor had moved, nothing was written then
+    """
+    session = get_session()
+    try:
+        with session.begin():
+            session.add(models.vCenterEventCursor(vcenter_uuid=vcenter_uuid))
+    except db_exc.DBDuplicateEntry:
+        pass
+
+    session = get_session()
+    with session.begin():
+        query = session.query(models.vCenterEventCursor)
+        count = query.filter_by(vcenter_uuid=vcenter_uuid,
+                                last_key=previous_key).update(
+            {'last_key': last_key, 'last_created_at': last_created_at},
+            synchronize_session=False)
+        if count != 1:
+            return False
+        session.bulk_insert_mappings(models.vCenterLog, logs)
+    return True
+
+
 ##################
 
 
@@ -3,6 +3,7 @@
 from oslo_db.sqlalchemy import models
 from oslo_utils import timeutils
 from sqlalchemy import Boolean
+from sqlalchemy import BigInteger, Float, Text
 from sqlalchemy import Column, DateTime, String, Integer, schema
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -95,3 +96,57 @@ class vCenterLog(BASE, SoilDBBase):
                        onupdate=timeutils.utcnow)  # resource operate time
     created_at = Column(DateTime, default=timeutils.utcnow),
     updated_at = Column(DateTime, default=timeutils.utcnow)
+
+
+class vCenterSession(BASE):
+    """Authenticated vcenter session shared by all soil processes"""
+
+    __tablename__ = 'vcenter_session'
+
+    id = Column(Integer, primary_key=True)
+    session_key = Column(String(255), unique=True)  # host:port:user
+    cookie = Column(String(1024))  # vmware_soap_session cookie
+    generation = Column(Integer, default=0)  # bumped on every re-login
+    lease_owner = Column(String(255))  # process logging in right now
+    lease_expires_at = Column(DateTime)
+    created_at = Column(DateTime, default=timeutils.utcnow)
+    updated_at = Column(DateTime, default=timeutils.utcnow,
+                        onupdate=timeutils.utcnow)
+
+
+class vCenterEventCursor(BASE):
+    """Latest vcenter event copied into vcenter_log, per vcenter"""
+
+    __tablename__ = 'vcenter_event_cursor'
+
+    id = Column(Integer, primary_key=True)
+    vcenter_uuid = Column(String(36), unique=True)
+    last_key = Column(Integer)  # key of the latest event copied
+    last_created_at = Column(DateTime)  # createdTime of that event
+    created_at = Column(DateTime, default=timeutils.utcnow)
+    updated_at = Column(DateTime, default=timeutils.utcnow,
+                        onupdate=timeutils.utcnow)
+
+
+class vCenterExportJob(BASE):
+    """Export job of a vcenter virtual machine, read by all soil processes"""
+
+    __tablename__ = 'vcenter_export_job'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(36), unique=True)
+    vcenter_uuid = Column(String(36))
+    moid = Column(String(64))  # virtual machine exported
+    name = Column(String(255))  # its name, known once the export started
+    format = Column(String(16))  # ovf or ova
+    state = Column(String(32))
+    progress = Column(Integer, default=0)  # percentage of the disks
+    bytes = Column(BigInteger, default=0)  # bytes of the disks downloaded
+    directory = Column(String(1024))
+    files = Column(Text)  # json list of the exported files
+    error = Column(Text)
+    started_at = Column(Float)  # epoch seconds
+    finished_at = Column(Float)
+    created_at = Column(DateTime, default=timeutils.utcnow)
+    updated_at = Column(DateTime, default=timeutils.utcnow,
+                        onupdate=timeutils.utcnow)
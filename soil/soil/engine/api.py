@@ -0,0 +1,101 @@
+# Copyright 2020 Soil, Inc.
+
+"""Handles all requests to the engine service.
+
+With ``use_rpc`` the requests are sent to soil-engine, which owns the
+inventory mirrors of all the vCenters. Without it every API worker runs an
+in-process engine manager, starting the mirror of a vCenter the first time
+it is asked for.
+"""
+
+import soil.conf
+from soil.engine import manager
+from soil.engine import rpcapi
+
+
+CONF = soil.conf.CONF
+CONF.import_opt('use_rpc', 'soil.service')
+
+
+class LocalAPI(object):
+    """A local version of the engine API that runs the manager in-process"""
+
+    def __init__(self):
+        self._manager = manager.EngineManager(service_name='soil-api')
+
+    def get_vcenter_summary(self, context, vcenter_uuid):
+        return self._manager.get_vcenter_summary(context, vcenter_uuid)
+
+    def get_vcenter_changes(self, context, vcenter_uuid, since=None):
+        return self._manager.get_vcenter_changes(context, vcenter_uuid,
+                                                 since=since)
+
+    def get_vcenter_overview(self, context, group_by=None):
+        return self._manager.get_vcenter_overview(context, group_by=group_by)
+
+    def get_vcenter_metrics(self, context, vcenter_uuid, moid, metrics=None,
+                            start=None, end=None, step=None):
+        return self._manager.get_vcenter_metrics(
+            context, vcenter_uuid, moid, metrics=metrics, start=start,
+            end=end, step=step)
+
+    def export_vm(self, context, vcenter_uuid, moid, fmt='ovf'):
+        return self._manager.export_vm(context, vcenter_uuid, moid, fmt=fmt)
+
+    def get_export_job(self, context, job_id):
+        return self._manager.get_export_job(context, job_id)
+
+    def lookup_guest(self, context, kind, value):
+        return self._manager.lookup_guest(context, kind, value)
+
+    def query_vcenter(self, context, vcenter_uuid, query, limit):
+        return self._manager.query_vcenter(context, vcenter_uuid, query,
+                                           limit)
+
+
+class API(object):
+    """Engine API that sends the requests to soil-engine over RPC"""
+
+    def __init__(self):
+        self.engine_rpcapi = rpcapi.EngineAPI()
+
+    def get_vcenter_summary(self, context, vcenter_uuid):
+        return self.engine_rpcapi.get_vcenter_summary(context, vcenter_uuid)
+
+    def get_vcenter_changes(self, context, vcenter_uuid, since=None):
+        return self.engine_rpcapi.get_vcenter_changes(context, vcenter_uuid,
+                                                      since=since)
+
+    def get_vcenter_overview(self, context, group_by=None):
+        return self.engine_rpcapi.get_vcenter_overview(context,
+                                                       group_by=group_by)
+
+    def get_vcenter_metrics(self, context, vcenter_uuid, moid, metrics=None,
+                            start=None, end=None, step=None):
+        return self.engine_rpcapi.get_vcenter_metrics(
+            context, vcenter_uuid, moid, metrics=metrics, start=start,
+            end=end, step=step)
+
+    def export_vm(self, context, vcenter_uuid, moid, fmt='ovf'):
+        return self.engine_rpcapi.export_vm(context, vcenter_uuid, moid,
+                                            fmt=fmt)
+
+    def get_export_job(self, context, job_id):
+        return self.engine_rpcapi.get_export_job(context, job_id)
+
+    def lookup_guest(self, context, kind, value):
+        return self.engine_rpcapi.lookup_guest(context, kind, value)
+
+    def query_vcenter(self, context, vcenter_uuid, query, limit):
+        return self.engine_rpcapi.query_vcenter(context, vcenter_uuid, query,
+                                                limit)
+
+
+_API = None
+
+
+def get_api():
+    global _API
+    if _API is None:
+        _API = API() if CONF.use_rpc else LocalAPI()
+    return _API
@@ -4,10 +4,21 @@ import os
 
 from oslo_config import cfg
 from oslo_log import log as logging
+import oslo_messaging as messaging
 from oslo_service import periodic_task
 
+import soil.conf
+from soil.api.utils.vmware import aggregate
+from soil.api.utils.vmware import events
+from soil.api.utils.vmware import export
+from soil.api.utils.vmware.index import get_guest_index
+from soil.api.utils.vmware import inventory
+from soil.api.utils.vmware import perf
+from soil.api.utils.vmware.common import get_field
+from soil.db import api as db_api
 
-CONF = cfg.CONF
+
+CONF = soil.conf.CONF
 LOG = logging.getLogger(__name__)
 
 engine_opts = [
@@ -25,13 +36,39 @@ _PID = os.getpid()
 
 
 class EngineManager(periodic_task.PeriodicTasks):
+    """Engine manager
+
+    Besides the periodic tasks it owns the inventory mirrors of all the
+    registered vCenters and answers the queries of the API against them,
+    see soil.engine.rpcapi.
+
+    API version history:
+
+        1.0 - Initial version, get_vcenter_summary
+        1.1 - Add get_vcenter_changes
+        1.2 - Add get_vcenter_overview
+        1.3 - Add get_vcenter_metrics
+        1.4 - Add export_vm and get_export_job
+        1.5 - Add lookup_guest
+        1.6 - Add query_vcenter
+    """
+
+    target = messaging.Target(version='1.6')
 
     def __init__(self, host=None, service_name='soil-engine'):
         if not host:
             host = CONF.host
         self.host = host
         self.service_name = service_name
+        self._mirrors = {}
+        self._collectors = {}
+        self._event_collectors = {}
         super(EngineManager, self).__init__(CONF)
+        # export jobs of a soil process which stopped stay unfinished
+        try:
+            export.fail_stale_jobs()
+        except Exception:
+            LOG.exception("Could not fail the stale export jobs")
 
     def periodic_tasks(self, context, raise_on_error=False):
         """Tasks to be run at a periodic interval."""
@@ -43,17 +80,198 @@ class EngineManager(periodic_task.PeriodicTasks):
         when one requests the service be started.  This is called before any
         service record is created. Child classes should override this method.
         """
-        pass
+        if CONF.vmware.inventory_sync_interval >= 0:
+            self._sync_inventory_mirrors(None)
 
     def cleanup_host(self):
         """Hook to do cleanup work when the service shuts down.
 
         Child classes should override this method.
         """
-        pass
+        for mirror in self._mirrors.values():
+            mirror.stop()
+        self._mirrors.clear()
+        for collectors in (self._collectors, self._event_collectors):
+            for collector in collectors.values():
+                collector.stop()
+            collectors.clear()
 
     # NOTE(gcb) This is just an example showing usage of periodic task.
     @periodic_task.periodic_task(spacing=CONF.check_interval)
     def log_pid(self, context):
         """periodical task for logging pid of the current process"""
         LOG.info('Run soil-engine with pid:%s on host:%s' % (_PID, self.host))
+
+    @periodic_task.periodic_task(
+        spacing=CONF.vmware.inventory_sync_interval)
+    def _sync_inventory_mirrors(self, context):
+        """Runs one inventory mirror per registered vCenter"""
+        vcenters = dict((vcenter.uuid, vcenter)
+                        for vcenter in db_api.vcenter_get_all())
+
+        for uuid in list(self._mirrors):
+            mirror = self._mirrors[uuid]
+            vcenter = vcenters.get(uuid)
+            if vcenter is None or mirror.vcenter != self._vcenter_ref(vcenter):
+                LOG.info("Stopping inventory mirror of vCenter %s",
+                         mirror.vcenter.host)
+                mirror.stop()
+                del self._mirrors[uuid]
+                for collectors in (self._collectors, self._event_collectors):
+                    collector = collectors.pop(uuid, None)
+                    if collector is not None:
+                        collector.stop()
+
+        for uuid, vcenter in vcenters.items():
+            if uuid not in self._mirrors:
+                self._start_mirror(vcenter)
+
+    @staticmethod
+    def _vcenter_ref(vcenter):
+        return inventory.vCenterRef(vcenter.uuid, vcenter.host, vcenter.port,
+                                    vcenter.username, vcenter.password)
+
+    def _start_mirror(self, vcenter):
+        LOG.info("Starting inventory mirror of vCenter %s", vcenter.host)
+        # NOTE: only soil-engine writes the snapshots, API workers running a
+        # local manager mirror the same vCenters and only read them
+        mirror = inventory.InventoryMirror(
+            vcenter, save_snapshots=self.service_name == 'soil-engine')
+        self._mirrors[vcenter.uuid] = mirror
+        # serve the last snapshot while the first sync runs
+        mirror.load_snapshot()
+        mirror.start()
+        # NOTE: metrics are collected and events copied by soil-engine only,
+        # API workers running a local manager would each query the same
+        # metrics and copy the same events
+        if (self.service_name == 'soil-engine' and
+                CONF.vmware.perf_interval > 0):
+            collector = perf.PerfCollector(mirror.vcenter,
+                                           mirror.perf_entities)
+            self._collectors[vcenter.uuid] = collector
+            collector.start()
+        if (self.service_name == 'soil-engine' and
+                CONF.vmware.event_interval > 0):
+            collector = events.EventLogCollector(vcenter)
+            self._event_collectors[vcenter.uuid] = collector
+            collector.start()
+        return mirror
+
+    def _get_mirror(self, vcenter_uuid):
+        mirror = self._mirrors.get(vcenter_uuid)
+        if mirror is None:
+            vcenter = db_api.vcenter_get_by_uuid(vcenter_uuid)
+            if vcenter is None:
+                return None
+            mirror = self._start_mirror(vcenter)
+        return mirror
+
+    def get_vcenter_summary(self, context, vcenter_uuid):
+        """Returns the mirrored summary of a vCenter and its staleness"""
+        mirror = self._get_mirror(vcenter_uuid)
+        if mirror is None:
+            return None
+        return {'summary': mirror.summary(), 'inventory': mirror.status()}
+
+    def get_vcenter_changes(self, context, vcenter_uuid, since=None):
+        """Returns the inventory changes of a vCenter since a token"""
+        mirror = self._get_mirror(vcenter_uuid)
+        if mirror is None:
+            return None
+        changes = mirror.changes(since)
+        changes['inventory'] = mirror.status()
+        return changes
+
+    def get_vcenter_overview(self, context, group_by=None):
+        """Returns the summary of all the vCenters, optionally grouped
+
+        :param group_by: None for one summary of all the vCenters, else
+            one of aggregate.GROUP_BY
+        """
+        aggregator = aggregate.SummaryAggregator(group_by)
+        vcenters = []
+        for vcenter in db_api.vcenter_get_all():
+            mirror = self._get_mirror(vcenter.uuid)
+            if mirror is None:
+                continue
+            for batch in mirror.column_batches(aggregate.AGGREGATE_FIELDS):
+                aggregator.add(batch, vcenter.uuid)
+            status = mirror.status()
+            status.update(uuid=vcenter.uuid, host=vcenter.host)
+            vcenters.append(status)
+        return {'group_by': group_by, 'summary': aggregator.finish(),
+                'vcenters': vcenters}
+
+    def get_vcenter_metrics(self, context, vcenter_uuid, moid, metrics=None,
+                            start=None, end=None, step=None):
+        """Returns the collected performance series of a host or a VM
+
+        The series are read from the ring buffers of the performance
+        collector of the vCenter, the vCenter itself is not queried.
+        """
+        if self._get_mirror(vcenter_uuid) is None:
+            return None
+        collector = self._collectors.get(vcenter_uuid)
+        if collector is None:
+            return {'entity': moid, 'metrics': None,
+                    'collector': {'state': 'disabled'}}
+        return {'entity': moid,
+                'metrics': collector.series(moid, metrics, start, end, step),
+                'collector': collector.status()}
+
+    def export_vm(self, context, vcenter_uuid, moid, fmt='ovf'):
+        """Starts the export of a virtual machine, returns the job status"""
+        vcenter = db_api.vcenter_get_by_uuid(vcenter_uuid)
+        if vcenter is None:
+            return None
+        job = export.ExportJob(vcenter, moid, fmt)
+        job.start()
+        export.prune_jobs()
+        return job.status()
+
+    def get_export_job(self, context, job_id):
+        """Returns the status of an export job, None if it is unknown
+
+        Jobs keep their status in the database, the one of a job started
+        by another API worker is found as well.
+        """
+        return export.get_job_status(job_id)
+
+    def lookup_guest(self, context, kind, value):
+        """Returns the virtual machines whose guest reports an address
+
+        :param kind: one of index.GuestIndex.KINDS
+        :param value: the IP address, MAC address or hostname looked up
+        """
+        # every vCenter must be mirrored for its guests to be indexed
+        for vcenter in db_api.vcenter_get_all():
+            self._get_mirror(vcenter.uuid)
+
+        result = []
+        for vcenter_uuid, moid in get_guest_index().lookup(kind, value):
+            mirror = self._mirrors.get(vcenter_uuid)
+            props = mirror.objects.get(moid) if mirror is not None else None
+            if props is None:
+                continue
+            result.append({
+                'vcenter': vcenter_uuid,
+                'moid': moid,
+                'name': props.get('name'),
+                'hostname': props.get('guest.hostName'),
+                'ips': get_field(props, 'guest.net[].ipAddress', []),
+                'macs': get_field(props, 'guest.net[].macAddress', []),
+                'stale': mirror.stale,
+            })
+        return result
+
+    def query_vcenter(self, context, vcenter_uuid, query, limit):
+        """Returns a page of the mirrored objects matching a query
+
+        :param query: a query of query.build_query
+        """
+        mirror = self._get_mirror(vcenter_uuid)
+        if mirror is None:
+            return None
+        objects, marker = mirror.query(query, limit)
+        return {'objects': objects, 'next_marker': marker,
+                'inventory': mirror.status()}
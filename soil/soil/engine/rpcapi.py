@@ -0,0 +1,84 @@
+# Copyright 2020 Soil, Inc.
+
+"""
+Client side of the engine RPC API.
+"""
+
+import oslo_messaging as messaging
+
+from soil import rpc
+
+
+_TOPIC = 'engine'
+
+
+def _context(context):
+    if context is None:
+        return {}
+    if hasattr(context, 'to_dict'):
+        return context.to_dict()
+    return context
+
+
+class EngineAPI(object):
+    """Client side of the engine rpc API.
+
+    API version history:
+
+        1.0 - Initial version, get_vcenter_summary
+        1.1 - Add get_vcenter_changes
+        1.2 - Add get_vcenter_overview
+        1.3 - Add get_vcenter_metrics
+        1.4 - Add export_vm and get_export_job
+        1.5 - Add lookup_guest
+        1.6 - Add query_vcenter
+    """
+
+    VERSION_ALIASES = {
+    }
+
+    def __init__(self, topic=_TOPIC):
+        super(EngineAPI, self).__init__()
+        target = messaging.Target(topic=topic, version='1.6')
+        self.client = rpc.get_client(target)
+
+    def get_vcenter_summary(self, context, vcenter_uuid):
+        cctxt = self.client.prepare()
+        return cctxt.call(_context(context), 'get_vcenter_summary',
+                          vcenter_uuid=vcenter_uuid)
+
+    def get_vcenter_changes(self, context, vcenter_uuid, since=None):
+        cctxt = self.client.prepare(version='1.1')
+        return cctxt.call(_context(context), 'get_vcenter_changes',
+                          vcenter_uuid=vcenter_uuid, since=since)
+
+    def get_vcenter_overview(self, context, group_by=None):
+        cctxt = self.client.prepare(version='1.2')
+        return cctxt.call(_context(context), 'get_vcenter_overview',
+                          group_by=group_by)
+
+    def get_vcenter_metrics(self, context, vcenter_uuid, moid, metrics=None,
+                            start=None, end=None, step=None):
+        cctxt = self.client.prepare(version='1.3')
+        return cctxt.call(_context(context), 'get_vcenter_metrics',
+                          vcenter_uuid=vcenter_uuid, moid=moid,
+                          metrics=metrics, start=start, end=end, step=step)
+
+    def export_vm(self, context, vcenter_uuid, moid, fmt='ovf'):
+        cctxt = self.client.prepare(version='1.4')
+        return cctxt.call(_context(context), 'export_vm',
+                          vcenter_uuid=vcenter_uuid, moid=moid, fmt=fmt)
+
+    def get_export_job(self, context, job_id):
+        cctxt = self.client.prepare(version='1.4')
+        return cctxt.call(_context(context), 'get_export_job', job_id=job_id)
+
+    def lookup_guest(self, context, kind, value):
+        cctxt = self.client.prepare(version='1.5')
+        return cctxt.call(_context(context), 'lookup_guest', kind=kind,
+                          value=value)
+
+    def query_vcenter(self, context, vcenter_uuid, query, limit):
+        cctxt = self.client.prepare(version='1.6')
+        return cctxt.call(_context(context), 'query_vcenter',
+                          vcenter_uuid=vcenter_uuid, query=query, limit=limit)
@@ -30,7 +30,7 @@ from oslo_utils import importutils
 
 from soil import baserpc
 from soil import exception
-from soil.i18n import _, _LI
+from soil.i18n import _, _LE, _LI
 from soil import rpc
 from soil.wsgi import common as wsgi_common
 from soil.wsgi import server as wsgi
@@ -81,6 +81,8 @@ class Service(service.Service):
         self.rpcserver = None
 
     def start(self):
+        self.manager.init_host()
+
         if CONF.use_rpc:
             target = messaging.Target(topic=self.topic, server=self.host)
 
@@ -118,7 +120,7 @@ class Service(service.Service):
         if not topic:
             topic = binary.rpartition('soil-')[2]
         if not manager:
-            manager = SERVICE_MANAGER.get(binary)
+            manager = SERVICE_MANAGERS.get(binary)
 
         service_obj = cls(host, binary, topic, manager)
 
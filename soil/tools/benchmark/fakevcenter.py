@@ -0,0 +1,1193 @@
+# Copyright 2020 Soil, Inc.
+
+"""A fake vCenter serving a synthetic inventory over SOAP
+
+Answers the calls the collectors of soil make against a vCenter: the
+service content, logins, container views, RetrievePropertiesEx with its
+ContinueRetrievePropertiesEx pages, private property collectors with their
+filters and WaitForUpdatesEx, and virtual machine power tasks completing
+after a set duration. Requests are parsed and responses written with the
+pyVmomi (de)serializers, so the clients run unmodified against it.
+
+Every SOAP round trip is counted with the bytes of its request and response
+bodies, per method, and served as JSON at /stats. An injected latency is
+slept before each request is answered.
+
+It is not a vCenter: container views do not follow the inventory changes
+made after their creation, the partialUpdates of filters and the WaitOptions
+other than maxWaitSeconds and maxObjectUpdates are ignored, and the power
+tasks always succeed.
+
+It is a development tool, not installed with soil.
+
+usage:
+    python tools/benchmark/fakevcenter.py --port 8443 --hosts 32 \
+        --vms 1000 --datastores 16 --latency 0.005
+"""
+
+import argparse
+import calendar
+import collections
+import copy
+import datetime
+import itertools
+import json
+import os
+import re
+import shutil
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from xml.parsers import expat
+from xml.sax import saxutils
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from pyVmomi import Iso8601
+from pyVmomi import SoapAdapter
+from pyVmomi import VmomiSupport
+from pyVmomi import vim
+from pyVmomi import vmodl
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+
+_VERSION = VmomiSupport.GetServiceVersions('vim25')[0]
+_VERSION_ID = VmomiSupport.versionIdMap[_VERSION]
+_NS = 'urn:vim25'
+_NSMAP = dict(SoapAdapter.SOAP_NSMAP, **{_NS: ''})
+
+_PC = vmodl.query.PropertyCollector
+
+# the accessor pyVmomi 8.0 and later read single properties with, it is
+# not in the type info
+_FETCH = VmomiSupport.Object(
+    name='Fetch', wsdlName='Fetch', version=_VERSION, isTask=False,
+    params=(VmomiSupport.Object(name='prop', type=str, version=_VERSION,
+                                flags=0),),
+    result=object, resultFlags=0, methodResult=object)
+
+_COOKIE_RE = re.compile(r'vmware_soap_session="?([^";]+)')
+
+# methods answered without a session
+_ANONYMOUS_METHODS = ('RetrieveServiceContent', 'Login', 'CurrentTime')
+
+# properties holding the children of a container, for container views
+_CHILD_PROPERTIES = (
+    (vim.Folder, ('childEntity',)),
+    (vim.Datacenter, ('vmFolder', 'hostFolder', 'datastoreFolder',
+                      'networkFolder')),
+    (vim.ComputeResource, ('host', 'resourcePool')),
+    (vim.ResourcePool, ('resourcePool', 'vm')),
+)
+
+# seconds a task stays in the recentTask of the task manager once completed
+_RECENT_TASK_TTL = 600
+
+# changes kept to update filters incrementally, older filters are rebuilt
+_CHANGE_LOG_SIZE = 100000
+
+# objects of a RetrievePropertiesEx page when maxObjects is not set
+DEFAULT_PAGE_SIZE = 1000
+
+
+def _now():
+    return datetime.datetime.now(Iso8601.TZManager.GetTZInfo())
+
+
+def _serialize(value, name, typ, flags=0):
+    info = VmomiSupport.Object(name=name, type=typ, version=_VERSION,
+                               flags=flags)
+    # Serialize is public on every pyVmomi, SerializeToUnicode is gone
+    # since 8.0
+    return SoapAdapter.Serialize(value, info, _VERSION,
+                                 _NSMAP).decode('utf-8')
+
+
+def _envelope(body):
+    return ''.join([SoapAdapter.XML_HEADER, '\n',
+                    SoapAdapter.SOAP_ENVELOPE_START,
+                    SoapAdapter.SOAP_BODY_START, body,
+                    SoapAdapter.SOAP_BODY_END,
+                    SoapAdapter.SOAP_ENVELOPE_END]).encode('utf-8')
+
+
+def _fault_envelope(fault):
+    detail = _serialize(fault, '%sFault' % fault._wsdlName, object)
+    # the detail of a fault is qualified by the vim namespace
+    detail = detail.replace('Fault ', 'Fault xmlns="%s" ' % _NS, 1)
+    message = saxutils.escape(fault.msg or fault._wsdlName)
+    return _envelope('<soapenv:Fault><faultcode>ServerFaultCode</faultcode>'
+                     '<faultstring>%s</faultstring><detail>%s</detail>'
+                     '</soapenv:Fault>' % (message, detail))
+
+
+def service_versions():
+    """Returns the vimServiceVersions.xml document of the fake vCenter"""
+    prior = ''.join('<version>%s</version>' % VmomiSupport.versionIdMap[v]
+                    for v in VmomiSupport.GetServiceVersions('vim25')[1:]
+                    if v in VmomiSupport.versionIdMap)
+    return ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<namespaces version="1.0"><namespace><name>urn:vim25</name>'
+            '<version>%s</version><priorVersions>%s</priorVersions>'
+            '</namespace></namespaces>' % (_VERSION_ID, prior)).encode('utf-8')
+
+
+class _Serialized(object):
+    """The returnval of a response, already serialized"""
+
+    def __init__(self, xml):
+        self.xml = xml
+
+
+class _RequestDeserializer(SoapAdapter.ExpatDeserializerNSHandlers):
+    """Parses a SOAP request into its method, managed object and arguments
+
+    Each parameter is handed to a SoapDeserializer of its type, array
+    parameters element by element. The method is None when pyVmomi does
+    not know it, its parameters but _this are skipped then.
+    """
+
+    def Deserialize(self, request):
+        self.nsMap = {}
+        self.stack = []
+        self.name = None
+        self.method = None
+        self.this = None
+        self.args = {}
+        self.params = {}
+        self.param = None
+        self.deser = None
+        self.parser = expat.ParserCreate(
+            namespace_separator=SoapAdapter.NS_SEP)
+        self.parser.buffer_text = True
+        SoapAdapter.SetHandlers(self.parser, SoapAdapter.GetHandlers(self))
+        self.parser.Parse(request, True)
+        self._collect()
+        del self.parser
+        return self.name, self.method, self.this, self.args
+
+    def StartElementHandler(self, tag, attr):
+        name = tag.rpartition(SoapAdapter.NS_SEP)[2]
+        in_body = len(self.stack) > 1 and self.stack[1] == 'Body'
+        if in_body and len(self.stack) == 2:
+            self.name = name
+            try:
+                self.method = VmomiSupport.GuessWsdlMethod(name).info
+            except KeyError:
+                if name == _FETCH.wsdlName:
+                    self.method = _FETCH
+            if self.method is not None:
+                self.params = dict((param.name, param)
+                                   for param in self.method.params)
+        elif in_body and len(self.stack) == 3 and (
+                self.method is not None or name == '_this'):
+            # the deserializer takes over until the end of the parameter
+            self._collect()
+            if name == '_this':
+                typ = VmomiSupport.ManagedObject
+            else:
+                typ = self.params[name].type
+            many = issubclass(typ, list)
+            self.param = (name, typ, many)
+            self.deser = SoapAdapter.SoapDeserializer(version=_VERSION)
+            self.deser.Deserialize(self.parser, typ.Item if many else typ,
+                                   False, self.nsMap)
+            self.deser.StartElementHandler(tag, attr)
+            return
+        self.stack.append(name)
+
+    def EndElementHandler(self, tag):
+        self.stack.pop()
+
+    def CharacterDataHandler(self, data):
+        pass
+
+    def _collect(self):
+        if self.deser is None:
+            return
+        name, typ, many = self.param
+        value = self.deser.GetResult()
+        if name == '_this':
+            self.this = value
+        elif many:
+            self.args.setdefault(name, typ()).append(value)
+        else:
+            self.args[name] = value
+        self.deser = None
+
+
+class _Object(object):
+    """A managed object of the fake inventory"""
+
+    __slots__ = ('moid', 'cls', 'props', 'rev')
+
+    def __init__(self, cls, moid, props):
+        self.moid = moid
+        self.cls = cls
+        self.props = props
+        self.rev = 0
+
+    def ref(self):
+        return self.cls(self.moid)
+
+
+class _Session(object):
+
+    def __init__(self, user):
+        self.key = str(uuid.uuid4())
+        now = _now()
+        self.user_session = vim.UserSession(
+            key=self.key, userName=user, fullName=user, loginTime=now,
+            lastActiveTime=now, locale='en', messageLocale='en',
+            extensionSession=False, ipAddress='127.0.0.1',
+            userAgent='pyvmomi', callCount=0)
+        self.objects = set()
+        self.tokens = {}
+
+
+class _Filter(object):
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.seq = None
+        self.selected = collections.OrderedDict()
+        self.known = {}
+        self.dirty = set()
+
+
+class _Collector(object):
+
+    def __init__(self):
+        self.filters = collections.OrderedDict()
+        self.version = 0
+        self.cancelled = False
+
+
+class _Stats(object):
+    """SOAP round trips and bytes of the request and response bodies"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.methods = {}
+
+    def record(self, method, bytes_in, bytes_out):
+        with self._lock:
+            self.round_trips += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            counters = self.methods.setdefault(method, [0, 0, 0])
+            counters[0] += 1
+            counters[1] += bytes_in
+            counters[2] += bytes_out
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'round_trips': self.round_trips,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'methods': dict(
+                    (method, {'calls': calls, 'bytes_in': bytes_in,
+                              'bytes_out': bytes_out})
+                    for method, (calls, bytes_in, bytes_out)
+                    in self.methods.items()),
+            }
+
+
+class FakevCenter(object):
+    """The inventory and the SOAP methods of a fake vCenter
+
+    The inventory has one datacenter, hosts spread over clusters of at
+    most 16 hosts, datastores shared by the hosts of a cluster and virtual
+    machines spread over the hosts. Everything runs under one condition,
+    released only while WaitForUpdatesEx waits for changes.
+
+    usage:
+        vcenter = FakevCenter(hosts=8, vms=100, datastores=4)
+        status, body, cookie = vcenter.handle(request, cookie)
+    """
+
+    def __init__(self, hosts, vms, datastores, user='root',
+                 password='vmware', task_duration=1.0):
+        self.user = user
+        self.password = password
+        self.task_duration = task_duration
+        self.stats = _Stats()
+        self.objects = {}
+        self._cond = threading.Condition()
+        self._sessions = {}
+        self._collectors = {}
+        self._fragments = {}
+        self._ids = itertools.count(1)
+        self._seq = 0
+        self._changes = collections.deque(maxlen=_CHANGE_LOG_SIZE)
+        self._build(hosts, vms, datastores)
+        self._handlers = {
+            'RetrieveServiceContent': self._retrieve_service_content,
+            'CurrentTime': self._current_time,
+            'Login': self._login,
+            'Logout': self._logout,
+            'SessionIsActive': self._session_is_active,
+            'CreateContainerView': self._create_container_view,
+            'DestroyView': self._destroy,
+            'Fetch': self._fetch,
+            'RetrievePropertiesEx': self._retrieve_properties_ex,
+            'ContinueRetrievePropertiesEx':
+                self._continue_retrieve_properties_ex,
+            'CancelRetrievePropertiesEx': self._cancel_retrieve_properties_ex,
+            'RetrieveProperties': self._retrieve_properties,
+            'CreatePropertyCollector': self._create_property_collector,
+            'DestroyPropertyCollector': self._destroy,
+            'CreateFilter': self._create_filter,
+            'DestroyPropertyFilter': self._destroy_filter,
+            'WaitForUpdatesEx': self._wait_for_updates_ex,
+            'WaitForUpdates': self._wait_for_updates,
+            'CancelWaitForUpdates': self._cancel_wait_for_updates,
+            'PowerOnVM_Task': self._power_on_vm,
+            'PowerOffVM_Task': self._power_off_vm,
+        }
+
+    # inventory
+
+    def _add(self, cls, moid, **props):
+        self.objects[moid] = _Object(cls, moid, props)
+        return cls(moid)
+
+    def _build(self, hosts, vms, datastores):
+        hosts = max(hosts, 1)
+        datastores = max(datastores, 1)
+        clusters = (hosts + 15) // 16
+        now = _now()
+
+        root = vim.Folder('group-d1')
+        dc = vim.Datacenter('datacenter-2')
+        vm_folder = vim.Folder('group-v3')
+        host_folder = vim.Folder('group-h4')
+        ds_folder = vim.Folder('group-s5')
+        net_folder = vim.Folder('group-n6')
+        cluster_refs = [vim.ClusterComputeResource('domain-c%d' % (i + 1))
+                        for i in range(clusters)]
+        pool_refs = [vim.ResourcePool('resgroup-%d' % (i + 1))
+                     for i in range(clusters)]
+        host_refs = [vim.HostSystem('host-%d' % (i + 1))
+                     for i in range(hosts)]
+        ds_refs = [vim.Datastore('datastore-%d' % (i + 1))
+                   for i in range(datastores)]
+        vm_refs = [vim.VirtualMachine('vm-%d' % (i + 1)) for i in range(vms)]
+
+        def cluster_of(index):
+            return index % clusters
+
+        host_vms = [[] for _i in range(hosts)]
+        pool_vms = [[] for _i in range(clusters)]
+        ds_vms = [[] for _i in range(datastores)]
+        cluster_ds = [[ds for i, ds in enumerate(ds_refs)
+                       if cluster_of(i) == c] or ds_refs
+                      for c in range(clusters)]
+
+        for i, ref in enumerate(vm_refs):
+            host_index = i % hosts
+            cluster = cluster_of(host_index)
+            datastore = cluster_ds[cluster][i % len(cluster_ds[cluster])]
+            host_vms[host_index].append(ref)
+            pool_vms[cluster].append(ref)
+            ds_vms[ds_refs.index(datastore)].append(ref)
+            powered_on = i % 4 != 3
+            template = i % 50 == 49
+            nics = []
+            if powered_on and not template:
+                nics = [vim.vm.GuestInfo.NicInfo(
+                    network='VM Network',
+                    ipAddress=['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255,
+                                                i & 255)],
+                    macAddress='00:50:56:%02x:%02x:%02x' % (
+                        i >> 16 & 255, i >> 8 & 255, i & 255),
+                    connected=True, deviceConfigId=4000)]
+            name = 'vm-%05d' % (i + 1)
+            self._add(
+                vim.VirtualMachine, ref._moId, name=name, parent=vm_folder,
+                resourcePool=pool_refs[cluster], datastore=[datastore],
+                runtime=vim.vm.RuntimeInfo(
+                    host=host_refs[host_index],
+                    connectionState='connected',
+                    powerState='poweredOn' if powered_on else 'poweredOff',
+                    faultToleranceState='notConfigured',
+                    toolsInstallerMounted=False, numMksConnections=0,
+                    recordReplayState='inactive', onlineStandby=False,
+                    consolidationNeeded=False),
+                config=vim.vm.ConfigInfo(
+                    changeVersion=now.isoformat(), modified=now, name=name,
+                    guestFullName='Other Linux (64-bit)', version='vmx-19',
+                    uuid=str(uuid.UUID(int=i + 1)), template=template,
+                    guestId='otherLinux64Guest', alternateGuestName='',
+                    files=vim.vm.FileInfo(
+                        vmPathName='[%s] %s/%s.vmx' % (
+                            self._ds_name(datastore), name, name)),
+                    flags=vim.vm.FlagInfo(),
+                    defaultPowerOps=vim.vm.DefaultPowerOpInfo(),
+                    hardware=vim.vm.VirtualHardware(
+                        numCPU=1 << (i % 4), memoryMB=1024 << (i % 4))),
+                guest=vim.vm.GuestInfo(
+                    guestState='running' if powered_on else 'notRunning',
+                    hostName=None if template else '%s.bench.local' % name,
+                    net=nics))
+
+        for i, ref in enumerate(host_refs):
+            cluster = cluster_of(i)
+            self._add(
+                vim.HostSystem, ref._moId,
+                name='esx%04d.bench.local' % (i + 1),
+                parent=cluster_refs[cluster], datastore=cluster_ds[cluster],
+                vm=host_vms[i],
+                runtime=vim.host.RuntimeInfo(connectionState='connected',
+                                             powerState='poweredOn',
+                                             inMaintenanceMode=False),
+                hardware=vim.host.HardwareInfo(
+                    systemInfo=vim.host.SystemInfo(
+                        vendor='Soil', model='Fake',
+                        uuid=str(uuid.UUID(int=(1 << 64) + i))),
+                    cpuInfo=vim.host.CpuInfo(numCpuPackages=2,
+                                             numCpuCores=16,
+                                             numCpuThreads=32,
+                                             hz=2400000000),
+                    cpuPkg=[vim.host.CpuPackage(
+                        index=package, vendor='intel', hz=2400000000,
+                        busHz=100000000, description='Fake CPU',
+                        threadId=list(range(package * 16, package * 16 + 16)))
+                        for package in range(2)],
+                    memorySize=256 << 30, smcPresent=False))
+
+        for i, ref in enumerate(ds_refs):
+            self._add(
+                vim.Datastore, ref._moId, name=self._ds_name(ref),
+                parent=ds_folder, vm=ds_vms[i],
+                summary=vim.Datastore.Summary(
+                    datastore=ref, name=self._ds_name(ref),
+                    url='ds:///vmfs/volumes/%s/' % uuid.UUID(int=i + 1),
+                    capacity=4 << 40, freeSpace=(4 << 40) * (i % 10) // 10,
+                    accessible=True, type='VMFS' if i % 3 else 'NFS'))
+
+        for c, ref in enumerate(cluster_refs):
+            members = [host for i, host in enumerate(host_refs)
+                       if cluster_of(i) == c]
+            self._add(
+                vim.ClusterComputeResource, ref._moId,
+                name='cluster-%02d' % (c + 1), parent=host_folder,
+                host=members, datastore=cluster_ds[c],
+                resourcePool=pool_refs[c],
+                summary=vim.ClusterComputeResource.Summary(
+                    totalCpu=len(members) * 16 * 2400,
+                    totalMemory=len(members) * (256 << 30),
+                    numCpuCores=len(members) * 16,
+                    numCpuThreads=len(members) * 32,
+                    effectiveCpu=len(members) * 16 * 2200,
+                    effectiveMemory=len(members) * 240 * 1024,
+                    numHosts=len(members), numEffectiveHosts=len(members),
+                    overallStatus='green', currentFailoverLevel=1,
+                    numVmotions=0))
+            self._add(vim.ResourcePool, pool_refs[c]._moId, name='Resources',
+                      parent=ref, resourcePool=[], vm=pool_vms[c])
+
+        self._add(vim.Folder, root._moId, name='Datacenters', parent=None,
+                  childEntity=[dc])
+        self._add(vim.Datacenter, dc._moId, name='Datacenter', parent=root,
+                  vmFolder=vm_folder, hostFolder=host_folder,
+                  datastoreFolder=ds_folder, networkFolder=net_folder,
+                  datastore=ds_refs)
+        self._add(vim.Folder, vm_folder._moId, name='vm', parent=dc,
+                  childEntity=vm_refs)
+        self._add(vim.Folder, host_folder._moId, name='host', parent=dc,
+                  childEntity=cluster_refs)
+        self._add(vim.Folder, ds_folder._moId, name='datastore', parent=dc,
+                  childEntity=ds_refs)
+        self._add(vim.Folder, net_folder._moId, name='network', parent=dc,
+                  childEntity=[])
+
+        about = vim.AboutInfo(
+            name='VMware vCenter Server', fullName='Soil fake vCenter',
+            vendor='Soil', version=_VERSION_ID, build='0',
+            osType='linux-x64', productLineId='vpx', apiType='VirtualCenter',
+            apiVersion=_VERSION_ID, instanceUuid=str(uuid.uuid4()))
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=root,
+            propertyCollector=self._add(vmodl.query.PropertyCollector,
+                                        'propertyCollector', filter=[]),
+            viewManager=self._add(vim.view.ViewManager, 'ViewManager',
+                                  viewList=[]),
+            sessionManager=self._add(vim.SessionManager, 'SessionManager',
+                                     sessionList=[]),
+            taskManager=self._add(vim.TaskManager, 'TaskManager',
+                                  recentTask=[]),
+            about=about)
+        self._add(vim.ServiceInstance, 'ServiceInstance',
+                  content=self.content, serverClock=now,
+                  capability=vim.Capability(provisioningSupported=False,
+                                            multiHostSupported=True,
+                                            userShellAccessSupported=False))
+
+    @staticmethod
+    def _ds_name(ref):
+        return 'datastore%03d' % int(ref._moId.rpartition('-')[2])
+
+    def _children(self, obj):
+        for cls, names in _CHILD_PROPERTIES:
+            if issubclass(obj.cls, cls):
+                for name in names:
+                    value = obj.props.get(name)
+                    if isinstance(value, list):
+                        for child in value:
+                            yield child
+                    elif value is not None:
+                        yield value
+
+    def _touch(self, obj, structural=False):
+        """Records a change of obj, structural when references changed"""
+        obj.rev += 1
+        self._seq += 1
+        self._changes.append((self._seq, obj.moid, structural))
+        self._cond.notify_all()
+
+    def _set(self, moid, path, value, structural=False):
+        """Sets the property at path, copying the data objects on the way
+
+        Values handed out before keep their content, so changes are found
+        by comparing values.
+        """
+        obj = self.objects[moid]
+        names = path.split('.')
+        if len(names) == 1:
+            obj.props[path] = value
+        else:
+            top = current = copy.copy(obj.props[names[0]])
+            for name in names[1:-1]:
+                child = copy.copy(getattr(current, name))
+                setattr(current, name, child)
+                current = child
+            setattr(current, names[-1], value)
+            obj.props[names[0]] = top
+        self._touch(obj, structural)
+
+    def _value(self, obj, path, session=None):
+        """Returns the value of the property path of obj, None when unset"""
+        names = path.split('.')
+        try:
+            info = obj.cls._GetPropertyInfo(names[0])
+        except AttributeError:
+            raise vmodl.query.InvalidProperty(name=path)
+        if obj.cls is vim.SessionManager and path == 'currentSession':
+            return session.user_session if session is not None else None
+
+        value = obj.props.get(names[0])
+        for name in names[1:]:
+            if value is None:
+                return None
+            try:
+                info = value._GetPropertyInfo(name)
+            except AttributeError:
+                raise vmodl.query.InvalidProperty(name=path)
+            value = getattr(value, name)
+        if isinstance(value, list) and type(value) is not info.type:
+            # values of a DynamicProperty need a typed array
+            value = info.type(value)
+        return value
+
+    def _get(self, ref):
+        obj = self.objects.get(ref._moId) if ref is not None else None
+        if obj is None:
+            raise vmodl.fault.ManagedObjectNotFound(
+                msg="The object has already been deleted or has not been "
+                    "completely created", obj=ref)
+        return obj
+
+    # property collection
+
+    def _select(self, spec):
+        """Returns the objects collected by the FilterSpec spec
+
+        :return: an ordered dict of moid -> property paths, in the order
+            the traversal reached the objects
+        """
+        named = {}
+
+        def find_names(select_set):
+            for select in select_set or ():
+                if isinstance(select, _PC.TraversalSpec) and select.name:
+                    if select.name not in named:
+                        named[select.name] = select
+                        find_names(select.selectSet)
+
+        for obj_spec in spec.objectSet:
+            find_names(obj_spec.selectSet)
+
+        found = collections.OrderedDict()
+        for obj_spec in spec.objectSet:
+            self._get(obj_spec.obj)
+            seen = set()
+            stack = [(obj_spec.obj._moId, obj_spec.skip, obj_spec.selectSet)]
+            while stack:
+                moid, skip, select_set = stack.pop()
+                if (moid, id(select_set)) in seen:
+                    continue
+                seen.add((moid, id(select_set)))
+                obj = self.objects.get(moid)
+                if obj is None:
+                    continue
+                if not skip:
+                    found[moid] = None
+                for select in select_set or ():
+                    if not isinstance(select, _PC.TraversalSpec):
+                        select = named.get(select.name)
+                        if select is None:
+                            continue
+                    if not issubclass(obj.cls, select.type):
+                        continue
+                    value = self._value(obj, select.path)
+                    children = value if isinstance(value, list) else [value]
+                    for child in reversed(children):
+                        if isinstance(child, VmomiSupport.ManagedObject):
+                            stack.append((child._moId, select.skip,
+                                          select.selectSet))
+
+        selected = collections.OrderedDict()
+        for moid in found:
+            obj = self.objects[moid]
+            paths = []
+            for prop_spec in spec.propSet:
+                if not issubclass(obj.cls, prop_spec.type):
+                    continue
+                if prop_spec.all:
+                    names = sorted(obj.props)
+                else:
+                    names = prop_spec.pathSet or ()
+                for path in names:
+                    if path not in paths:
+                        paths.append(path)
+            if paths or any(issubclass(obj.cls, prop_spec.type)
+                            for prop_spec in spec.propSet):
+                selected[moid] = paths
+        return selected
+
+    def _property_xml(self, obj, path, session):
+        key = (obj.moid, path)
+        cached = self._fragments.get(key)
+        if cached is not None and cached[0] == obj.rev:
+            return cached[1]
+        value = self._value(obj, path, session)
+        if value is None:
+            xml = ''
+        else:
+            xml = _serialize(vmodl.DynamicProperty(name=path, val=value),
+                             'propSet', vmodl.DynamicProperty)
+        # objects of the sessions come and go, they are not cached
+        if obj.cls is not vim.SessionManager and '[' not in obj.moid:
+            self._fragments[key] = (obj.rev, xml)
+        return xml
+
+    def _content_xml(self, tag, moid, paths, session):
+        """Serializes the ObjectContent of moid, properties cached"""
+        obj = self.objects.get(moid)
+        if obj is None:
+            return ''
+        props = ''.join(self._property_xml(obj, path, session)
+                        for path in paths)
+        return '<%s><obj type="%s">%s</obj>%s</%s>' % (
+            tag, obj.cls._wsdlName, saxutils.escape(moid), props, tag)
+
+    def _page(self, session, pending, max_objects):
+        page, rest = pending[:max_objects], pending[max_objects:]
+        token = None
+        if rest:
+            token = str(next(self._ids))
+            session.tokens[token] = (rest, max_objects)
+        objects = ''.join(self._content_xml('objects', moid, paths, session)
+                          for moid, paths in page)
+        if not objects and token is None:
+            return None
+        token_xml = '<token>%s</token>' % token if token else ''
+        return _Serialized('<returnval>%s%s</returnval>' %
+                           (token_xml, objects))
+
+    def _fetch(self, session, this, args):
+        return self._value(self._get(this), args['prop'], session)
+
+    def _retrieve_properties_ex(self, session, this, args):
+        pending = []
+        for spec in args['specSet']:
+            pending.extend(self._select(spec).items())
+        options = args.get('options')
+        max_objects = ((options and options.maxObjects) or
+                       DEFAULT_PAGE_SIZE)
+        return self._page(session, pending, max_objects)
+
+    def _continue_retrieve_properties_ex(self, session, this, args):
+        try:
+            pending, max_objects = session.tokens.pop(args['token'])
+        except KeyError:
+            raise vmodl.fault.InvalidArgument(msg="Invalid token",
+                                              invalidProperty='token')
+        return self._page(session, pending, max_objects)
+
+    def _cancel_retrieve_properties_ex(self, session, this, args):
+        session.tokens.pop(args['token'], None)
+
+    def _retrieve_properties(self, session, this, args):
+        contents = []
+        for spec in args['specSet']:
+            for moid, paths in self._select(spec).items():
+                contents.append(self._content_xml('returnval', moid, paths,
+                                                  session))
+        return _Serialized(''.join(contents))
+
+    # property collectors and filters
+
+    def _private(self, session, cls, prefix, **props):
+        moid = 'session[%s]%s-%d' % (session.key, prefix, next(self._ids))
+        session.objects.add(moid)
+        return self._add(cls, moid, **props)
+
+    def _collector(self, session, this):
+        self._get(this)
+        key = (session.key, this._moId)
+        collector = self._collectors.get(key)
+        if collector is None:
+            collector = self._collectors[key] = _Collector()
+        return collector
+
+    def _create_property_collector(self, session, this, args):
+        return self._private(session, vmodl.query.PropertyCollector, 'pc',
+                             filter=[])
+
+    def _create_filter(self, session, this, args):
+        collector = self._collector(session, this)
+        spec = args['spec']
+        self._select(spec)
+        ref = self._private(session, _PC.Filter, 'filter', spec=spec,
+                            partialUpdates=args.get('partialUpdates'))
+        collector.filters[ref._moId] = _Filter(spec)
+        return ref
+
+    def _destroy_filter(self, session, this, args):
+        self._get(this)
+        for (key, _moid), collector in self._collectors.items():
+            if key == session.key:
+                collector.filters.pop(this._moId, None)
+        self._destroy(session, this, args)
+
+    def _destroy(self, session, this, args):
+        self._get(this)
+        self.objects.pop(this._moId, None)
+        session.objects.discard(this._moId)
+        collector = self._collectors.pop((session.key, this._moId), None)
+        for moid in collector.filters if collector is not None else ():
+            self.objects.pop(moid, None)
+            session.objects.discard(moid)
+
+    def _filter_updates(self, pcfilter, limit):
+        changes = []
+        if pcfilter.seq is not None:
+            for change in reversed(self._changes):
+                if change[0] <= pcfilter.seq:
+                    break
+                changes.append(change)
+        rebuild = (pcfilter.seq is None or
+                   any(structural for _seq, _moid, structural in changes) or
+                   (self._changes and pcfilter.seq < self._changes[0][0] - 1))
+        if rebuild:
+            pcfilter.selected = self._select(pcfilter.spec)
+            pcfilter.dirty.update(pcfilter.selected)
+            pcfilter.dirty.update(pcfilter.known)
+        else:
+            pcfilter.dirty.update(
+                moid for _seq, moid, _structural in changes
+                if moid in pcfilter.selected or moid in pcfilter.known)
+        pcfilter.seq = self._seq
+
+        ordered = [moid for moid in pcfilter.selected
+                   if moid in pcfilter.dirty]
+        ordered.extend(moid for moid in pcfilter.dirty
+                       if moid not in pcfilter.selected)
+        updates = []
+        for moid in ordered:
+            if limit is not None and len(updates) >= limit:
+                return updates, True
+            pcfilter.dirty.discard(moid)
+            if moid not in pcfilter.selected:
+                known = pcfilter.known.pop(moid, None)
+                if known is not None:
+                    updates.append(_PC.ObjectUpdate(kind='leave',
+                                                    obj=known[0]))
+                continue
+
+            obj = self.objects[moid]
+            ref = obj.ref()
+            current = dict((path, self._value(obj, path))
+                           for path in pcfilter.selected[moid])
+            old = pcfilter.known.get(moid)
+            pcfilter.known[moid] = (ref, current)
+            if old is None:
+                change_set = [_PC.Change(name=path, op='assign', val=value)
+                              for path, value in current.items()
+                              if value is not None]
+                updates.append(_PC.ObjectUpdate(kind='enter', obj=ref,
+                                                changeSet=change_set))
+                continue
+            change_set = []
+            for path, value in current.items():
+                previous = old[1].get(path)
+                if value is previous or value == previous:
+                    continue
+                change_set.append(_PC.Change(name=path, op='assign',
+                                             val=value))
+            if change_set:
+                updates.append(_PC.ObjectUpdate(kind='modify', obj=ref,
+                                                changeSet=change_set))
+        return updates, False
+
+    def _updates(self, collector, limit):
+        filter_set = []
+        truncated = False
+        for moid, pcfilter in collector.filters.items():
+            updates, truncated = self._filter_updates(pcfilter, limit)
+            if updates:
+                filter_set.append(_PC.FilterUpdate(filter=_PC.Filter(moid),
+                                                   objectSet=updates))
+                if limit is not None:
+                    limit -= len(updates)
+            if truncated:
+                break
+        return filter_set, truncated
+
+    def _wait_for_updates_ex(self, session, this, args):
+        collector = self._collector(session, this)
+        options = args.get('options')
+        max_wait = options.maxWaitSeconds if options else None
+        limit = options.maxObjectUpdates if options else None
+        deadline = time.time() + max_wait if max_wait is not None else None
+        while True:
+            filter_set, truncated = self._updates(collector, limit)
+            if filter_set:
+                collector.version += 1
+                return _PC.UpdateSet(version=str(collector.version),
+                                     filterSet=filter_set,
+                                     truncated=truncated)
+            if collector.cancelled:
+                collector.cancelled = False
+                raise vmodl.fault.RequestCanceled(msg="Request canceled")
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            self._cond.wait(remaining)
+
+    def _wait_for_updates(self, session, this, args):
+        return self._wait_for_updates_ex(session, this, {})
+
+    def _cancel_wait_for_updates(self, session, this, args):
+        self._collector(session, this).cancelled = True
+        self._cond.notify_all()
+
+    # sessions
+
+    def _retrieve_service_content(self, session, this, args):
+        return self.content
+
+    def _current_time(self, session, this, args):
+        return _now()
+
+    def _login(self, session, this, args):
+        if (args.get('userName') != self.user or
+                args.get('password') != self.password):
+            raise vim.fault.InvalidLogin(
+                msg="Cannot complete login due to an incorrect user name "
+                    "or password.")
+        session = _Session(self.user)
+        self._sessions[session.key] = session
+        return session
+
+    def _logout(self, session, this, args):
+        self._sessions.pop(session.key, None)
+        for moid in session.objects:
+            self.objects.pop(moid, None)
+            self._collectors.pop((session.key, moid), None)
+        self._collectors.pop((session.key, 'propertyCollector'), None)
+
+    def _session_is_active(self, session, this, args):
+        return args.get('sessionID') in self._sessions
+
+    # views
+
+    def _create_container_view(self, session, this, args):
+        container = self._get(args['container'])
+        types = tuple(args.get('type') or ()) or (vim.ManagedEntity,)
+        recursive = args.get('recursive')
+        view = []
+        seen = set([container.moid])
+        stack = list(reversed(list(self._children(container))))
+        while stack:
+            ref = stack.pop()
+            if ref._moId in seen or ref._moId not in self.objects:
+                continue
+            seen.add(ref._moId)
+            obj = self.objects[ref._moId]
+            if issubclass(obj.cls, types):
+                view.append(ref)
+            if recursive:
+                stack.extend(reversed(list(self._children(obj))))
+        return self._private(session, vim.view.ContainerView, 'view',
+                             container=container.ref(), type=list(types),
+                             recursive=recursive, view=view)
+
+    # tasks
+
+    def _start_task(self, session, this, name, description_id, on_success):
+        entity = self._get(this)
+        now = _now()
+        number = next(self._ids)
+        task = vim.Task('task-%d' % number)
+        self._add(vim.Task, task._moId, info=vim.TaskInfo(
+            key=task._moId, task=task,
+            name=VmomiSupport.GuessWsdlMethod(name),
+            descriptionId=description_id, entity=this,
+            entityName=entity.props.get('name'), state='running',
+            cancelled=False, cancelable=False,
+            reason=vim.TaskReasonUser(userName=self.user),
+            queueTime=now, startTime=now, eventChainId=number))
+
+        manager = self.objects['TaskManager']
+        expired = time.time() - _RECENT_TASK_TTL
+        recent = [ref for ref in manager.props['recentTask']
+                  if self._completed_at(ref._moId) > expired]
+        self._set('TaskManager', 'recentTask', recent + [task],
+                  structural=True)
+
+        timer = threading.Timer(self.task_duration, self._complete_task,
+                                (task._moId, on_success))
+        timer.daemon = True
+        timer.start()
+        return task
+
+    def _completed_at(self, moid):
+        info = self.objects[moid].props['info']
+        if info.completeTime is None:
+            return float('inf')
+        return calendar.timegm(info.completeTime.utctimetuple())
+
+    def _complete_task(self, moid, on_success):
+        with self._cond:
+            on_success()
+            info = copy.copy(self.objects[moid].props['info'])
+            info.state = 'success'
+            info.progress = 100
+            info.completeTime = _now()
+            self._set(moid, 'info', info)
+
+    def _power_on_vm(self, session, this, args):
+        return self._start_task(
+            session, this, 'PowerOnVM_Task', 'VirtualMachine.powerOn',
+            lambda: self._set(this._moId, 'runtime.powerState', 'poweredOn'))
+
+    def _power_off_vm(self, session, this, args):
+        return self._start_task(
+            session, this, 'PowerOffVM_Task', 'VirtualMachine.powerOff',
+            lambda: self._set(this._moId, 'runtime.powerState',
+                              'poweredOff'))
+
+    # requests
+
+    def handle(self, request, cookie=None):
+        """Answers the SOAP request
+
+        :param request: the body of the request
+        :param cookie: the Cookie header of the request
+        :return: the status, the body of the response, the name of the
+            method and the session cookie to set, if any
+        """
+        method = 'unknown'
+        try:
+            method, info, this, args = _RequestDeserializer().Deserialize(
+                request)
+            handler = self._handlers.get(method)
+            if info is None or handler is None:
+                raise vmodl.fault.MethodNotFound(
+                    msg="Method %s is not supported by the fake vCenter" %
+                        method, receiver=this, method=method)
+            match = _COOKIE_RE.search(cookie or '')
+            with self._cond:
+                session = self._sessions.get(match.group(1)
+                                             if match else None)
+                if session is None and method not in _ANONYMOUS_METHODS:
+                    raise vim.fault.NotAuthenticated(
+                        msg="The session is not authenticated.",
+                        object=this, privilegeId='System.View')
+                if session is not None:
+                    session.user_session.callCount += 1
+                result = handler(session, this, args)
+            set_cookie = None
+            if method == 'Login':
+                set_cookie = 'vmware_soap_session="%s"; Path=/; HttpOnly' % (
+                    result.key)
+                result = result.user_session
+            if isinstance(result, _Serialized):
+                returnval = result.xml
+            elif result is None:
+                returnval = ''
+            else:
+                returnval = _serialize(result, 'returnval', info.result,
+                                       info.resultFlags)
+            body = _envelope('<%sResponse xmlns="%s">%s</%sResponse>' % (
+                method, _NS, returnval, method))
+            return 200, body, method, set_cookie
+        except vmodl.MethodFault as e:
+            return 500, _fault_envelope(e), method, None
+        except Exception as e:
+            fault = vmodl.fault.SystemError(msg=str(e), reason=str(e))
+            return 500, _fault_envelope(fault), method, None
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep the connections alive, pyVmomi pools them
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written apart, do not wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def _send(self, status, body, content_type='text/xml; charset=utf-8',
+              cookie=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cookie:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/stats':
+            body = json.dumps(self.server.vcenter.stats.to_dict())
+            return self._send(200, body.encode('utf-8'), 'application/json')
+        if path != '/sdk/vimServiceVersions.xml':
+            return self._send(404, b'')
+        self._delay()
+        body = service_versions()
+        self._send(200, body)
+        self.server.vcenter.stats.record('vimServiceVersions', 0, len(body))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = self.rfile.read(length)
+        self._delay()
+        status, body, method, cookie = self.server.vcenter.handle(
+            request, self.headers.get('Cookie'))
+        self._send(status, body, cookie=cookie)
+        self.server.vcenter.stats.record(method, len(request), len(body))
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class FakevCenterServer(socketserver.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """Serves a FakevCenter over HTTPS, with a self signed certificate
+
+    usage:
+        server = FakevCenterServer(('127.0.0.1', 0), FakevCenter(8, 100, 4))
+        server.serve_forever()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, vcenter, latency=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+        self.vcenter = vcenter
+        self.latency = latency
+        self.verbose = verbose
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        directory = tempfile.mkdtemp(prefix='soil-fake-vcenter-')
+        try:
+            cert_file, key_file = _self_signed_cert(directory, address[0])
+            context.load_cert_chain(cert_file, key_file)
+        finally:
+            shutil.rmtree(directory)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+def _self_signed_cert(directory, host):
+    """Writes a self signed certificate of host, returns its files"""
+    backend = default_backend()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=backend)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME,
+                                         u'%s' % (host or 'localhost'))])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name).public_key(key.public_key()).serial_number(
+        uuid.uuid4().int).not_valid_before(
+        now - datetime.timedelta(days=1)).not_valid_after(
+        now + datetime.timedelta(days=365)).sign(key, hashes.SHA256(),
+                                                 backend)
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    with open(cert_file, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()))
+    return cert_file, key_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves a synthetic vCenter inventory over SOAP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443,
+                        help="port to listen on, 0 picks a free one")
+    parser.add_argument('--hosts', type=int, default=8)
+    parser.add_argument('--vms', type=int, default=100)
+    parser.add_argument('--datastores', type=int, default=4)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='vmware')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds slept before answering each request")
+    parser.add_argument('--task-duration', type=float, default=1.0,
+                        help="seconds a power task runs")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    vcenter = FakevCenter(args.hosts, args.vms, args.datastores,
+                          user=args.user, password=args.password,
+                          task_duration=args.task_duration)
+    server = FakevCenterServer((args.host, args.port), vcenter,
+                               latency=args.latency, verbose=args.verbose)
+    # the port is read back by whoever started the server
+    print('listening on https://%s:%d/sdk' % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
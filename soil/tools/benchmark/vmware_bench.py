@@ -0,0 +1,295 @@
+# Copyright 2020 Soil, Inc.
+
+"""Benchmarks the vCenter collectors against a fake vCenter.
+
+Starts the fake vCenter of fakevcenter.py with a synthetic inventory of
+every requested size and runs each benchmark in a process of its own against
+it, so the peak RSS of a benchmark is not inflated by the ones before.
+Reports, per inventory size and benchmark, the wall time, the SOAP round
+trips and bytes counted by the fake vCenter and the peak RSS of the
+benchmark process. It is a development tool, not installed with soil, and
+needs soil importable.
+
+usage:
+    python tools/benchmark/vmware_bench.py --size 16:1000:8 \
+        --size 128:10000:64 --latency 0.002
+
+"""
+
+import collections
+import json
+import os
+import re
+import resource
+import ssl
+import subprocess
+import sys
+import time
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from pyVmomi import vim
+from six.moves.urllib import request as urlrequest
+
+from soil import config
+from soil.api.utils.vmware import inventory
+from soil.api.utils.vmware.base import vCenterPropertyCollector
+from soil.api.utils.vmware.base import vCenterSmartConnect
+from soil.api.utils.vmware.common import plan_propspec
+from soil.api.views.vmware import vcenter as vcenter_views
+
+CONF = cfg.CONF
+logging.register_options(CONF)
+
+_USER = 'root'
+_PASSWORD = 'vmware'
+
+_FAKE_VCENTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fakevcenter.py')
+
+bench_opts = [
+    cfg.MultiStrOpt('size',
+                    default=['8:100:4', '32:1000:16', '128:10000:64'],
+                    help='HOSTS:VMS:DATASTORES of an inventory to benchmark, '
+                         'may be repeated'),
+    cfg.ListOpt('benchmarks',
+                default=['collector', 'collector_fast', 'collector_compact',
+                         'collector_columns', 'summary', 'tasks'],
+                help='The benchmarks to run'),
+    cfg.FloatOpt('latency',
+                 default=0.0,
+                 help='Seconds the fake vCenter waits before answering each '
+                      'request'),
+    cfg.IntOpt('tasks',
+               default=20,
+               help='Power tasks started and waited for by the tasks '
+                    'benchmark'),
+    cfg.FloatOpt('task_duration',
+                 default=1.0,
+                 help='Seconds a power task runs on the fake vCenter'),
+    cfg.StrOpt('output',
+               help='File the results are written to as JSON'),
+    cfg.StrOpt('run',
+               help='Runs this benchmark alone and prints its result, used '
+                    'by the benchmark processes'),
+    cfg.PortOpt('port',
+                help='Port of the fake vCenter, used by the benchmark '
+                     'processes'),
+]
+
+CONF.register_cli_opts(bench_opts)
+
+_vCenter = collections.namedtuple('_vCenter',
+                                  ['host', 'port', 'username', 'password'])
+
+_LISTENING_RE = re.compile(r'listening on https://[^:]+:(\d+)/')
+
+
+class _Meter(object):
+    """Measures the block it wraps, with the stats of the fake vCenter"""
+
+    def __init__(self, port):
+        self._url = 'https://127.0.0.1:%d/stats' % port
+        self.wall = None
+        self.stats = None
+
+    def _stats(self):
+        resp = urlrequest.urlopen(self._url,
+                                  context=ssl._create_unverified_context())
+        return json.loads(resp.read().decode('utf-8'))
+
+    def __enter__(self):
+        self._before = self._stats()
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wall = time.time() - self._started
+        after = self._stats()
+        self.stats = dict((key, after[key] - self._before[key])
+                          for key in ('round_trips', 'bytes_in', 'bytes_out'))
+
+
+def _collect(vcenter, meter, **kwargs):
+    properties = plan_propspec(inventory.INVENTORY_FIELDS)
+    with meter:
+        with vCenterPropertyCollector(vcenter, [], properties,
+                                      **kwargs) as result:
+            if 'columns' in kwargs:
+                return sum(len(batch) for key, batch in result.items()
+                           if key != 'content')
+            # without the service content
+            return len(result) - 1
+
+
+def _bench_collector(vcenter, meter):
+    return _collect(vcenter, meter)
+
+
+def _bench_collector_fast(vcenter, meter):
+    return _collect(vcenter, meter, fast=True)
+
+
+def _bench_collector_compact(vcenter, meter):
+    return _collect(vcenter, meter, compact=True)
+
+
+def _bench_collector_columns(vcenter, meter):
+    return _collect(vcenter, meter, columns=inventory.INVENTORY_FIELDS)
+
+
+def _bench_summary(vcenter, meter):
+    builder = vcenter_views.ViewBuilder()
+    with meter:
+        builder._summary(vcenter)
+
+
+def _bench_tasks(vcenter, meter):
+    with vCenterSmartConnect(vcenter) as vc:
+        vms = vc.get_container_view(vc.si.content.rootFolder,
+                                    [vim.VirtualMachine])[:CONF.tasks]
+        with meter:
+            tasks = [vm.PowerOnVM_Task() for vm in vms]
+            futures = [vc.watch_task(task) for task in tasks]
+            for future in futures:
+                future.wait()
+    return len(tasks)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('collector', _bench_collector),
+    ('collector_fast', _bench_collector_fast),
+    ('collector_compact', _bench_collector_compact),
+    ('collector_columns', _bench_collector_columns),
+    ('summary', _bench_summary),
+    ('tasks', _bench_tasks),
+])
+
+
+def _peak_rss():
+    """Returns the peak RSS of this process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run_benchmark(name):
+    # the collectors are measured, not the sessions shared through the db
+    CONF.set_override('share_sessions', False, 'vmware')
+    vcenter = _vCenter('127.0.0.1', CONF.port, _USER, _PASSWORD)
+    # log in once, the pooled session is used by the benchmark
+    with vCenterSmartConnect(vcenter):
+        pass
+
+    base_rss = _peak_rss()
+    meter = _Meter(CONF.port)
+    objects = BENCHMARKS[name](vcenter, meter)
+    result = {
+        'benchmark': name,
+        'objects': objects,
+        'wall': meter.wall,
+        'base_rss': base_rss,
+        'peak_rss': _peak_rss(),
+    }
+    result.update(meter.stats)
+    print(json.dumps(result))
+
+
+def _start_fake_vcenter(hosts, vms, datastores):
+    """Starts a fake vCenter, returns its process and port"""
+    process = subprocess.Popen(
+        [sys.executable, _FAKE_VCENTER,
+         '--port', '0', '--hosts', str(hosts), '--vms', str(vms),
+         '--datastores', str(datastores), '--user', _USER,
+         '--password', _PASSWORD, '--latency', str(CONF.latency),
+         '--task-duration', str(CONF.task_duration)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    match = _LISTENING_RE.match(process.stdout.readline())
+    if match is None:
+        process.kill()
+        process.wait()
+        raise RuntimeError("The fake vCenter did not start")
+    return process, int(match.group(1))
+
+
+def _spawn_benchmark(name, port):
+    args = [sys.executable, os.path.abspath(__file__), '--run', name,
+            '--port', str(port), '--tasks', str(CONF.tasks)]
+    for config_file in CONF.config_file or ():
+        args.extend(['--config-file', config_file])
+    process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    output, _err = process.communicate()
+    lines = output.strip().splitlines()
+    if process.returncode or not lines:
+        return {'benchmark': name, 'error': 'exit status %s' %
+                process.returncode}
+    return json.loads(lines[-1])
+
+
+def _parse_size(size):
+    try:
+        hosts, vms, datastores = [int(count) for count in size.split(':')]
+    except ValueError:
+        raise ValueError("size %s is not HOSTS:VMS:DATASTORES" % size)
+    return hosts, vms, datastores
+
+
+def _report(results):
+    header = ('%6s %7s %5s  %-18s %7s %9s %6s %12s %12s %9s %9s' %
+              ('hosts', 'vms', 'ds', 'benchmark', 'objects', 'wall (s)',
+               'trips', 'bytes out', 'bytes in', 'rss (MiB)', '+rss'))
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        prefix = '%6d %7d %5d  %-18s' % (result['hosts'], result['vms'],
+                                         result['datastores'],
+                                         result['benchmark'])
+        if 'error' in result:
+            print('%s failed: %s' % (prefix, result['error']))
+            continue
+        # the growth of the peak RSS over the one after the login
+        print('%s %7s %9.3f %6d %12d %12d %9.1f %9.1f' % (
+            prefix,
+            result['objects'] if result['objects'] is not None else '-',
+            result['wall'], result['round_trips'], result['bytes_out'],
+            result['bytes_in'], result['peak_rss'] / 1024.0,
+            (result['peak_rss'] - result['base_rss']) / 1024.0))
+
+
+def main():
+    config.parse_args(sys.argv, configure_db=False, init_rpc=False)
+    logging.setup(CONF, 'soil')
+    eventlet.monkey_patch()
+
+    if CONF.run:
+        return _run_benchmark(CONF.run)
+
+    unknown = [name for name in CONF.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        sys.exit("Unknown benchmarks %s, choose from %s" %
+                 (', '.join(unknown), ', '.join(BENCHMARKS)))
+    sizes = [_parse_size(size) for size in CONF.size]
+
+    results = []
+    for hosts, vms, datastores in sizes:
+        process, port = _start_fake_vcenter(hosts, vms, datastores)
+        try:
+            for name in CONF.benchmarks:
+                result = _spawn_benchmark(name, port)
+                result.update(hosts=hosts, vms=vms, datastores=datastores,
+                              latency=CONF.latency)
+                results.append(result)
+        finally:
+            process.terminate()
+            process.wait()
+
+    _report(results)
+    if CONF.output:
+        with open(CONF.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()